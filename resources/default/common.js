@@ -33,6 +33,22 @@ function trim(myString) {
 	return myString.replace(/^\s+/g, '').replace(/\s+$/g, '');
 }
 
+function decode_entries(json) {
+	// entries come as objects or, with format=columnar, as rows of fields
+	if (!json)
+		return [];
+	if (!json.fields)
+		return json.entries || [];
+	var entries = [];
+	for (var row = 0; row < json.rows.length; row++) {
+		var entry = {};
+		for (var column = 0; column < json.fields.length; column++)
+			entry[json.fields[column]] = json.rows[row][column];
+		entries.push(entry);
+	}
+	return entries;
+}
+
 function dumpObject(obj) {
 	return dumpObjectIndented(obj, "  ");
 }
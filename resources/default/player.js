@@ -1,9 +1,13 @@
 var timers = [];
+var poll_timer = null;
+var events = null;
 var clear_status = null;
 var volume = null;
 var muted = null;
+var suggest_timer = null;
 
 $(document).ready(function() {
+	subscribe_events();
 	update_status();
 	clear_info();
 	
@@ -16,16 +20,14 @@ $(document).ready(function() {
 	
 	$('#previous').click(function() {
 		$.post("rest/player", { action: "previous" }, function (data) {
-			timers.push(setTimeout('load_queue()', 200));
-			timers.push(setTimeout('update_status()', 500));
+			timers.push(setTimeout('refresh()', 500));
 			info('<i>previous...</i>');
 		});
 	});
 	
 	$('#next').click(function() {
 		$.post("rest/player", { action: "next" }, function (data) {
-			timers.push(setTimeout('load_queue()', 200));
-			timers.push(setTimeout('update_status()', 500));
+			timers.push(setTimeout('refresh()', 500));
 			info('<i>next...</i>');
 		});
 	});
@@ -96,6 +98,13 @@ $(document).ready(function() {
 		  }
 	});
 	
+	$('#search_filter').keyup(function(event) {
+		if (event.keyCode != '13') {
+			clearTimeout(suggest_timer);
+			suggest_timer = setTimeout('load_suggestions()', 150);
+		}
+	});
+	
 	$('#vol_down').click(function() {
 		set_volume(-0.1);
 	});
@@ -149,23 +158,41 @@ function set_volume(step) {
 }
 
 
+function load_suggestions() {
+	var filter = trim($('#search_filter').val());
+	if (filter.length < 2 || filter.indexOf(':') >= 0) {
+		$('#suggestions').html('');
+		return;
+	}
+	$.getJSON('rest/suggest', { 'q' : filter, 'limit' : 5 }, function(json) {
+		$('#suggestions').html('');
+		$.each(json, function(field, names) {
+			$.each(names, function(index, suggestion) {
+				$('<option>').val(suggestion.name).attr('label', field).appendTo('#suggestions');
+			});
+		});
+	});
+}
+
+
 function do_search(parameters) {
 	info('<i>searching...</i>');
 	var url = 'rest/search';
 	$('#search_result').html('');
 	$('#search_result').append(search_parameters_to_html(parameters));
 	$('#search_result').append('<img id="img_searching" src="img/loading.gif" width="16" height="16" alt="Searching..." title="Searching..." />');
-	$.post(url, parameters, function(json) {
+	$.post(url, $.extend({ 'format' : 'columnar' }, parameters), function(json) {
+		var entries = decode_entries(json);
 		$('#img_searching').hide();
 		$('#search_parameters').append(
 				'<span class="cell">' +
 				'<span class="prop">count</span>:' +
-				'<span class="val">' + json.entries.length + '</span>' +
+				'<span class="val">' + entries.length + '</span>' +
 				'</span>');
 		$('#search_result').append(create_header('search_header_actions'));
 		$('#search_header_actions').append(create_add_all('search_add_all'))
 		var ids = '';
-		$.each(json.entries, function(index, entry) {
+		$.each(entries, function(index, entry) {
 			add_search_entry(index, entry, 'search_result', true);
 			ids += entry.id + ',';
 		});
@@ -212,102 +239,156 @@ function search_parameters_to_html(parameters) {
 }
 
 
+function subscribe_events() {
+	if (!window.EventSource) {
+		return;
+	}
+	events = new EventSource('rest/events');
+	events.addEventListener('status', function(event) {
+		show_status(JSON.parse(event.data));
+	});
+	events.addEventListener('queue', function(event) {
+		if (!$('#queue').hasClass('hide')) {
+			load_queue();
+		}
+	});
+	events.onerror = function() {
+		// the server refused the stream, fall back to polling
+		if (events.readyState == EventSource.CLOSED) {
+			update_status();
+		}
+	};
+}
+
+
+function is_subscribed() {
+	return events && events.readyState != EventSource.CLOSED;
+}
+
+
 function update_status() {
+	clearTimeout(poll_timer);
+	if (is_subscribed()) {
+		return;
+	}
+	$.getJSON('rest/status', show_status).fail(handle_jquery_failure);
+	poll_timer = setTimeout('update_status()', 10000);
+}
+
+
+function refresh() {
+	// status and queue in one round trip, subscribers get the status pushed
+	if (is_subscribed()) {
+		load_queue();
+		return;
+	}
+	clearTimeout(poll_timer);
+	var requests = [{ 'path' : '/rest/status' }, { 'path' : '/rest/queue?format=columnar' }];
+	$.post('rest/batch', { 'requests' : JSON.stringify(requests) }, function(responses) {
+		if (responses[0].status == 200) {
+			show_status(responses[0].body);
+		}
+		if (responses[1].status == 200) {
+			show_queue(responses[1].body);
+		}
+	}, 'json').fail(handle_jquery_failure);
+	poll_timer = setTimeout('update_status()', 10000);
+}
+
+
+function show_status(json) {
 	
 	$.each(timers, function(index, timer) {
 		clearTimeout(timer);
 	});
+	timers = [];
 	
-	$.getJSON('rest/status', function(json) {
-		if (json && json.playing) {
-			$('#play').hide();
-			$('#pause').show();
-		} else {
-			$('#play').show();
-			$('#pause').hide();
-		}
-		
-		if (json && json.volume) {
-			volume = json.volume;
-			volume = Math.round(volume*100)/100;
-		} else {
-			volume = 0;
-		}
+	if (json && json.playing) {
+		$('#play').hide();
+		$('#pause').show();
+	} else {
+		$('#play').show();
+		$('#pause').hide();
+	}
+	
+	if (json && json.volume) {
+		volume = json.volume;
+		volume = Math.round(volume*100)/100;
+	} else {
+		volume = 0;
+	}
 
-		if (json && json.muted) {
-			muted = true;
-			$('#vol_status').attr('title', 'Muted')
-			$('#vol_status').attr('src', 'img/volume-muted.png');
+	if (json && json.muted) {
+		muted = true;
+		$('#vol_status').attr('title', 'Muted')
+		$('#vol_status').attr('src', 'img/volume-muted.png');
+	} else {
+		muted = false;
+		$('#vol_status').attr('title', 'Volume: ' + (volume * 100) + '%')
+		if (volume > 0.79) {
+			// high
+			$('#vol_status').attr('src', 'img/volume-high.png');
+		} else if (volume > 0.49) {
+			// medium
+			$('#vol_status').attr('src', 'img/volume-medium.png');
+		} else if (volume > 0.19) {
+			// low
+			$('#vol_status').attr('src', 'img/volume-low.png');
 		} else {
-			muted = false;
-			$('#vol_status').attr('title', 'Volume: ' + (volume * 100) + '%')
-			if (volume > 0.79) {
-				// high
-				$('#vol_status').attr('src', 'img/volume-high.png');
-			} else if (volume > 0.49) {
-				// medium
-				$('#vol_status').attr('src', 'img/volume-medium.png');
-			} else if (volume > 0.19) {
-				// low
-				$('#vol_status').attr('src', 'img/volume-low.png');
-			} else {
-				// muted
-				$('#vol_status').attr('src', 'img/volume-muted.png');
-			}
+			// muted
+			$('#vol_status').attr('src', 'img/volume-muted.png');
 		}
+	}
+	
+	if (json && json.playing) {
 		
-		if (json && json.playing) {
-			
-			var artist = '';
-			var album = '';
-			var title = '';
-			var time = 0;
-			
-			if (json && json.playing_entry) {
-				entry = json.playing_entry;
-				if (entry.title) {
-					title = entry.title;
-				}
-				if (entry.artist) {
-					artist = 'by <i>' + entry.artist + '</i>';
-				}
-				if (entry.album) {
-					album = 'from <i>' + entry.album + '</i>';
-				}
+		var artist = '';
+		var album = '';
+		var title = '';
+		var time = 0;
+		
+		if (json && json.playing_entry) {
+			entry = json.playing_entry;
+			if (entry.title) {
+				title = entry.title;
+			}
+			if (entry.artist) {
+				artist = 'by <i>' + entry.artist + '</i>';
+			}
+			if (entry.album) {
+				album = 'from <i>' + entry.album + '</i>';
 			}
+		}
 
-			$('#artist').html(artist);
-			$('#album').html(album);
-			$('#title').html(title);
+		$('#artist').html(artist);
+		$('#album').html(album);
+		$('#title').html(title);
 
-			var countdown = function() {
-				
-				var duration = entry.duration;
-				var actual_time = json.playing_time;
+		var countdown = function() {
+			
+			var duration = entry.duration;
+			var actual_time = json.playing_time;
+			
+			var timer_function = function () {
+				actual_time++;
 				
-				var timer_function = function () {
-					actual_time++;
-					
-					str_time = human_time(actual_time);
+				str_time = human_time(actual_time);
                     if (duration) {
                         str_time += ' <i> of </i> ' + human_time(duration);
                     }
-					$('#time').html(str_time);
-					
-					if (duration == 0 || actual_time < duration)
-						timers.push(setTimeout(timer_function, 1000));
-					else {
-						update_status();
-						timers.push(setTimeout('load_queue()', 100));
-					}
-				};
-				timers.push(setTimeout(timer_function, 1000));
-			}
-			
-			countdown();
+				$('#time').html(str_time);
+				
+				if (duration == 0 || actual_time < duration)
+					timers.push(setTimeout(timer_function, 1000));
+				else {
+					timers.push(setTimeout('refresh()', 100));
+				}
+			};
+			timers.push(setTimeout(timer_function, 1000));
 		}
-	}).fail(handle_jquery_failure);
-	timers.push(setTimeout('update_status()', 10000));
+		
+		countdown();
+	}
 }
 
 
@@ -335,33 +416,32 @@ function clear_info(speed, message) {
 
 
 function load_queue() {
-	$.getJSON('rest/queue', function(json) {
-		$('#queue').html('');
-		$('#queue').append(create_header('queue_header_actions'));
-		$('#queue_header_actions').append(create_remove_all('clear_queue'));
-		$('#queue_header_actions').append(create_shuffle_queue('shuffle_queue'));
-		if (json && json.entries) {
-			$.each(json.entries, function(index, entry) {
-				add_queue_entry(index, entry);
-			});
-		}
-		
-		$('#clear_queue').click(function() {
-			$.post("rest/player", {action : "clear_queue"}, function(data) {
-				info('<i>play queue cleared</i>');
-				$('#queue').html('');
-			});
+	$.getJSON('rest/queue', { 'format' : 'columnar' }, show_queue).fail(handle_jquery_failure);
+}
+
+
+function show_queue(json) {
+	$('#queue').html('');
+	$('#queue').append(create_header('queue_header_actions'));
+	$('#queue_header_actions').append(create_remove_all('clear_queue'));
+	$('#queue_header_actions').append(create_shuffle_queue('shuffle_queue'));
+	$.each(decode_entries(json), function(index, entry) {
+		add_queue_entry(index, entry);
+	});
+	
+	$('#clear_queue').click(function() {
+		$.post("rest/player", {action : "clear_queue"}, function(data) {
+			info('<i>play queue cleared</i>');
+			$('#queue').html('');
 		});
-		
-		$('#shuffle_queue').click(function() {
-			$.post("rest/player", { action: "shuffle_queue" }, function (data) {
-				timers.push(setTimeout('load_queue()', 500));
-				timers.push(setTimeout('update_status()', 500));
-				info('<i>playing queue shuffled</i>');
-			});
+	});
+	
+	$('#shuffle_queue').click(function() {
+		$.post("rest/player", { action: "shuffle_queue" }, function (data) {
+			timers.push(setTimeout('refresh()', 500));
+			info('<i>playing queue shuffled</i>');
 		});
-
-	}).fail(handle_jquery_failure);
+	});
 }
 
 
@@ -553,32 +633,27 @@ function load_tag_cloud() {
 
     };
 	
-	$.getJSON('rest/library/artists', function(json) {
-		biggest_value = json.max;
-        var index = 0;
-        $.each(json.values, function(name, value) {
-            write_html(name, value, 'artist', index++);
-        });
-		
-	}).fail(handle_jquery_failure);
+	var types = ['artist', 'album', 'genre'];
+	var requests = $.map(types, function(type) {
+		return { 'method' : 'GET', 'path' : '/rest/library/' + type + 's' };
+	});
 	
-	$.getJSON('rest/library/albums', function(json) {
-		biggest_value = json.max;
-        var index = 0;
-        $.each(json.values, function(name, value) {
-            write_html(name, value, 'album', index++);
-		});
-		
-	}).fail(handle_jquery_failure);
-
-	$.getJSON('rest/library/genres', function(json) {
-		biggest_value = json.max;
-        var index = 0;
-        $.each(json.values, function(name, value) {
-            write_html(name, value, 'genre', index++);
+	$.post('rest/batch', { 'requests' : JSON.stringify(requests) }, function(responses) {
+		$.each(responses, function(position, response) {
+			if (response.status != 200) {
+				return;
+			}
+			var json = response.body;
+			if (json.indexing !== undefined) {
+				info('<i>indexing, ' + json.indexing + '% done</i>');
+			}
+			biggest_value = json.max;
+			var index = 0;
+			$.each(json.values, function(name, value) {
+				write_html(name, value, types[position], index++);
+			});
 		});
-		
-	}).fail(handle_jquery_failure);
+	}, 'json').fail(handle_jquery_failure);
 
 }
 
@@ -1,81 +1,112 @@
 import re
 import os
-import copy
+import gzip
+import zlib
+import hashlib
 
-from functools import partial
 from collections import defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+
+from rhythmweb.utils import parse_accept
 
 import logging
 log = logging.getLogger(__name__)
 
+ENCODINGS = ('gzip', 'deflate')
+COMPRESSED_EXTENSIONS = {'png', 'gif', 'ico', 'jpg', 'jpeg', 'gz', 'zip'}
+
 
 class NoRouteError(Exception):
     pass
 
 
+CONVERTERS = {'int': int, 'float': float, 'str': str}
+
+
 class App(object):
 
     def __init__(self):
-        self.routes = {}
+        self.root = RouteNode()
         self.file_groups = defaultdict(lambda: {})
+        self.contents = {}
+        self.check_mtime = False
         self.path_with_args_matcher = re.compile(r'(/.+?)<')
         self.args_matcher = re.compile(r'(<.*?>)')
         self.typed_rule_matcher = re.compile(r'<([\w\?]+):(int|float|str)>')
         self.simple_rule_matcher = re.compile(r'<([\w\?]+)>')
 
-    def add_route(self, path, function):
-        path, args = self.parse_route(path)
-        self.routes[path] = (function, args)
+    def add_route(self, path, function, query=()):
+        path, rules = self.parse_route(path)
+        node = self.root
+        for segment in path.split('/'):
+            node = node.children.setdefault(segment, RouteNode())
+        node.function = function
+        node.rules = tuple(rules)
+        node.query = tuple(query)
         log.debug('Registering route {}'.format(path))
 
+    def iter_routes(self):
+        """Yields (path, function, rules) for every route in the trie"""
+        pending = [(None, self.root)]
+        while pending:
+            path, node = pending.pop()
+            if node.function is not None:
+                yield path, node.function, node.rules
+            for segment, child in node.children.items():
+                pending.append((segment if path is None else path + '/' + segment, child))
+
     def route(self, path, **kwargs):
         try:
             route, args = self.find_route(path)
-            log.debug('Found route function {}'.format(route))
+            log.debug('Found route function %s', route)
             return route(*args, **kwargs)
         except NoRouteError:
             return None
 
     def find_route(self, path):
-        log.debug('Looking for route that matches {}'.format(path))
-        possible = path.split('/')
-        while possible:
-            possible_path = '/'.join(possible)
-            route, rules = self.routes.get(possible_path, (None, None))
-            if route:
-                log.debug('Found route {}'.format(possible_path))
-                if rules:
-                    rules = copy.copy(rules)
-                    args = self.parse_path_args(path[len(possible_path):], rules)
-                else:
-                    args = []
-                return route, args
-            possible.pop()
-        log.debug('Route for path {} not found'.format(path))
-        raise NoRouteError()
-
-    def parse_path_args(self, args, rules):
-        log.debug('Looking for path arguments with this path {} and rules {}'.format(args, rules))
-        slices = args.split('/')
-        slices.reverse()
-        rules.reverse()
-        parsed_args = []
-        while rules and slices:
-            arg = slices.pop()
-            if not arg:
-                continue
-            parsed_args.append(self.validate_rule(rules.pop(), arg))
-        while rules:
-            rule = rules.pop()
-            log.debug('There are rules left: {}'.format(rule))
-            if rule['optional']:
-                parsed_args.append(None)
-            else:
+        """
+        Walks the route trie down the path segments, the deepest route found
+        gets the rest of the segments as arguments
+        """
+        segments = path.split('/')
+        found, position = self.find_node(segments)
+        if not found.rules:
+            return found.function, []
+        return found.function, self.parse_path_args(segments[position:], found.rules)
+
+    def query_parameters(self, path, parameters):
+        """
+        Keeps the query string parameters the route for path declared, any
+        other parameter (a cache buster) is ignored
+        """
+        try:
+            node, _ = self.find_node(path.split('/'))
+        except NoRouteError:
+            return {}
+        return {name: parameters[name] for name in node.query if name in parameters}
+
+    def find_node(self, segments):
+        node = self.root
+        found = None
+        for index, segment in enumerate(segments):
+            node = node.children.get(segment, None)
+            if node is None:
+                break
+            if node.function is not None:
+                found, position = node, index + 1
+        if found is None:
+            log.debug('Route for path %s not found', '/'.join(segments))
+            raise NoRouteError()
+        return found, position
+
+    def parse_path_args(self, segments, rules):
+        values = [segment for segment in segments if segment]
+        args = [self.validate_rule(rule, value) for rule, value in zip(rules, values)]
+        for rule in rules[len(args):]:
+            if not rule['optional']:
                 raise NoRouteError()
-        if slices:
-            slices.reverse()
-            log.debug('Path parts where not exausted, this is left: {}'.format(slices))
-        return parsed_args
+            args.append(None)
+        return args
 
     def parse_rule(self, rule):
         typed_rule = self.typed_rule_matcher.match(rule)
@@ -86,19 +117,15 @@ class App(object):
         optional = name.endswith('?')
         if optional:
             name = name[:-1]
-        return {'name': name, 'type': kind, 'optional': optional}
+        return {'name': name, 'type': kind, 'optional': optional,
+                'convert': CONVERTERS[kind]}
 
     def validate_rule(self, rule, value):
-        kind = rule['type']
         try:
-            if kind == 'int':
-                return int(value)
-            elif kind == 'float':
-                return float(value)
-            else:
-                return str(value)
-        except:
-            raise ValueError('{} is invalid as value for {}, {} expected'.format(value, rule['name'], kind))
+            return rule['convert'](value)
+        except ValueError:
+            raise ValueError('{} is invalid as value for {}, {} expected'.format(
+                value, rule['name'], rule['type']))
 
     def parse_route(self, path):
         has_args = self.path_with_args_matcher.match(path)
@@ -113,10 +140,21 @@ class App(object):
         return path, rules
 
     def get_file(self, path, group):
-        readfile = self.file_groups[group].get(path, None)
-        if readfile:
-            return readfile()
-        return None
+        static_file = self.file_groups[group].get(path, None)
+        if static_file and self.check_mtime and static_file.is_stale():
+            log.debug('Reloading modified file {}'.format(static_file.path))
+            static_file = self.load_file(static_file.path)
+            self.file_groups[group][path] = static_file
+        return static_file
+
+    def load_file(self, path):
+        mtime = os.stat(path).st_mtime
+        content = read_file(path)
+        digest = hashlib.sha1(content).hexdigest()
+        if digest not in self.contents:
+            self.contents[digest] = (content, compress(path, content))
+        content, variants = self.contents[digest]
+        return StaticFile(path, content, digest, mtime, variants)
 
     def mount(self, path, group, ignore=None):
         if ignore_file(path):
@@ -136,7 +174,7 @@ class App(object):
                 log.debug('Ignoring path start {}'.format(ignore))
                 route = route[len(ignore):]
             log.debug('Registering route {} to read file {}'.format(route, path))
-            self.file_groups[group][route] = partial(read_file, path)
+            self.file_groups[group][route] = self.load_file(path)
         else:
             raise IOError('{} does not exists'.format(path))
 
@@ -154,12 +192,99 @@ def ignore_file(path):
 
 def read_file(path):
     with open(path, 'rb') as f:
-        return f.readlines()
+        return f.read()
+
+
+def compress(path, content):
+    """Builds the compressed variants of a file worth serving"""
+    extension = path.split('.')[-1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return {}
+    variants = {
+        'gzip': gzip.compress(content, mtime=0),
+        'deflate': zlib.compress(content, 9),
+    }
+    return {encoding: variant for encoding, variant in variants.items()
+            if len(variant) < len(content)}
+
+
+class RouteNode(object):
+    """A path segment of the route trie, it holds a route if one ends here"""
+
+    __slots__ = ('children', 'function', 'rules', 'query')
+
+    def __init__(self):
+        self.children = {}
+        self.function = None
+        self.rules = ()
+        self.query = ()
+
+
+class StaticFile(object):
+    """
+    A mounted file held in memory, identical contents mounted in different
+    groups share the same bytes, compressed variants and validators
+    """
+
+    def __init__(self, path, content, digest, mtime, variants=None):
+        self.path = path
+        self.content = content
+        self.mtime = mtime
+        self.variants = variants or {}
+        self.etag = '"{}"'.format(digest)
+        self.etags = {encoding: '"{}-{}"'.format(digest, encoding)
+                      for encoding in self.variants}
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+    def __len__(self):
+        return len(self.content)
+
+    def encode(self, accept_encoding):
+        """Returns the encoding, content and etag that better fits the client"""
+        if self.variants and accept_encoding:
+            accepted = parse_accept(accept_encoding)
+            default = accepted.get('*', 0)
+            best, quality = None, 0
+            for encoding in ENCODINGS:
+                if encoding in self.variants and accepted.get(encoding, default) > quality:
+                    best, quality = encoding, accepted.get(encoding, default)
+            if best:
+                return best, self.variants[best], self.etags[best]
+        return None, self.content, self.etag
+
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def is_not_modified(self, environ):
+        """Evaluates the conditional request headers against this file"""
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            etags = [etag[2:] if etag.startswith('W/') else etag for etag in etags]
+            if '*' in etags or self.etag in etags:
+                return True
+            return any(etag in etags for etag in self.etags.values())
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE', None)
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(self.mtime) <= since
+        return False
 
 
-def route(path):
+def route(path, query=()):
+    """
+    Registers the function for path, GET requests only pass the query
+    string parameters named in query
+    """
     def decorate(func):
-        app.add_route(path, func)
+        app.add_route(path, func, query)
+        return func
     return decorate
 
 
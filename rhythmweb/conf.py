@@ -12,6 +12,9 @@ class Configuration(object):
             'theme.mobile' : 'touch',
             'hostname' : '0.0.0.0',
             'port' : '7000',
+            'keepalive.timeout' : '15',
+            'keepalive.requests' : '100',
+            'events.subscribers' : '50',
             'log.file' : '/tmp/rb-serve.log',
             'log.level' : 'INFO',
             'log.format' : '%(levelname)s	%(asctime)s	%(name)s: %(message)s',
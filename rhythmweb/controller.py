@@ -1,7 +1,10 @@
 
-from collections import defaultdict
+import json
+from collections import defaultdict, OrderedDict
+from itertools import chain
 
-from rhythmweb.model import get_song, get_playlist
+from gi.repository import GLib
+from rhythmweb.model import get_song, get_rows, get_playlist, SONG_FIELDS
 from rhythmweb.rb import RBHandler, RBEntry
 from rhythmweb import rb
 
@@ -9,10 +12,25 @@ import logging
 log = logging.getLogger(__name__)
 
 rb_handler = {}
+status_history = OrderedDict()
+status_cache = {}
+song_fragments = OrderedDict()
+
+MAX_STATUS_HISTORY = 32
+LONG_POLL_SECONDS = 30
+SONG_FRAGMENTS_SIZE = 2000
+SUGGEST_FIELDS = OrderedDict((('artist', 'artists'), ('album', 'albums'),
+    ('title', 'songs'), ('genre', 'genres')))
 
 def set_shell(shell):
     rb_handler['rb'] = RBHandler(shell)
     rb_handler['shell'] = shell
+    rb_handler.pop('events', None)
+    status_history.clear()
+    status_cache.clear()
+    song_fragments.clear()
+    shell.props.db.connect('entry-changed', forget_song)
+    shell.props.db.connect('entry-deleted', forget_song)
 
 def get_handler():
     return rb_handler.get('rb', None)
@@ -20,17 +38,48 @@ def get_handler():
 def get_shell():
     return rb_handler.get('shell', None)
 
+def get_events():
+    if 'events' not in rb_handler:
+        rb_handler['events'] = Events(get_handler())
+    return rb_handler['events']
+
+def get_song_fragment(entry, fields=SONG_FIELDS):
+    """
+    The song of the entry as encoded json, kept by entry id until the entry
+    changes so popular entries are not read and encoded on every request
+    """
+    fragments = song_fragments.get(entry.id, None)
+    if fragments is None:
+        fragments = song_fragments[entry.id] = {}
+        while len(song_fragments) > SONG_FRAGMENTS_SIZE:
+            song_fragments.popitem(last=False)
+    else:
+        song_fragments.move_to_end(entry.id)
+    fragment = fragments.get(fields, None)
+    if fragment is None:
+        fragment = fragments[fields] = bytes(json.dumps(get_song(entry, fields)), 'UTF-8')
+    return fragment
+
+def forget_song(db, entry, *args):
+    song_fragments.pop(RBEntry(entry).id, None)
+
+def get_songs(entries, fields=SONG_FIELDS, columnar=False):
+    """The songs of the entries as encoded json fragments, or columnar rows"""
+    if columnar:
+        return get_rows(entries, fields)
+    return {'entries': (get_song_fragment(entry, fields) for entry in entries)}
+
 class Song(object):
 
     def __init__(self):
         self.rb = get_handler()
 
-    def find_by_id(self, song_id):
+    def find_by_id(self, song_id, fields=SONG_FIELDS):
         entry = self.rb.get_entry(song_id)
         if not entry:
             return None
         log.debug('Found song %d', song_id)
-        return get_song(entry)
+        return get_song(entry, fields)
 
     def rate(self, song):
         self.set_rating(song, song['rating'])
@@ -48,11 +97,13 @@ class Queue(object):
         self.rb = get_handler()
         self.queue = rb.Queue(get_shell())
 
-    def get_queue(self):
+    def get_queue(self, fields=SONG_FIELDS, columnar=False):
         entries = self.queue.get_play_queue()
+        if columnar:
+            return get_rows(entries, fields) if entries else {}
         queue = defaultdict(lambda:[])
         for entry in entries:
-            queue['entries'].append(get_song(entry))
+            queue['entries'].append(get_song_fragment(entry, fields))
         return queue
 
     def enqueue(self, entry_id):
@@ -64,6 +115,12 @@ class Queue(object):
     def shuffle_queue(self):
         self.queue.shuffle_queue()
 
+    def update_queue(self, add=(), remove=(), move=(), replace=None):
+        self.queue.update_queue(add, remove, move, replace)
+
+    def reorder_queue(self, entry_ids):
+        self.queue.reorder_queue(entry_ids)
+
     def clear_queue(self):
         self.queue.clear_play_queue()
 
@@ -108,10 +165,229 @@ class Player(object):
         status['volume'] = handler.get_volume()
         return status
 
+    def snapshot(self):
+        """
+        The status from the handler snapshot, it is only serialized again
+        when the state version changes
+        """
+        version = self.rb.state_version
+        if status_cache.get('version', None) != version:
+            snapshot = self.rb.get_snapshot()
+            status = {}
+            for key in ('playing', 'playing_order', 'muted', 'volume'):
+                status[key] = snapshot[key]
+            if snapshot['playing_entry']:
+                status['playing_entry'] = get_song(snapshot['playing_entry'])
+            status_cache['version'] = version
+            status_cache['status'] = status
+            status_cache['body'] = bytes(json.dumps(status), 'UTF-8')
+        return StatusSnapshot(status_cache['status'], status_cache['body'], self.rb)
+
+    def watch(self, since, timeout=LONG_POLL_SECONDS):
+        """
+        Returns the status changes after the since version, or a watch
+        to wait for them if nothing changed yet
+        """
+        if since != self.rb.state_version:
+            return self.status_since(since)
+        timeout = max(1, min(timeout, LONG_POLL_SECONDS))
+        return StatusWatch(self.rb, since, timeout)
+
+    def status_since(self, since):
+        version = self.rb.state_version
+        status = self.snapshot().as_dict()
+        previous = status_history.get(since, None)
+        status_history[version] = status
+        while len(status_history) > MAX_STATUS_HISTORY:
+            status_history.popitem(last=False)
+        changes = status_changes(previous, status) if previous else dict(status)
+        changes['version'] = version
+        return changes
+
+
+class StatusSnapshot(object):
+    """A serialized status, only the playing time is filled in when sent"""
+
+    def __init__(self, status, body, handler):
+        self.status = status
+        self.body = body
+        self.rb = handler
+
+    def as_dict(self):
+        status = dict(self.status)
+        if 'playing_entry' in status:
+            status['playing_time'] = self.rb.get_elapsed()
+        return status
+
+    def encode(self):
+        if 'playing_entry' not in self.status:
+            return self.body
+        return b''.join((b'{"playing_time": ', bytes(str(self.rb.get_elapsed()), 'UTF-8'),
+            b', ', self.body[1:]))
+
+
+class StatusWatch(object):
+    """
+    A status request parked until the state version moves past since or
+    the timeout expires, it does not hold anything but a listener and a
+    timer while it waits
+    """
+
+    def __init__(self, handler, since, timeout):
+        self.rb = handler
+        self.since = since
+        self.done = False
+        self.wakeup = None
+        self.rb.add_state_listener(self.state_changed)
+        self._timeout_id = GLib.timeout_add_seconds(timeout, self.expired)
+
+    def state_changed(self, what, version):
+        self.finish()
+
+    def expired(self):
+        self._timeout_id = None
+        self.finish()
+        return False
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.close()
+        if self.wakeup:
+            self.wakeup()
+
+    def result(self):
+        return Player().status_since(self.since)
+
+    def close(self):
+        self.rb.remove_state_listener(self.state_changed)
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+
+def status_changes(old, new):
+    """The fields that changed between two status, None for the removed ones"""
+    changes = dict((key, value) for key, value in new.items()
+            if old.get(key, None) != value)
+    changes.update((key, None) for key in old if key not in new)
+    return changes
+
+
+HEARTBEAT_SECONDS = 25
+
+class Events(object):
+    """
+    Fans out the player and queue changes to the event stream subscribers,
+    payloads are built once per change and shared by all the subscribers
+    """
+
+    def __init__(self, handler):
+        self.rb = handler
+        self.subscribers = set()
+        self.changed = set()
+        self._idle_id = None
+        self._heartbeat_id = None
+        self.rb.add_state_listener(self.state_changed)
+
+    def subscribe(self):
+        stream = EventStream(self)
+        stream.push('status', self.status())
+        self.subscribers.add(stream)
+        if self._heartbeat_id is None:
+            self._heartbeat_id = GLib.timeout_add_seconds(
+                    HEARTBEAT_SECONDS, self.heartbeat)
+        log.debug('Event subscriber added, %d connected', len(self.subscribers))
+        return stream
+
+    def unsubscribe(self, stream):
+        self.subscribers.discard(stream)
+        if not self.subscribers and self._heartbeat_id is not None:
+            GLib.source_remove(self._heartbeat_id)
+            self._heartbeat_id = None
+        log.debug('Event subscriber removed, %d connected', len(self.subscribers))
+
+    def state_changed(self, what, version):
+        if not self.subscribers:
+            return
+        self.changed.add(what)
+        if self._idle_id is None:
+            self._idle_id = GLib.idle_add(self.flush)
+
+    def flush(self):
+        self._idle_id = None
+        changed, self.changed = self.changed, set()
+        events = []
+        if rb.STATE_PLAYER in changed:
+            events.append(('status', self.status()))
+        if rb.STATE_QUEUE in changed:
+            events.append(('queue', json.dumps({'version' : self.rb.state_version})))
+        for stream in list(self.subscribers):
+            for kind, data in events:
+                stream.push(kind, data)
+        return False
+
+    def heartbeat(self):
+        for stream in list(self.subscribers):
+            stream.push(None, None)
+        return True
+
+    def status(self):
+        return Player().snapshot().encode().decode('UTF-8')
+
+
+class EventStream(object):
+    """
+    A subscription to the player events, it only keeps the last event of
+    each kind so a slow client skips stale states instead of piling them up
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.pending = OrderedDict()
+        self.wakeup = None
+
+    def push(self, kind, data):
+        self.pending.pop(kind, None)
+        self.pending[kind] = data
+        if self.wakeup:
+            self.wakeup()
+
+    def pop(self):
+        pending, self.pending = self.pending, OrderedDict()
+        return list(pending.items())
+
+    def close(self):
+        self.events.unsubscribe(self)
+
 
-def query_library(what):
+def query_library(what, **page):
+    """
+    The library table, or a page of it when any of sort, prefix, first or
+    limit are given, with the indexing progress while it is built
+    """
     log.debug('Looking for library %s', what)
-    return getattr(get_handler().library, what, {})
+    library = get_handler().library
+    if page:
+        values = library.select(what, **page)
+    else:
+        values = getattr(library, what, {})
+    progress = library.progress()
+    if progress is not None:
+        values = dict(values, indexing=progress)
+    return values
+
+
+def library_suggestions(prefix, fields, limit):
+    """Names starting with prefix for every field, most played first"""
+    log.debug('Suggesting %s for %s', fields, prefix)
+    library = get_handler().library
+    suggestions = {}
+    for field in fields:
+        suggestions[field] = [{'name': name, 'play_count': play_count}
+            for name, play_count in library.suggest(SUGGEST_FIELDS[field], prefix, limit)]
+    return suggestions
 
 
 class Query(object):
@@ -119,11 +395,28 @@ class Query(object):
     def __init__(self):
         self.rb = get_handler()
 
-    def query(self, query_filter):
-        entries = defaultdict(lambda: [])
-        for entry in self.rb.query(query_filter):
-            entries['entries'].append(get_song(entry))
-        return entries
+    def query(self, query_filter, fields=SONG_FIELDS, columnar=False):
+        """
+        The entries are converted while they are sent, only the first one is
+        read here so an empty result is still an empty object
+        """
+        if 'cursor' in query_filter:
+            return self.page(query_filter, fields, columnar)
+        entries = iter(self.rb.query(query_filter))
+        first = next(entries, None)
+        if first is None:
+            return {}
+        return get_songs(chain([first], entries), fields, columnar)
+
+    def page(self, query_filter, fields=SONG_FIELDS, columnar=False):
+        """A page of a search cursor, with the cursor to ask for the next one"""
+        entries, cursor = self.rb.query_cursor(query_filter)
+        page = {}
+        if entries:
+            page.update(get_songs(entries, fields, columnar))
+        if cursor:
+            page['cursor'] = cursor
+        return page
 
 
 class Source(object):
@@ -153,11 +446,11 @@ class Source(object):
             return False
         return self.rb.play_source(source)
 
-    def get_playlist(self, playlist_id):
-        return get_playlist(self.get_source(playlist_id))
+    def get_playlist(self, playlist_id, fields=SONG_FIELDS):
+        return get_playlist(self.get_source(playlist_id), fields)
 
-    def get_playlists(self):
-        return [get_playlist(source) for source in self.get_sources()]
+    def get_playlists(self, fields=SONG_FIELDS):
+        return [get_playlist(source, fields) for source in self.get_sources()]
 
 
 def as_list(value):
@@ -0,0 +1,223 @@
+import re
+import math
+import unicodedata
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+import logging
+log = logging.getLogger(__name__)
+
+EMPTY_NAME = '[empty]'
+
+TOKEN = re.compile(r'\w+')
+
+FUZZY_THRESHOLD = 0.3
+
+# artist, album, genre and title
+FIELD_WEIGHTS = (3.0, 1.5, 0.5, 1.0)
+BM25_K1 = 1.2
+BM25_B = 0.75
+PREFIX_WEIGHT = 0.5
+EXACT_ARTIST_BOOST = 2.0
+
+
+def fold(text):
+    """Case and accent insensitive form of text"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return TOKEN.findall(fold(text))
+
+
+def trigrams(token):
+    """The trigrams of a token padded as pg_trgm does, two blanks ahead"""
+    padded = '  ' + token + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SearchIndex(object):
+    """
+    Inverted index of the folded artist, album, genre and title tokens of
+    every entry. A search token matches every indexed token it is a prefix
+    of, the entries have to match all the search tokens.
+
+    The indexed tokens are themselves indexed by trigram so a fuzzy search
+    only compares a misspelled token with the tokens sharing a trigram.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.tokens = []
+        self.trigrams = defaultdict(set)
+        self.documents = {}
+        self.lengths = [0] * len(FIELD_WEIGHTS)
+
+    def update(self, entry_id, names, track_number=0):
+        """
+        Indexes the entry names, in the library order: artist, album,
+        genre and title
+        """
+        self.remove(entry_id)
+        fields = tuple(tokenize(name) if name != EMPTY_NAME else [] for name in names)
+        tokens = set()
+        for field, field_tokens in enumerate(fields):
+            tokens.update(field_tokens)
+            self.lengths[field] += len(field_tokens)
+        for token in tokens:
+            posting = self.postings[token]
+            if not posting:
+                insort(self.tokens, token)
+                for trigram in trigrams(token):
+                    self.trigrams[trigram].add(token)
+            posting.add(entry_id)
+        artist, album, genre, title = [fold(name) for name in names]
+        self.documents[entry_id] = (tokens, (artist, album, track_number, title), fields)
+
+    def remove(self, entry_id):
+        document = self.documents.pop(entry_id, None)
+        if document is None:
+            return
+        for field, field_tokens in enumerate(document[2]):
+            self.lengths[field] -= len(field_tokens)
+        for token in document[0]:
+            posting = self.postings[token]
+            posting.discard(entry_id)
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+                for trigram in trigrams(token):
+                    similar = self.trigrams[trigram]
+                    similar.discard(token)
+                    if not similar:
+                        del self.trigrams[trigram]
+
+    def matching(self, token):
+        """The entries with any token starting with token"""
+        start = bisect_left(self.tokens, token)
+        end = bisect_left(self.tokens, token + '\U0010ffff')
+        if end - start == 1:
+            return self.postings[self.tokens[start]]
+        found = set()
+        for indexed in self.tokens[start:end]:
+            found.update(self.postings[indexed])
+        return found
+
+    def search(self, text):
+        """
+        The ids of the entries matching every token of text, each id once,
+        sorted by artist, album, track number and title
+        """
+        tokens = sorted(set(tokenize(text)), key=len, reverse=True)
+        if not tokens:
+            return []
+        found = None
+        for token in tokens:
+            matches = self.matching(token)
+            found = set(matches) if found is None else found & matches
+            if not found:
+                return []
+        log.debug('Index found {} entries for "{}"'.format(len(found), text))
+        return sorted(found, key=lambda entry_id: self.documents[entry_id][1])
+
+    def similar(self, token, threshold=FUZZY_THRESHOLD):
+        """
+        The indexed tokens with their trigram similarity to token, shared
+        trigrams over all the trigrams of both, at least threshold. Tokens
+        token is a prefix of are exact matches.
+        """
+        found = {}
+        wanted = trigrams(token)
+        shared = defaultdict(int)
+        for trigram in wanted:
+            for indexed in self.trigrams.get(trigram, ()):
+                shared[indexed] += 1
+        for indexed, count in shared.items():
+            similarity = count / (len(wanted) + len(trigrams(indexed)) - count)
+            if similarity >= threshold:
+                found[indexed] = similarity
+        start = bisect_left(self.tokens, token)
+        end = bisect_left(self.tokens, token + '\U0010ffff')
+        for indexed in self.tokens[start:end]:
+            found[indexed] = 1.0
+        return found
+
+    def fuzzy_search(self, text, threshold=FUZZY_THRESHOLD):
+        """
+        The ids of the entries with a token similar to every token of text,
+        best scored first, the score of an entry is the sum of the best
+        similarity for each token
+        """
+        tokens = set(tokenize(text))
+        if not tokens:
+            return []
+        scores = None
+        for token in tokens:
+            best = {}
+            for indexed, similarity in self.similar(token, threshold).items():
+                for entry_id in self.postings[indexed]:
+                    if best.get(entry_id, 0) < similarity:
+                        best[entry_id] = similarity
+            if scores is None:
+                scores = best
+            else:
+                scores = dict((entry_id, score + best[entry_id])
+                    for entry_id, score in scores.items() if entry_id in best)
+            if not scores:
+                return []
+        log.debug('Fuzzy index found {} entries for "{}"'.format(len(scores), text))
+        return sorted(scores, key=lambda entry_id: (-scores[entry_id], self.documents[entry_id][1]))
+
+    def terms(self, token, fuzzy=False):
+        """
+        The indexed tokens a search token matches with their weight, the
+        token itself counts fully and longer or similar tokens count less
+        """
+        if fuzzy:
+            terms = dict((indexed, similarity * PREFIX_WEIGHT)
+                for indexed, similarity in self.similar(token).items())
+        else:
+            start = bisect_left(self.tokens, token)
+            end = bisect_left(self.tokens, token + '\U0010ffff')
+            terms = dict((indexed, PREFIX_WEIGHT) for indexed in self.tokens[start:end])
+        if token in self.postings:
+            terms[token] = 1.0
+        return terms
+
+    def relevance(self, text, entry_ids, fuzzy=False):
+        """
+        BM25F scores of the given entries for text: the term frequencies of
+        every field are weighted, artist first, and normalized by the field
+        length before saturating. Entries whose artist is exactly the text
+        get their score doubled.
+        """
+        tokens = tokenize(text)
+        count = len(self.documents)
+        if not tokens or not count:
+            return {}
+        averages = [max(length / count, 1.0) for length in self.lengths]
+        queried = []
+        for token in set(tokens):
+            terms = self.terms(token, fuzzy)
+            idf = dict((term, math.log(1 + (count - len(self.postings[term]) + 0.5)
+                / (len(self.postings[term]) + 0.5))) for term in terms)
+            queried.append((terms, idf))
+        scores = {}
+        for entry_id in entry_ids:
+            fields = self.documents[entry_id][2]
+            score = 0.0
+            for terms, idf in queried:
+                frequencies = defaultdict(float)
+                for field, field_tokens in enumerate(fields):
+                    norm = FIELD_WEIGHTS[field] / (1 - BM25_B + BM25_B * len(field_tokens) / averages[field])
+                    for field_token in field_tokens:
+                        if field_token in terms:
+                            frequencies[field_token] += terms[field_token] * norm
+                for term, frequency in frequencies.items():
+                    score += idf[term] * frequency * (BM25_K1 + 1) / (frequency + BM25_K1)
+            if fields[0] == tokens:
+                score *= EXACT_ARTIST_BOOST
+            scores[entry_id] = score
+        return scores
@@ -1,23 +1,22 @@
-def get_song(entry):
+SONG_FIELDS = ('id', 'artist', 'album', 'track_number', 'title', 'duration',
+    'rating', 'year', 'genre', 'play_count', 'bitrate', 'last_played', 'location')
+
+def get_song(entry, fields=SONG_FIELDS):
     if not entry:
         return None
     song = {}
-    song['id'] = entry.id
-    song['artist'] = entry.artist
-    song['album'] = entry.album
-    song['track_number'] = entry.track_number
-    song['title'] = entry.title
-    song['duration'] = entry.duration
-    song['rating'] = entry.rating
-    song['year'] = entry.year
-    song['genre'] = entry.genre
-    song['play_count'] = entry.play_count
-    song['bitrate'] = entry.bitrate
-    song['last_played'] = entry.last_played
-    song['location'] = entry.location
+    for field in fields:
+        song[field] = getattr(entry, field)
     return song
 
-def get_playlist(playlist):
+def get_row(entry, fields=SONG_FIELDS):
+    return [getattr(entry, field) for field in fields]
+
+def get_rows(entries, fields=SONG_FIELDS):
+    """The songs of the entries as a header with the field names and a row per entry"""
+    return {'fields': list(fields), 'rows': (get_row(entry, fields) for entry in entries)}
+
+def get_playlist(playlist, fields=SONG_FIELDS):
     if not playlist:
         return None
     plst = {}
@@ -25,7 +24,7 @@ def get_playlist(playlist):
     plst['name'] = playlist.name
     plst['type'] = playlist.source_type
     if playlist.entries:
-        plst['entries'] = [get_song(entry) for entry in playlist.entries]
+        plst['entries'] = (get_song(entry, fields) for entry in playlist.entries)
     else:
         plst['entries'] = []
     return plst
@@ -1,10 +1,16 @@
+import time
+import math
+import heapq
 import random
+import itertools
 import logging
 log = logging.getLogger(__name__)
 
 from gi.repository import RB, GLib
 from rhythmweb.utils import to_list, to_int
-from collections import defaultdict
+from rhythmweb.index import SearchIndex, EMPTY_NAME
+from bisect import bisect_left, insort
+from collections import defaultdict, OrderedDict
 
 ORDER_LINEAR = 'linear'
 ORDER_SHUFFLE = 'shuffle'
@@ -32,6 +38,48 @@ RB_SOURCELIST_MODEL_COLUMN_GROUP_CATEGORY = 7
 SOURCETYPE_PLAYLIST = 'playlist'
 SOURCETYPE_SOURCE = 'source'
 
+STATE_PLAYER = 'player'
+STATE_QUEUE = 'queue'
+
+PLAYER_SIGNALS = ('playing-song-changed',
+                  'notify::volume', 'notify::mute', 'notify::play-order')
+QUEUE_SIGNALS = ('row-inserted', 'row-deleted', 'rows-reordered')
+
+ELAPSED_DRIFT = 2
+
+LIBRARY_PROPS = (RB.RhythmDBPropType.ARTIST, RB.RhythmDBPropType.ALBUM,
+                 RB.RhythmDBPropType.GENRE, RB.RhythmDBPropType.TITLE)
+ENTRY_PROPS = OrderedDict((
+    ('title', ('get_string', RB.RhythmDBPropType.TITLE)),
+    ('artist', ('get_string', RB.RhythmDBPropType.ARTIST)),
+    ('album', ('get_string', RB.RhythmDBPropType.ALBUM)),
+    ('track_number', ('get_ulong', RB.RhythmDBPropType.TRACK_NUMBER)),
+    ('duration', ('get_ulong', RB.RhythmDBPropType.DURATION)),
+    ('rating', ('get_double', RB.RhythmDBPropType.RATING)),
+    ('genre', ('get_string', RB.RhythmDBPropType.GENRE)),
+    ('play_count', ('get_ulong', RB.RhythmDBPropType.PLAY_COUNT)),
+    ('location', ('get_string', RB.RhythmDBPropType.LOCATION)),
+    ('year', ('get_ulong', RB.RhythmDBPropType.YEAR)),
+    ('bitrate', ('get_ulong', RB.RhythmDBPropType.BITRATE)),
+    ('last_played', ('get_ulong', RB.RhythmDBPropType.LAST_PLAYED))))
+LIBRARY_CHECK_SECONDS = 600
+LIBRARY_CHECK_SAMPLE = 20
+LIBRARY_SLICE = 500
+LIBRARY_TABLES = ('artists', 'albums', 'genres', 'songs')
+SORT_COUNT = 'count'
+SUGGEST_LIMIT = 10
+SUGGEST_CACHE_SIZE = 256
+SORT_NAME = 'name'
+SORT_RELEVANCE = 'relevance'
+RATING_BOOST = 0.5
+PLAY_COUNT_BOOST = 0.1
+CURSOR_NEW = 'new'
+CURSOR_CACHE_SIZE = 32
+CURSOR_TTL_SECONDS = 300
+QUERY_CACHE_SIZE = 64
+QUERY_CACHE_MAX_ENTRIES = 5000
+QUERY_TEXT_FILTERS = ('all', 'artist', 'album', 'title', 'genre')
+
 
 class RBHandler(object):
     """
@@ -80,10 +128,109 @@ class RBHandler(object):
             self.entry_types[entry_type] = rb_type
         self.entry_types['radio'] = self.entry_types[TYPE_RADIO]
 
+        self.state_version = 1
+        self.state_listeners = []
+        self._snapshot = None
+        self._elapsed = 0
+        self._elapsed_at = time.time()
+        self._playing = False
+        for signal in PLAYER_SIGNALS:
+            self.player.connect(signal, self.player_changed)
+        self.player.connect('playing-changed', self.playing_changed)
+        self.player.connect('elapsed-changed', self.elapsed_changed)
+        queue_model = shell.props.queue_source.props.query_model
+        for signal in QUEUE_SIGNALS:
+            queue_model.connect(signal, self.queue_changed)
+        self.db.connect('entry-changed', self.playing_entry_changed)
+
         self._library = Library()
+        self.db.connect('entry-changed', self.library.entry_changed)
+        self.db.connect('entry-deleted', self.library.entry_deleted)
         self.db.connect('entry_added', self.library.entry_added)
+        self.library.rebuild(self.db)
+        GLib.timeout_add_seconds(LIBRARY_CHECK_SECONDS, self.check_library)
+        self.cursors = Cursors()
+        self.query_cache = QueryCache()
         log.debug('rb handler loaded')
 
+    # STATE
+    def add_state_listener(self, listener):
+        """Registers a function called with (what, version) on every state change"""
+        self.state_listeners.append(listener)
+
+    def remove_state_listener(self, listener):
+        if listener in self.state_listeners:
+            self.state_listeners.remove(listener)
+
+    def state_changed(self, what):
+        if what == STATE_PLAYER:
+            self._snapshot = None
+        self.state_version += 1
+        log.debug('State changed: {} version {}'.format(what, self.state_version))
+        for listener in list(self.state_listeners):
+            listener(what, self.state_version)
+
+    def player_changed(self, *args):
+        self.state_changed(STATE_PLAYER)
+
+    def queue_changed(self, *args):
+        self.state_changed(STATE_QUEUE)
+
+    def playing_entry_changed(self, db, entry, *args):
+        if not self._snapshot or not self._snapshot['playing_entry']:
+            return
+        if entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID) == self._snapshot['playing_entry'].id:
+            self.state_changed(STATE_PLAYER)
+
+    def get_snapshot(self):
+        """
+        The player status, it is only read from the player again after the
+        signals report a change
+        """
+        if self._snapshot is None:
+            playing = self.get_playing_status()
+            self._snapshot = {
+                'playing' : playing,
+                'playing_entry' : self.get_playing_entry() if playing else None,
+                'playing_order' : self.get_play_order(),
+                'muted' : self.get_mute(),
+                'volume' : self.get_volume(),
+                }
+            self._playing = playing
+            if playing:
+                self._elapsed = self.get_playing_time()
+                self._elapsed_at = time.time()
+        return self._snapshot
+
+    def get_elapsed(self):
+        """Playing time derived from the last known position"""
+        return int(self.expected_elapsed(time.time()))
+
+    def expected_elapsed(self, now):
+        if self._playing:
+            return self._elapsed + now - self._elapsed_at
+        return self._elapsed
+
+    def playing_changed(self, player, playing):
+        """
+        Pausing keeps the position, extrapolation restarts when resumed
+        """
+        now = time.time()
+        self._elapsed, self._elapsed_at = self.expected_elapsed(now), now
+        self._playing = playing
+        self.state_changed(STATE_PLAYER)
+
+    def elapsed_changed(self, player, elapsed):
+        """
+        Elapsed time ticks every second while playing, it only counts as a
+        state change when it drifts from the expected value (seeks)
+        """
+        now = time.time()
+        expected = self.expected_elapsed(now)
+        self._elapsed, self._elapsed_at = elapsed, now
+        if abs(elapsed - expected) > ELAPSED_DRIFT:
+            self.state_changed(STATE_PLAYER)
+
     def get_playing_status(self):
         log.debug('get playing status')
         return self.player.get_playing()[1]
@@ -264,11 +411,117 @@ class RBHandler(object):
             query.add_rating(rating)
             query.add_play_count(play_count)
 
+        text = filters.get('all', None)
+        fuzzy = filters.get('fuzzy', None) not in (None, '', '0')
+        sort = filters.get('sort', None)
+        relevance = sort == SORT_RELEVANCE
+        if sort and not relevance:
+            raise InvalidQueryException('Unknown sort {}'.format(sort))
+
+        key = query_key(filters, rating, play_count, first, limit, fuzzy, sort)
+        generation = self.library.generation
+        entry_ids = self.query_cache.get(key, generation)
+        if entry_ids is not None:
+            log.debug('Query cache hit, {} hits and {} misses'.format(
+                self.query_cache.hits, self.query_cache.misses))
+            return self.read_entries(entry_ids)
+
+        if (fuzzy or relevance) and not text:
+            text = ' '.join(filters[name] for name in ('artist', 'album', 'title', 'genre')
+                if filters.get(name, None))
+        if text and 'exact-match' not in filters:
+            if self.library.progress() is None:
+                if relevance:
+                    entries = self.query_relevance(text, media_type, rating, play_count, first, limit, fuzzy)
+                else:
+                    entries = self.query_index(text, media_type, rating, play_count, first, limit, fuzzy)
+                return self.query_cache.record(key, generation, entries)
+            log.info('Library still indexing, searching the db')
+
         query_model = query.execute(self.db)
-        log.debug('RBHandler.query executed, loading results...')
-        entries = [entry for entry in read_model(query_model, first, limit)]
-        log.debug('RBHandler.query executed, returning results...')
-        return entries
+        log.debug('RBHandler.query executed, results are read as they are sent')
+        return self.query_cache.record(key, generation, read_model(query_model, first, limit))
+
+    def read_entries(self, entry_ids):
+        for entry_id in entry_ids:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                yield RBEntry(entry)
+
+    def query_cursor(self, filters):
+        """
+        Reads a page of a search through a cursor, cursor=new runs the
+        search and opens one, any other cursor resumes from where the last
+        page stopped. Returns the page entries and the cursor id, None once
+        the search is exhausted.
+        """
+        filters = dict(filters)
+        cursor_id = filters.pop('cursor')
+        limit = to_int(filters.pop('limit', 0), 'Parameter limit must be a number')
+        if cursor_id == CURSOR_NEW:
+            cursor_id = self.cursors.open(iter(self.query(filters)), self.library.generation)
+        return self.cursors.read(cursor_id, limit, self.library.generation)
+
+    def query_index(self, text, media_type, rating=0, play_count=0, first=0, limit=0, fuzzy=False):
+        """
+        Answers a search for all fields from the library token index, the
+        entries are only looked up to check the type, rating and play count.
+        A fuzzy search tolerates typos and returns the closest matches first.
+        """
+        log.debug('Searching the index for "{}"'.format(text))
+        if fuzzy:
+            entry_ids = self.library.index.fuzzy_search(text)
+        else:
+            entry_ids = self.library.index.search(text)
+        def entries():
+            skipped, found = 0, 0
+            for entry_id, entry in self.lookup_entries(entry_ids, media_type, rating, play_count):
+                if skipped < first:
+                    skipped += 1
+                    continue
+                yield RBEntry(entry)
+                found += 1
+                if limit and found >= limit:
+                    return
+        return entries()
+
+    def query_relevance(self, text, media_type, rating=0, play_count=0, first=0, limit=0, fuzzy=False):
+        """
+        Answers a search from the library index best match first, the text
+        scores are boosted by the entry rating and play count and only the
+        first + limit best entries are selected
+        """
+        log.debug('Ranking the index matches for "{}"'.format(text))
+        index = self.library.index
+        entry_ids = index.fuzzy_search(text) if fuzzy else index.search(text)
+        scores = index.relevance(text, entry_ids, fuzzy)
+        def scored():
+            for entry_id, entry in self.lookup_entries(entry_ids, media_type, rating, play_count):
+                score = scores[entry_id]
+                score *= 1 + RATING_BOOST * entry.get_double(RB.RhythmDBPropType.RATING) / 5
+                score *= 1 + PLAY_COUNT_BOOST * math.log1p(entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT))
+                yield score, entry
+        if limit:
+            ranked = heapq.nlargest(first + limit, scored(), key=lambda item: item[0])
+        else:
+            ranked = sorted(scored(), key=lambda item: item[0], reverse=True)
+        return iter([RBEntry(entry) for score, entry in ranked[first:]])
+
+    def lookup_entries(self, entry_ids, media_type, rating=0, play_count=0):
+        """The ids and db entries of entry_ids of media_type over rating and play count"""
+        for entry_id in entry_ids:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is None or entry.get_entry_type() != media_type:
+                continue
+            if rating and not entry.get_double(RB.RhythmDBPropType.RATING) > rating:
+                continue
+            if play_count and not entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT) > play_count:
+                continue
+            yield entry_id, entry
+
+    def check_library(self):
+        self.library.check(self.db)
+        return True
 
     # SOURCE
     def play_source(self, source):
@@ -290,7 +543,7 @@ class RBHandler(object):
     def load_source_entries(self, source, limit=100):
         if source is None:
             return
-        source.entries = [entry for entry in read_model(source.query_model, limit=limit)]
+        source.entries = read_model(source.query_model, limit=limit)
 
     def get_playlists(self):
         """Returns all registered playlists"""
@@ -333,59 +586,400 @@ class Queue(object):
         log.debug('get play queue model')
         return self.queue_source.props.query_model
 
+    def get_queue_entries(self):
+        """The db entries of the whole play queue, in order"""
+        return [row[0] for row in self.get_play_queue_model()]
+
     def clear_play_queue(self):
         log.debug("Cleaning playing queue")
-        for entry in read_model(self.get_play_queue_model()):
-            self.dequeue(entry)
+        for entry in self.get_queue_entries():
+            self.queue_source.remove_entry(entry)
+        self.queue_source.queue_draw()
         log.debug("Playing queue cleared")
 
     def shuffle_queue(self):
-        entries = self.get_play_queue()
-        if entries:
-            random.shuffle(entries)
-            for i in range(0, len(entries)):
-                entry = self.db.entry_lookup_by_id(entries[i].id)
-                self.queue_source.move_entry(entry, i)
+        entries = self.get_queue_entries()
+        order = list(range(len(entries)))
+        random.shuffle(order)
+        self.move_entries(entries, [entries[index] for index in order])
+        self.queue_source.queue_draw()
 
     def enqueue(self, entry_ids):
         log.debug("Enqueuing {}".format(entry_ids))
-        for entry_id in to_list(entry_ids):
-            entry = self.db.entry_lookup_by_id(int(entry_id))
-            if entry is None:
-                continue
-            self.queue_source.add_entry(entry, -1)
-        self.queue_source.queue_draw()
+        self.update_queue(add=to_list(entry_ids))
 
     def dequeue(self, entry_ids):
         log.debug("Dequeuing {}".format(entry_ids))
-        for entry_id in to_list(entry_ids):
-            entry = self.db.entry_lookup_by_id(int(entry_id))
-            if entry is None:
+        self.update_queue(remove=to_list(entry_ids))
+
+    def lookup(self, entry_ids):
+        """The db entries of the ids by id, each looked up once, unknown ids are left out"""
+        entries = {}
+        for entry_id in entry_ids:
+            entry_id = int(entry_id)
+            if entry_id in entries:
                 continue
-            self.queue_source.remove_entry(entry)
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                entries[entry_id] = entry
+        return entries
+
+    def update_queue(self, add=(), remove=(), move=(), replace=None):
+        """
+        Applies a set of changes to the play queue: it is replaced by the
+        replace ids first, then the remove ids are removed, the add ids are
+        added at the end and the (id, position) moves are applied in order.
+        Every id is looked up once and the queue is redrawn once.
+        """
+        add = list(OrderedDict.fromkeys(int(entry_id) for entry_id in add))
+        remove = list(OrderedDict.fromkeys(int(entry_id) for entry_id in remove))
+        move = [(int(entry_id), int(position)) for entry_id, position in move]
+        entries = self.lookup(add + remove + [entry_id for entry_id, position in move]
+            + [int(entry_id) for entry_id in replace or ()])
+        if replace is not None:
+            for entry in self.get_queue_entries():
+                self.queue_source.remove_entry(entry)
+            add = list(OrderedDict.fromkeys([int(entry_id) for entry_id in replace] + add))
+        for entry_id in remove:
+            if entry_id in entries:
+                self.queue_source.remove_entry(entries[entry_id])
+        for entry_id in add:
+            if entry_id in entries:
+                self.queue_source.add_entry(entries[entry_id], -1)
+        if move:
+            queued = self.get_queue_entries()
+            self.move_entries(queued, moved(queued, move))
         self.queue_source.queue_draw()
 
+    def reorder_queue(self, entry_ids):
+        """
+        Puts the given entries first in the queue in the given order, the
+        rest of the queue keeps its order after them
+        """
+        log.debug("Reordering queue {}".format(entry_ids))
+        order = [int(entry_id) for entry_id in entry_ids]
+        entries = self.get_queue_entries()
+        by_id = dict((entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), entry) for entry in entries)
+        first = [by_id[entry_id] for entry_id in order if entry_id in by_id]
+        rest = [entry for entry in entries if entry not in first]
+        self.move_entries(entries, first + rest)
+        self.queue_source.queue_draw()
+
+    def move_entries(self, entries, order):
+        """Moves the queued entries into the new order, only those out of place"""
+        current = list(entries)
+        for index, entry in enumerate(order):
+            if current[index] is entry:
+                continue
+            self.queue_source.move_entry(entry, index)
+            current.remove(entry)
+            current.insert(index, entry)
+
+
+def moved(entries, moves):
+    """The entries after moving the (id, position) moves in order"""
+    order = list(entries)
+    for entry_id, position in moves:
+        for entry in order:
+            if entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID) == entry_id:
+                order.remove(entry)
+                order.insert(max(0, min(position, len(order))), entry)
+                break
+    return order
+
 
 class Library(object):
+    """
+    Play counts of every artist, album, genre and song title. It is kept
+    up to date from the db signals, every entry remembers what it added so
+    a change or a deletion only applies its difference.
+    The signals only queue the entry, bursts (a library load or an import)
+    are coalesced by entry and indexed in idle slices of LIBRARY_SLICE
+    entries so the main loop is never blocked.
+    """
 
     def __init__(self):
+        self.pending = OrderedDict()
+        self.queued = 0
+        self.generation = 0
+        self._drain_id = None
+        self.reset()
+
+    def reset(self):
         self.artists = {'values': defaultdict(lambda: 0), 'max': 0}
         self.albums = {'values': defaultdict(lambda: 0), 'max': 0}
         self.genres = {'values': defaultdict(lambda: 0), 'max': 0}
         self.songs = {'values': defaultdict(lambda: 0), 'max': 0}
+        self.tables = (self.artists, self.albums, self.genres, self.songs)
+        self.sizes = tuple(defaultdict(lambda: 0) for table in self.tables)
+        self.names = tuple([] for table in self.tables)
+        self.by_count = [None] * len(self.tables)
+        self.suggestions = tuple(OrderedDict() for table in self.tables)
+        self.entries = {}
+        self.index = SearchIndex()
+
+    def read(self, rb_entry):
+        names = tuple(rb_entry.get_string(prop) or EMPTY_NAME for prop in LIBRARY_PROPS)
+        return names, rb_entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT)
 
     def entry_added(self, db, rb_entry):
-        entry = RBEntry(rb_entry)
-        self.append(self.artists, entry.artist, entry.play_count)
-        self.append(self.albums, entry.album, entry.play_count)
-        self.append(self.genres, entry.genre, entry.play_count)
-        self.append(self.songs, entry.title, entry.play_count)
+        self.queue(rb_entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), rb_entry)
+
+    def entry_changed(self, db, rb_entry, *args):
+        self.queue(rb_entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), rb_entry)
+
+    def entry_deleted(self, db, rb_entry):
+        self.queue(rb_entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), None)
+
+    def queue(self, entry_id, rb_entry):
+        """Queues the entry to index, None removes it"""
+        self.generation += 1
+        if entry_id not in self.pending:
+            self.queued += 1
+        self.pending[entry_id] = rb_entry
+        if self._drain_id is None:
+            self._drain_id = GLib.idle_add(self.drain)
+
+    def drain(self):
+        for _ in range(min(LIBRARY_SLICE, len(self.pending))):
+            entry_id, rb_entry = self.pending.popitem(last=False)
+            if rb_entry is None:
+                self.remove(entry_id)
+            else:
+                self.update(entry_id, rb_entry)
+        if self.pending:
+            return True
+        log.debug('Library indexed {} entries'.format(self.queued))
+        self._drain_id = None
+        self.queued = 0
+        return False
+
+    def progress(self):
+        """Percent of the queued entries already indexed, None when done"""
+        if not self.pending:
+            return None
+        return 100 * (self.queued - len(self.pending)) // self.queued
+
+    def update(self, entry_id, rb_entry):
+        names, play_count = self.read(rb_entry)
+        old = self.entries.get(entry_id, None)
+        self.entries[entry_id] = (names, play_count)
+        if old is None or old[0] != names:
+            self.index.update(entry_id, names,
+                rb_entry.get_ulong(RB.RhythmDBPropType.TRACK_NUMBER))
+        if old is None:
+            for index, name in enumerate(names):
+                self.append(index, name, play_count, 1)
+            return
+        old_names, old_count = old
+        for index, (old_name, name) in enumerate(zip(old_names, names)):
+            if old_name != name:
+                self.append(index, old_name, -old_count, -1)
+                self.append(index, name, play_count, 1)
+            elif old_count != play_count:
+                self.append(index, name, play_count - old_count, 0)
+
+    def remove(self, entry_id):
+        if entry_id not in self.entries:
+            return
+        names, play_count = self.entries.pop(entry_id)
+        self.index.remove(entry_id)
+        for index, name in enumerate(names):
+            self.append(index, name, -play_count, -1)
+
+    def append(self, index, name, play_count, entries):
+        """
+        Adds play_count to name, entries counts how many entries use the
+        name so it is dropped when the last one goes
+        """
+        values, sizes = self.tables[index], self.sizes[index]
+        self.by_count[index] = None
+        self.suggestions[index].clear()
+        sizes[name] += entries
+        if sizes[name] <= 0:
+            del sizes[name]
+            value = values['values'].pop(name, 0)
+            del self.names[index][bisect_left(self.names[index], (name.casefold(), name))]
+            if value and value >= values['max']:
+                values['max'] = max(values['values'].values(), default=0)
+            return
+        if sizes[name] == entries:
+            insort(self.names[index], (name.casefold(), name))
+        value = values['values'][name] = values['values'][name] + play_count
+        if value > values['max']:
+            values['max'] = value
+        elif play_count < 0 and value - play_count >= values['max']:
+            values['max'] = max(values['values'].values(), default=0)
+
+    def select(self, what, sort=SORT_COUNT, prefix=None, first=0, limit=0):
+        """
+        A page of the what table sorted by count or name, optionally only
+        the names starting with prefix (case insensitive). The names are
+        kept sorted, the count order is only sorted again after a change
+        and ties are sorted by name
+        """
+        index = LIBRARY_TABLES.index(what)
+        values = self.tables[index]['values']
+        if prefix:
+            names = self.names[index]
+            folded = prefix.casefold()
+            start = bisect_left(names, (folded,))
+            end = bisect_left(names, (folded + '\U0010ffff',))
+            selected = [name for _, name in names[start:end]]
+            if sort == SORT_COUNT:
+                selected.sort(key=lambda name: -values[name])
+        elif sort == SORT_NAME:
+            selected = [name for _, name in self.names[index]]
+        else:
+            if self.by_count[index] is None:
+                by_name = [name for _, name in self.names[index]]
+                self.by_count[index] = sorted(by_name, key=lambda name: -values[name])
+            selected = self.by_count[index]
+        page = selected[first:first + limit] if limit else selected[first:]
+        return {'values': dict((name, values[name]) for name in page),
+                'max': self.tables[index]['max'], 'total': len(selected)}
+
+    def suggest(self, what, prefix, limit=SUGGEST_LIMIT):
+        """
+        The limit names of the what table starting with prefix (case
+        insensitive) with the most plays, as (name, play count). The sorted
+        names give the prefix range, the answers are cached until the table
+        changes so typing on many clients only pays the first lookup.
+        """
+        index = LIBRARY_TABLES.index(what)
+        cache = self.suggestions[index]
+        key = (prefix.casefold(), limit)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        names, values = self.names[index], self.tables[index]['values']
+        start = bisect_left(names, key[:1])
+        end = bisect_left(names, (key[0] + '\U0010ffff',))
+        best = heapq.nlargest(limit, names[start:end], key=lambda name: values[name[1]])
+        cache[key] = [(name, values[name]) for _, name in best]
+        if len(cache) > SUGGEST_CACHE_SIZE:
+            cache.popitem(last=False)
+        return cache[key]
+
+    def check(self, db):
+        """
+        Cheap consistency check against the db: the entry count has to
+        match, otherwise the library is built again, and a random sample of
+        entries is read again to fix any difference
+        """
+        if self.pending:
+            return
+        if db.entry_count() != len(self.entries):
+            log.warning('Library has {} entries but the db {}, rebuilding'.format(
+                len(self.entries), db.entry_count()))
+            self.rebuild(db)
+            return
+        sample = random.sample(list(self.entries), min(LIBRARY_CHECK_SAMPLE, len(self.entries)))
+        for entry_id in sample:
+            entry = db.entry_lookup_by_id(entry_id)
+            if entry is None:
+                self.remove(entry_id)
+            else:
+                self.update(entry_id, entry)
+
+    def rebuild(self, db):
+        """Indexes every db entry again, in idle slices like the signals"""
+        self.reset()
+        self.pending.clear()
+        self.queued = 0
+        db.entry_foreach(lambda entry, data: self.entry_added(db, entry), None)
+
+
+class Cursors(object):
+    """
+    Open searches resumed page by page, a cursor keeps the lazy entries of
+    its search so a page only reads its own rows. Cursors are evicted when
+    more than CURSOR_CACHE_SIZE are open, after CURSOR_TTL_SECONDS unused
+    and whenever the db changes.
+    """
+
+    def __init__(self, size=CURSOR_CACHE_SIZE, ttl=CURSOR_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self.cursors = OrderedDict()
+
+    def open(self, entries, generation):
+        """Keeps the entries iterator, returns the new cursor id"""
+        self.expire()
+        cursor_id = '{:016x}'.format(random.getrandbits(64))
+        self.cursors[cursor_id] = (entries, generation, time.time())
+        while len(self.cursors) > self.size:
+            self.cursors.popitem(last=False)
+        return cursor_id
+
+    def read(self, cursor_id, limit, generation):
+        """
+        The next limit entries of the cursor, all of them when there is no
+        limit, and the cursor id to go on or None when there are no more
+        """
+        self.expire()
+        if cursor_id not in self.cursors:
+            raise InvalidQueryException('Unknown or expired cursor {}'.format(cursor_id))
+        entries, opened, used = self.cursors.pop(cursor_id)
+        if opened != generation:
+            raise InvalidQueryException('The library changed, cursor {} expired'.format(cursor_id))
+        page = list(itertools.islice(entries, limit or None))
+        if not limit or len(page) < limit:
+            return page, None
+        self.cursors[cursor_id] = (entries, generation, time.time())
+        return page, cursor_id
+
+    def expire(self):
+        oldest = time.time() - self.ttl
+        for cursor_id, (entries, generation, used) in list(self.cursors.items()):
+            if used >= oldest:
+                break
+            del self.cursors[cursor_id]
+
+
+class QueryCache(object):
+    """
+    Entry ids of the last searches by their normalized filters, the least
+    recently used are evicted past QUERY_CACHE_SIZE searches and all of
+    them are dropped when the library generation changes.
+    """
 
-    def append(self, values, name, play_count):
-        if not name: name = '[empty]'
-        values['values'][name] += play_count
-        if values['max'] < values['values'][name]:
-            values['max'] = values['values'][name]
+    def __init__(self, size=QUERY_CACHE_SIZE, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.size = size
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        """The cached entry ids for key, None when they are not cached"""
+        if generation != self.generation:
+            self.results.clear()
+            self.generation = generation
+        entry_ids = self.results.get(key, None)
+        if entry_ids is None:
+            self.misses += 1
+            return None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return entry_ids
+
+    def record(self, key, generation, entries):
+        """
+        Yields the entries as they are read, their ids are cached once all
+        of them are read, unless there are more than max_entries
+        """
+        entry_ids = []
+        for entry in entries:
+            if len(entry_ids) <= self.max_entries:
+                entry_ids.append(entry.id)
+            yield entry
+        if len(entry_ids) > self.max_entries or generation != self.generation:
+            return
+        self.results[key] = entry_ids
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
 
 
 class Query(object):
@@ -488,21 +1082,24 @@ class InvalidQueryException(Exception):
 
 
 class RBEntry(object):
+    """
+    A db entry, its properties are only read from the db the first time
+    they are used so an entry sent with a few fields only reads those
+    """
+
+    __slots__ = ('entry', 'id') + tuple(ENTRY_PROPS)
 
     def __init__(self, entry):
+        self.entry = entry
         self.id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
-        self.title = entry.get_string(RB.RhythmDBPropType.TITLE) # self.get_value(entry, RB.RhythmDBPropType.TITLE)
-        self.artist = entry.get_string(RB.RhythmDBPropType.ARTIST) # self.get_value(entry, RB.RhythmDBPropType.ARTIST)
-        self.album = entry.get_string(RB.RhythmDBPropType.ALBUM)
-        self.track_number = entry.get_ulong(RB.RhythmDBPropType.TRACK_NUMBER)
-        self.duration = entry.get_ulong(RB.RhythmDBPropType.DURATION)
-        self.rating = entry.get_double(RB.RhythmDBPropType.RATING)
-        self.genre = entry.get_string(RB.RhythmDBPropType.GENRE)
-        self.play_count = entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT)
-        self.location = entry.get_string(RB.RhythmDBPropType.LOCATION)
-        self.year = entry.get_ulong(RB.RhythmDBPropType.YEAR)
-        self.bitrate = entry.get_ulong(RB.RhythmDBPropType.BITRATE)
-        self.last_played = entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED)
+
+    def __getattr__(self, name):
+        if name not in ENTRY_PROPS:
+            raise AttributeError(name)
+        getter, prop = ENTRY_PROPS[name]
+        value = getattr(self.entry, getter)(prop)
+        setattr(self, name, value)
+        return value
 
     def __int__(self):
         return self.id
@@ -522,6 +1119,20 @@ class RBSource(object):
         return self.id
 
 
+def query_key(filters, rating, play_count, first, limit, fuzzy, sort):
+    """
+    The canonical form of a search: texts without repeated blanks, case
+    folded unless they have to match exactly, and the parsed numbers
+    """
+    exact = 'exact-match' in filters
+    texts = []
+    for name in QUERY_TEXT_FILTERS:
+        text = ' '.join((filters.get(name, None) or '').split())
+        texts.append(text if exact else text.casefold())
+    return (filters.get('type', None) or TYPE_SONG, exact, fuzzy, sort,
+        rating, play_count, first, limit) + tuple(texts)
+
+
 def read_model(model, first=0, limit=0):
     if model is None:
         raise ValueError('A model to read is required')
@@ -1,14 +1,31 @@
 import os
 import re
 import cgi
+import sys
 import json
+import time
+import zlib
+import base64
+import socket
+import struct
+import hashlib
+
+from io import BytesIO
+from email.utils import formatdate
+from types import GeneratorType
+from urllib.parse import unquote, parse_qs
 
 from gi.repository import GObject
-from wsgiref.simple_server import WSGIRequestHandler
-from wsgiref.simple_server import make_server
 
 from rhythmweb.app import app
+from rhythmweb.controller import EventStream, StatusWatch, status_changes
 from rhythmweb.conf import Configuration
+from rhythmweb.utils import parse_accept, as_parameters
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 import logging
 log = logging.getLogger(__name__)
@@ -35,11 +52,58 @@ CONTENT_TYPES = {
     'js': 'application/x-javascript',
 }
 
+READ_SIZE = 64 * 1024
+WRITE_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+MAX_PIPELINE_SIZE = MAX_HEADER_SIZE + MAX_BODY_SIZE
+
+STREAM_THRESHOLD = 200
+STREAM_SLICE = 50
+STREAM_CHUNK_SIZE = 16 * 1024
+
+JSON_TYPE = 'application/json'
+CBOR_TYPE = 'application/cbor'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+CBOR_INDEFINITE_ARRAY = b'\x9f'
+CBOR_BREAK = b'\xff'
+CBOR_FALSE = b'\xf4'
+CBOR_TRUE = b'\xf5'
+CBOR_NULL = b'\xf6'
+CBOR_DOUBLE = b'\xfb'
+CBOR_POSITIVE_BIGNUM = 2
+CBOR_NEGATIVE_BIGNUM = 3
+
+EVENTS_RETRY = 3000
+
+WEBSOCKET_PATH = '/rest/ws'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_COMMANDS = '/rest/player'
+WEBSOCKET_EVENTS = '/rest/events'
+MAX_MESSAGE_SIZE = 64 * 1024
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED = 1003
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
 class Server(object):
 
     def __init__(self):
         self.config = Configuration()
-        self.cgi_server = None
+        app.check_mtime = self.config.get_boolean('debug')
+        self.max_subscribers = self.config.get_int('events.subscribers')
+        self.socket = None
+        self.connections = set()
         self.is_running = False
         self._watch_id = None
 
@@ -47,33 +111,49 @@ class Server(object):
         log.info('   STARTING SERVER')
         hostname = self.config.get_string('hostname')
         port = self.config.get_int('port')
-        self.cgi_server = make_server(
-            hostname,
-            port,
-            self.handle_request,
-            handler_class=WSGIRequestHandler)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((hostname, port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.server_name = hostname
+        self.server_port = str(port)
+        self.keepalive_timeout = self.config.get_int('keepalive.timeout')
+        self.keepalive_requests = self.config.get_int('keepalive.requests')
         self._watch_id = GObject.io_add_watch(
-            self.cgi_server.socket,
+            self.socket,
             GObject.IO_IN,
-            self.io_watch_handle_request)
+            self.io_watch_accept)
         self.is_running = True
-        log.info('   CGI SERVER STARTED')
+        log.info('   HTTP SERVER STARTED')
 
     def stop(self):
-        if self.cgi_server:
-            log.info('   STOPPING CGI SERVER')
+        if self.socket:
+            log.info('   STOPPING HTTP SERVER')
             GObject.source_remove(self._watch_id)
-            self.cgi_server.server_close()
-        self.cgi_server = None
+            for connection in list(self.connections):
+                connection.close()
+            self.socket.close()
+        self.socket = None
         self.is_running = False
         log.info('   SERVER STOPPED')
 
-    def io_watch_handle_request(self, source, cb_condition):
-        log.debug('Handling request')
+    def io_watch_accept(self, source, cb_condition):
         if not self.is_running:
             log.fatal('NOT RUNNING')
             return False
-        self.cgi_server.handle_request()
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except BlockingIOError:
+                break
+            except OSError:
+                log.error('Error accepting connection', exc_info=True)
+                break
+            log.debug('Accepted connection from {}'.format(address))
+            connection = Connection(self, client, address)
+            self.connections.add(connection)
+            connection.open()
         return True
 
     def handle_request(self, environ, response):
@@ -83,14 +163,17 @@ class Server(object):
             path = '/index.html'
         agent = environ.get('HTTP_USER_AGENT', '')
         group = 'mobile' if match_mobile.match(agent) else 'default'
-        response = Response(response)
+        response = Response(response, environ)
         log.debug('Handling request {} {} for agent {} ({})'.format(method, path, agent, group))
         try:
             if method == 'GET':
                 content = app.get_file(path, group)
                 if content:
+                    if content.is_not_modified(environ):
+                        return response.reply_with_not_modified(content)
                     return response.reply_with_file(path, content)
-                content = app.route(path)
+                query = app.query_parameters(path, self.parse_query_parameters(environ))
+                content = app.route(path, **query)
 
             if method == 'POST':
                 post = self.parse_post_parameters(environ)
@@ -98,6 +181,12 @@ class Server(object):
 
             if content is None:
                 return response.reply_with_not_found()
+            if isinstance(content, StatusWatch):
+                return response.reply_with_long_poll(content)
+            if isinstance(content, EventStream):
+                if not self.accepts_subscriber(content):
+                    return response.reply_with_unavailable()
+                return response.reply_with_events(content)
             return response.reply_with_json(content)
 
         except ValueError as e:
@@ -109,6 +198,20 @@ class Server(object):
         except ServerError as e:
             return response.reply_with_server_error(e)
 
+    def accepts_subscriber(self, stream):
+        if len(stream.events.subscribers) <= self.max_subscribers:
+            return True
+        log.info('Too many event subscribers, refusing a new one')
+        stream.close()
+        return False
+
+    def parse_query_parameters(self, environ):
+        parsed = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+        query = {}
+        for key, values in parsed.items():
+            query[key] = values[0] if len(values) == 1 else values
+        return query
+
     def parse_post_parameters(self, environ):
         parsed = cgi.FieldStorage(
             fp=environ['wsgi.input'],
@@ -121,17 +224,506 @@ class Server(object):
         return post
 
 
+class Connection(object):
+    """
+    A client connection driven by GLib IO watches, the socket is read and
+    written incrementally so a slow client never blocks the main loop.
+    Connections are kept alive between requests and pipelined requests are
+    answered in order, one at a time.
+    A response body that yields an empty chunk is suspended until it calls
+    the environ rhythmweb.resume function, so long lived streams do not
+    keep the write watch spinning.
+    A websocket handshake upgrades the connection, from then on the input
+    and output are websocket frames handled by a WebSocket.
+    """
+
+    def __init__(self, server, client, address):
+        self.server = server
+        self.socket = client
+        self.address = address
+        self.input = bytearray()
+        self.output = bytearray()
+        self.requests = 0
+        self.eof = False
+        self.closed = False
+        self.last_activity = time.time()
+        self.reset()
+        self.websocket = None
+        self._read_id = None
+        self._write_id = None
+        self._timeout_id = None
+
+    def reset(self):
+        self.environ = None
+        self.result = None
+        self.body = None
+        self.status = None
+        self.headers = None
+        self.headers_sent = False
+        self.keep_alive = False
+        self.chunked = False
+        self.no_body = False
+        self.suspended = False
+
+    @property
+    def busy(self):
+        return self.environ is not None
+
+    def open(self):
+        self.socket.setblocking(False)
+        self.start_reading()
+        self._timeout_id = GObject.timeout_add_seconds(
+            self.server.keepalive_timeout,
+            self.timeout_watch_idle)
+
+    def close(self):
+        if self.closed:
+            return
+        log.debug('Closing connection from {} after {} requests'.format(
+            self.address, self.requests))
+        self.closed = True
+        self.stop_reading()
+        self.stop_writing()
+        if self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self.close_body()
+        if self.websocket is not None:
+            self.websocket.stream.close()
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.server.connections.discard(self)
+
+    def start_reading(self):
+        if self._read_id is None and not self.eof:
+            self._read_id = GObject.io_add_watch(
+                self.socket,
+                GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                self.io_watch_read)
+
+    def stop_reading(self):
+        if self._read_id is not None:
+            GObject.source_remove(self._read_id)
+            self._read_id = None
+
+    def start_writing(self):
+        if self._write_id is None:
+            self._write_id = GObject.io_add_watch(
+                self.socket,
+                GObject.IO_OUT | GObject.IO_HUP | GObject.IO_ERR,
+                self.io_watch_write)
+
+    def stop_writing(self):
+        if self._write_id is not None:
+            GObject.source_remove(self._write_id)
+            self._write_id = None
+
+    def timeout_watch_idle(self):
+        if self.closed:
+            return False
+        idle = time.time() - self.last_activity
+        if idle >= self.server.keepalive_timeout and (self.output or not self.busy):
+            log.debug('Connection from {} idle for {:.0f}s'.format(self.address, idle))
+            self._timeout_id = None
+            self.close()
+            return False
+        return True
+
+    def io_watch_read(self, source, cb_condition):
+        if self.closed:
+            return False
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            log.debug('Error reading from {}'.format(self.address), exc_info=True)
+            data = None
+        if data:
+            self.last_activity = time.time()
+            self.input.extend(data)
+        else:
+            self.eof = True
+        if self.eof and (self.suspended or self.websocket is not None):
+            self._read_id = None
+            self.close()
+            return False
+        if self.websocket is not None:
+            self.websocket.process_input()
+        elif not self.busy:
+            self.process_input()
+        if self.closed:
+            return False
+        if self.eof or len(self.input) > MAX_PIPELINE_SIZE:
+            self._read_id = None
+            return False
+        return True
+
+    def process_input(self):
+        try:
+            environ = self.parse_request()
+        except HttpError as e:
+            log.debug('Invalid request from {}: {}'.format(self.address, e.status))
+            self.eof = True
+            self.stop_reading()
+            self.reply_with_error(e)
+            return
+        if environ is not None:
+            self.dispatch(environ)
+        elif self.eof:
+            self.close()
+
+    def parse_request(self):
+        while self.input.startswith(b'\r\n'):
+            del self.input[:2]
+        end = self.input.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.input) > MAX_HEADER_SIZE:
+                raise HttpError('431 Request Header Fields Too Large')
+            return None
+        lines = bytes(self.input[:end]).decode('iso-8859-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HttpError('400 Bad Request')
+        if not version.startswith('HTTP/'):
+            raise HttpError('400 Bad Request')
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise HttpError('400 Bad Request')
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = '{},{}'.format(headers[name], value) if name in headers else value
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HttpError('411 Length Required')
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError('400 Bad Request')
+        if length < 0:
+            raise HttpError('400 Bad Request')
+        if length > MAX_BODY_SIZE:
+            raise HttpError('413 Payload Too Large')
+        size = end + 4 + length
+        if len(self.input) < size:
+            return None
+        body = bytes(self.input[end + 4:size])
+        del self.input[:size]
+        return self.build_environ(method, target, version, headers, body)
+
+    def build_environ(self, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method.upper(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': headers.pop('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': self.server.server_port,
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': self.address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'rhythmweb.resume': self.resume,
+        }
+        headers.pop('content-length', None)
+        for name, value in headers.items():
+            environ['HTTP_{}'.format(name.upper().replace('-', '_'))] = value
+        return environ
+
+    def wants_keep_alive(self, environ):
+        if self.requests + 1 >= self.server.keepalive_requests:
+            return False
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def dispatch(self, environ):
+        log.debug('Dispatching {} {} from {}'.format(
+            environ['REQUEST_METHOD'], environ['PATH_INFO'], self.address))
+        self.environ = environ
+        if is_websocket_request(environ):
+            self.upgrade(environ)
+            return
+        self.keep_alive = self.wants_keep_alive(environ)
+        try:
+            result = self.server.handle_request(environ, self.start_response)
+        except Exception as e:
+            self.status = None
+            result = Response(self.start_response).reply_with_server_error(e)
+        self.result = result
+        self.body = iter(result)
+        self.start_writing()
+
+    def upgrade(self, environ):
+        key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '')
+        if (environ['REQUEST_METHOD'] != 'GET' or not key
+                or environ.get('HTTP_SEC_WEBSOCKET_VERSION') != '13'):
+            self.fail_upgrade(HttpError('400 Bad Request'))
+            return
+        stream = app.route(WEBSOCKET_EVENTS)
+        if not self.server.accepts_subscriber(stream):
+            self.fail_upgrade(HttpError('503 Service Unavailable'))
+            return
+        log.debug('Upgrading connection from {} to websocket'.format(self.address))
+        accept = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+        self.output.extend('\r\n'.join([
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Accept: {}'.format(base64.b64encode(accept).decode('ascii')),
+            '\r\n']).encode('ascii'))
+        self.websocket = WebSocket(self, stream)
+        self.start_writing()
+        self.websocket.process_input()
+
+    def fail_upgrade(self, error):
+        log.debug('Refusing websocket from {}: {}'.format(self.address, error.status))
+        self.eof = True
+        self.stop_reading()
+        self.reply_with_error(error)
+
+    def reply_with_error(self, error):
+        self.environ = {'REQUEST_METHOD': 'GET', 'SERVER_PROTOCOL': 'HTTP/1.0'}
+        self.status = error.status
+        self.headers = [('Content-type', 'text/html; charset=UTF-8')]
+        self.result = []
+        self.body = iter(self.result)
+        self.start_writing()
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('Response already started')
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.send_headers()
+        if self.no_body:
+            return
+        if self.chunked:
+            self.output.extend(b'%x\r\n' % len(data))
+            self.output.extend(data)
+            self.output.extend(b'\r\n')
+        else:
+            self.output.extend(data)
+
+    def send_headers(self):
+        self.headers_sent = True
+        lines = ['HTTP/1.1 {}'.format(header_value(self.status))]
+        names = set()
+        for name, value in self.headers:
+            names.add(name.lower())
+            lines.append('{}: {}'.format(header_value(name), header_value(value)))
+        code = self.status[:3]
+        self.no_body = (code in ('204', '304') or code.startswith('1')
+                or self.environ['REQUEST_METHOD'] == 'HEAD')
+        if self.no_body or 'content-length' in names:
+            pass
+        elif isinstance(self.result, (list, tuple)):
+            length = sum(len(chunk) for chunk in self.result)
+            lines.append('Content-Length: {}'.format(length))
+        elif self.environ['SERVER_PROTOCOL'] != 'HTTP/1.0':
+            self.chunked = True
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            self.keep_alive = False
+        lines.append('Date: {}'.format(formatdate(usegmt=True)))
+        lines.append('Server: rhythmweb')
+        if self.keep_alive:
+            lines.append('Connection: keep-alive')
+            lines.append('Keep-Alive: timeout={}, max={}'.format(
+                self.server.keepalive_timeout,
+                self.server.keepalive_requests - self.requests - 1))
+        else:
+            lines.append('Connection: close')
+        lines.append('\r\n')
+        self.output.extend('\r\n'.join(lines).encode('iso-8859-1', 'replace'))
+
+    def io_watch_write(self, source, cb_condition):
+        if self.closed:
+            return False
+        try:
+            self.fill_output()
+        except Exception:
+            log.error('Error producing response for {}'.format(self.address), exc_info=True)
+            self._write_id = None
+            self.close()
+            return False
+        if self.output:
+            try:
+                sent = self.socket.send(self.output)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                log.debug('Error writing to {}'.format(self.address), exc_info=True)
+                self._write_id = None
+                self.close()
+                return False
+            del self.output[:sent]
+            self.last_activity = time.time()
+        if self.output or (self.body is not None and not self.suspended):
+            return True
+        self._write_id = None
+        if self.websocket is not None:
+            self.websocket.flushed()
+        elif self.body is None:
+            self.finish_response()
+        return False
+
+    def resume(self):
+        if self.suspended and not self.closed:
+            self.suspended = False
+            self.start_writing()
+
+    def fill_output(self):
+        while (self.body is not None and not self.suspended
+                and len(self.output) < WRITE_SIZE):
+            try:
+                data = next(self.body)
+            except StopIteration:
+                if not self.headers_sent:
+                    self.send_headers()
+                if self.chunked:
+                    self.output.extend(b'0\r\n\r\n')
+                self.close_body()
+                break
+            if data:
+                self.write(data)
+            elif not isinstance(self.result, (list, tuple)):
+                self.suspended = True
+
+    def finish_response(self):
+        self.requests += 1
+        keep_alive = self.keep_alive
+        self.reset()
+        if not keep_alive:
+            self.close()
+            return
+        self.process_input()
+        if not self.closed and len(self.input) <= MAX_PIPELINE_SIZE:
+            self.start_reading()
+
+    def close_body(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+        self.result = None
+        self.body = None
+
+
 class Response(object):
 
-    def __init__(self, function):
+    def __init__(self, function, environ=None):
         self.function = function
+        self.environ = environ or {}
 
     def reply_with_json(self, content):
-        log.debug('Returning json {}'.format(content))
+        """
+        Replies with the content as json, or as CBOR or MessagePack when the
+        Accept header prefers them
+        """
+        media_type = self.negotiate()
+        if media_type == CBOR_TYPE:
+            return self.reply_with_cbor(content)
+        if media_type in MSGPACK_TYPES:
+            return self.reply_with_msgpack(content, media_type)
+        if isinstance(content, bytes):
+            return self.reply_with_encoded_json(content)
+        if is_large(content):
+            return self.reply_with_json_stream(content)
+        log.debug('Returning json %s', content)
+        return self.reply_with_encoded_json(bytes(json.dumps(content), 'UTF-8'))
+
+    def reply_with_encoded_json(self, body):
         self.function('200 OK', [
             ('Content-type', 'application/json; charset=UTF-8'), 
-            ('Cache-Control: ', 'no-cache; must-revalidate')])
-        return [bytes(json.dumps(content), 'UTF-8')]
+            ('Cache-Control', 'no-cache')])
+        return [body]
+
+    def reply_with_json_stream(self, content):
+        accepted = parse_accept(self.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers = [('Content-type', 'application/json; charset=UTF-8'),
+            ('Cache-Control', 'no-cache'),
+            ('Vary', 'Accept-Encoding')]
+        compressor = None
+        if accepted.get('gzip', accepted.get('*', 0)) > 0:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            headers.append(('Content-Encoding', 'gzip'))
+        log.debug('Streaming json, compressed: %s', compressor is not None)
+        self.function('200 OK', headers)
+        return stream_json(content, compressor)
+
+    def negotiate(self):
+        """
+        The media type to reply with, a binary one only when it is asked for
+        by name with a higher quality than json
+        """
+        accepted = parse_accept(self.environ.get('HTTP_ACCEPT', ''))
+        best = JSON_TYPE
+        quality = accepted.get(JSON_TYPE, accepted.get('application/*', accepted.get('*/*', 0)))
+        offered = (CBOR_TYPE,) + (MSGPACK_TYPES if msgpack else ())
+        for media_type in offered:
+            if accepted.get(media_type, 0) > quality:
+                best, quality = media_type, accepted[media_type]
+        return best
+
+    def reply_with_cbor(self, content):
+        headers = [('Content-type', CBOR_TYPE),
+            ('Cache-Control', 'no-cache'),
+            ('Vary', 'Accept')]
+        if not is_large(content):
+            self.function('200 OK', headers)
+            return [b''.join(iter_cbor(content))]
+        accepted = parse_accept(self.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers[-1] = ('Vary', 'Accept, Accept-Encoding')
+        compressor = None
+        if accepted.get('gzip', accepted.get('*', 0)) > 0:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            headers.append(('Content-Encoding', 'gzip'))
+        log.debug('Streaming cbor, compressed: %s', compressor is not None)
+        self.function('200 OK', headers)
+        return stream_bytes(iter_cbor(content), compressor)
+
+    def reply_with_msgpack(self, content, media_type):
+        body = msgpack.packb(as_plain(content), use_bin_type=True)
+        self.function('200 OK', [
+            ('Content-type', media_type),
+            ('Cache-Control', 'no-cache'),
+            ('Vary', 'Accept')])
+        return [body]
+
+    def reply_with_events(self, stream):
+        log.debug('Returning event stream')
+        stream.wakeup = self.environ.get('rhythmweb.resume')
+        self.function('200 OK', [
+            ('Content-type', 'text/event-stream; charset=UTF-8'),
+            ('Cache-Control', 'no-cache')])
+        return EventBody(stream)
+
+    def reply_with_long_poll(self, watch):
+        log.debug('Parking status request since version {}'.format(watch.since))
+        watch.wakeup = self.environ.get('rhythmweb.resume')
+        return LongPollBody(self, watch)
 
     def reply_with_not_found(self):
         log.debug('Returning not found')
@@ -142,24 +734,518 @@ class Response(object):
     def reply_with_file(self, path, content):
         extension = path.split('.')[-1].lower()
         content_type = CONTENT_TYPES.get(extension, 'text/plain')
-        self.function('200 OK', [('Content-type', content_type),
-            ('Cache-Control: ', 'no-cache; must-revalidate')])
-        log.debug('Returning {} {}={}'.format(path, extension, content_type))
-        return content
+        encoding, body, etag = content.encode(self.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers = [('Content-type', content_type),
+            ('Cache-Control', 'no-cache'),
+            ('ETag', etag),
+            ('Last-Modified', content.last_modified),
+            ('Content-Length', str(len(body)))]
+        if content.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        self.function('200 OK', headers)
+        log.debug('Returning {} {}={} ({})'.format(path, extension, content_type, encoding))
+        return [body]
 
-    def reply_with_client_error(self, e):
-        log.debug('Returning bad request')
-        self.function('400 Bad Request: {}'.format(e), [
-            ('Content-type', 'text/html; charset=UTF-8')])
+    def reply_with_not_modified(self, content):
+        log.debug('Returning not modified {}'.format(content.path))
+        encoding, body, etag = content.encode(self.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        headers = [('Cache-Control', 'no-cache'),
+            ('ETag', etag),
+            ('Last-Modified', content.last_modified)]
+        if content.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        self.function('304 Not Modified', headers)
         return []
 
+    def reply_with_client_error(self, e):
+        log.debug('Returning bad request: {}'.format(e))
+        self.function('400 Bad Request', [
+            ('Content-type', 'text/plain; charset=UTF-8')])
+        return [bytes(str(e), 'UTF-8')]
+
     def reply_with_method_not_allowed(self, method):
         log.debug('Error while running method {}'.format(method), exc_info=True)
-        self.function('405 method {} not allowed'.format(method), [
+        self.function('405 Method Not Allowed', [
+            ('Content-type', 'text/html; charset=UTF-8')])
+        return []
+
+    def reply_with_unavailable(self):
+        log.debug('Returning service unavailable')
+        self.function('503 Service Unavailable', [
+            ('Content-type', 'text/html; charset=UTF-8'),
+            ('Retry-After', '30')])
+        return []
+
+    def reply_with_server_error(self, e):
+        log.error('Server error: {}'.format(e), exc_info=True)
+        self.function('500 Internal Server Error', [
             ('Content-type', 'text/html; charset=UTF-8')])
         return []
 
 
 
+def header_value(value):
+    """Drops line breaks so no value can end the status line or a header"""
+    return ' '.join(str(value).splitlines())
+
+
+def is_large(content, limit=STREAM_THRESHOLD):
+    """
+    Tells if the content holds more than limit items in its lists and
+    dicts, or anything only the incremental encoder handles (generators and
+    already encoded json bytes)
+    """
+    pending = [content]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (GeneratorType, bytes)):
+            return True
+        if isinstance(value, dict):
+            value = value.values()
+        elif not isinstance(value, (list, tuple)):
+            continue
+        limit -= len(value)
+        if limit < 0:
+            return True
+        pending.extend(v for v in value
+                if isinstance(v, (dict, list, tuple, bytes, GeneratorType)))
+    return False
+
+
+def is_flat(value):
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, (list, tuple)):
+        return True
+    return not any(isinstance(v, (dict, list, tuple, GeneratorType, bytes)) for v in value)
+
+
+def iter_json(content):
+    """
+    Encodes the content as json pieces, long lists are encoded a slice of
+    items at a time so the whole document is never held as one string.
+    Bytes are already encoded json and go through as they are
+    """
+    if isinstance(content, bytes):
+        yield content.decode('UTF-8')
+    elif isinstance(content, dict):
+        yield '{'
+        for index, (key, value) in enumerate(content.items()):
+            if index:
+                yield ', '
+            yield json.dumps(key) + ': '
+            yield from iter_json(value)
+        yield '}'
+    elif isinstance(content, (list, tuple, GeneratorType)):
+        yield '['
+        items = iter(content)
+        first = True
+        while True:
+            chunk = [item for _, item in zip(range(STREAM_SLICE), items)]
+            if not chunk:
+                break
+            if not first:
+                yield ', '
+            first = False
+            if all(isinstance(item, bytes) for item in chunk):
+                yield b', '.join(chunk).decode('UTF-8')
+                continue
+            if all(is_flat(item) for item in chunk):
+                yield json.dumps(chunk)[1:-1]
+                continue
+            for index, item in enumerate(chunk):
+                if index:
+                    yield ', '
+                yield from iter_json(item)
+        yield ']'
+    else:
+        yield json.dumps(content)
+
+
+def stream_json(content, compressor=None):
+    """Yields the json encoded content in chunks, compressed if required"""
+    pieces, size = [], 0
+    for piece in iter_json(content):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            data = ''.join(pieces).encode('UTF-8')
+            pieces, size = [], 0
+            if compressor:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield data
+    data = ''.join(pieces).encode('UTF-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def as_plain(content):
+    """
+    The content with its generators read into lists and its already
+    encoded json bytes decoded, for encoders that only take plain values
+    """
+    if isinstance(content, bytes):
+        return json.loads(content.decode('UTF-8'))
+    if isinstance(content, dict):
+        return dict((key, as_plain(value)) for key, value in content.items())
+    if isinstance(content, (list, tuple, GeneratorType)):
+        return [as_plain(item) for item in content]
+    return content
+
+
+def cbor_head(major, value):
+    """The CBOR initial byte of a major type and its argument"""
+    major <<= 5
+    if value < 24:
+        return struct.pack('>B', major | value)
+    if value < 0x100:
+        return struct.pack('>BB', major | 24, value)
+    if value < 0x10000:
+        return struct.pack('>BH', major | 25, value)
+    if value < 0x100000000:
+        return struct.pack('>BI', major | 26, value)
+    return struct.pack('>BQ', major | 27, value)
+
+
+def iter_cbor(content):
+    """
+    Encodes the content as CBOR (RFC 8949) pieces, generators become
+    indefinite length arrays so they are read as they are sent.
+    Bytes are already encoded json and are decoded to encode their values
+    """
+    if content is None:
+        yield CBOR_NULL
+    elif content is True:
+        yield CBOR_TRUE
+    elif content is False:
+        yield CBOR_FALSE
+    elif isinstance(content, int):
+        major, value = (0, content) if content >= 0 else (1, -1 - content)
+        if value < 0x10000000000000000:
+            yield cbor_head(major, value)
+        else:
+            data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+            yield cbor_head(6, CBOR_POSITIVE_BIGNUM + major) + cbor_head(2, len(data)) + data
+    elif isinstance(content, float):
+        yield CBOR_DOUBLE + struct.pack('>d', content)
+    elif isinstance(content, str):
+        data = content.encode('UTF-8')
+        yield cbor_head(3, len(data)) + data
+    elif isinstance(content, bytes):
+        yield from iter_cbor(json.loads(content.decode('UTF-8')))
+    elif isinstance(content, dict):
+        yield cbor_head(5, len(content))
+        for key, value in content.items():
+            yield from iter_cbor(key)
+            yield from iter_cbor(value)
+    elif isinstance(content, (list, tuple)):
+        yield cbor_head(4, len(content))
+        for item in content:
+            yield from iter_cbor(item)
+    elif isinstance(content, GeneratorType):
+        yield CBOR_INDEFINITE_ARRAY
+        for item in content:
+            yield from iter_cbor(item)
+        yield CBOR_BREAK
+    else:
+        raise TypeError('{} is not CBOR serializable'.format(type(content).__name__))
+
+
+def stream_bytes(pieces, compressor=None):
+    """Yields the encoded pieces in chunks, compressed if required"""
+    chunk = bytearray()
+    for piece in pieces:
+        chunk.extend(piece)
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            data = bytes(chunk)
+            chunk.clear()
+            if compressor:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield data
+    data = bytes(chunk)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+class EventBody(object):
+    """
+    Server-Sent Events framing of an event stream, it yields an empty chunk
+    when there is nothing pending so the connection waits for the next push
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunks = []
+        if not self.started:
+            self.started = True
+            chunks.append('retry: {}\n\n'.format(EVENTS_RETRY))
+        for kind, data in self.stream.pop():
+            if kind is None:
+                chunks.append(':\n\n')
+            else:
+                chunks.append('event: {}\ndata: {}\n\n'.format(kind, data))
+        return ''.join(chunks).encode('UTF-8')
+
+    def close(self):
+        self.stream.close()
+
+
+class WebSocket(object):
+    """
+    RFC 6455 messaging over an upgraded connection. Text messages are JSON
+    commands with the same arguments as /rest/player plus an optional id
+    echoed in the reply, the player state changes are pushed back as the
+    status fields that changed since the last push.
+    Pushes wait while a slow client has more than WRITE_SIZE bytes pending,
+    the stream keeps the latest event of each kind meanwhile and they are
+    sent once the output is flushed.
+    """
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+        self.status = {}
+        self.message = None
+        self.closing = False
+        self.push_pending = False
+        stream.wakeup = self.push_events
+        self.push_events()
+
+    def process_input(self):
+        data = self.connection.input
+        while not self.closing:
+            try:
+                frame = parse_frame(data)
+                if frame is None:
+                    return
+                fin, opcode, payload, size = frame
+                del data[:size]
+                self.handle_frame(fin, opcode, payload)
+            except WebSocketError as e:
+                log.debug('Websocket error from {}: {}'.format(self.connection.address, e))
+                self.close(e.code, str(e))
+        del data[:]
+
+    def handle_frame(self, fin, opcode, payload):
+        if opcode >= OP_CLOSE:
+            if not fin or len(payload) > 125:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'invalid control frame')
+            if opcode == OP_CLOSE:
+                code = CLOSE_NORMAL
+                if len(payload) >= 2:
+                    code = int.from_bytes(payload[:2], 'big')
+                self.close(code)
+            elif opcode == OP_PING:
+                self.send(OP_PONG, payload)
+            elif opcode != OP_PONG:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'unknown opcode')
+            return
+        if opcode == OP_CONTINUATION:
+            if self.message is None:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'nothing to continue')
+            self.message[1].extend(payload)
+        elif opcode in (OP_TEXT, OP_BINARY):
+            if self.message is not None:
+                raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'message not finished')
+            self.message = (opcode, bytearray(payload))
+        else:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'unknown opcode')
+        if len(self.message[1]) > MAX_MESSAGE_SIZE:
+            raise WebSocketError(CLOSE_TOO_BIG, 'message too big')
+        if fin:
+            opcode, message = self.message
+            self.message = None
+            if opcode == OP_BINARY:
+                raise WebSocketError(CLOSE_UNSUPPORTED, 'binary messages not supported')
+            try:
+                text = message.decode('UTF-8')
+            except UnicodeDecodeError:
+                raise WebSocketError(CLOSE_INVALID_DATA, 'invalid UTF-8')
+            self.handle_message(text)
+
+    def handle_message(self, text):
+        reply = {}
+        try:
+            command = json.loads(text)
+            if not isinstance(command, dict):
+                raise ValueError('command must be an object')
+            if 'id' in command:
+                reply['id'] = command.pop('id')
+            log.debug('Websocket command {}'.format(command))
+            status = app.route(WEBSOCKET_COMMANDS, **as_parameters(command))
+            reply['action'] = status.pop('last_action')
+        except (ValueError, TypeError) as e:
+            reply['error'] = str(e) or 'invalid command'
+            self.send_json(reply)
+            return
+        except Exception:
+            log.error('Error running websocket command {}'.format(text), exc_info=True)
+            reply['error'] = 'server error'
+            self.send_json(reply)
+            return
+        self.send_status(status, reply)
+
+    def push_events(self):
+        if self.closing:
+            return
+        if len(self.connection.output) > WRITE_SIZE:
+            self.push_pending = True
+            return
+        self.push_pending = False
+        for kind, data in self.stream.pop():
+            if kind is None:
+                self.send(OP_PING, b'')
+            elif kind == 'status':
+                self.send_status(json.loads(data))
+            else:
+                self.send_json({kind : json.loads(data)})
+
+    def send_status(self, status, message=None):
+        message = message or {}
+        changes = status_changes(self.status, status)
+        self.status = status
+        if changes:
+            message['status'] = changes
+        if message:
+            self.send_json(message)
+
+    def send_json(self, value):
+        self.send(OP_TEXT, json.dumps(value).encode('UTF-8'))
+
+    def send(self, opcode, payload):
+        if self.closing:
+            return
+        self.connection.output.extend(encode_frame(opcode, payload))
+        self.connection.start_writing()
+
+    def close(self, code=CLOSE_NORMAL, reason=''):
+        if self.closing:
+            return
+        self.send(OP_CLOSE, code.to_bytes(2, 'big') + reason.encode('UTF-8')[:123])
+        self.closing = True
+        self.stream.close()
+
+    def flushed(self):
+        if self.closing:
+            self.connection.close()
+        elif self.push_pending:
+            self.push_events()
+
+
+def is_websocket_request(environ):
+    return (environ['PATH_INFO'] == WEBSOCKET_PATH
+            and environ.get('HTTP_UPGRADE', '').lower() == 'websocket')
+
+
+def parse_frame(data):
+    """
+    Parses a client frame from the start of data, returns None when the
+    frame is not complete yet or (fin, opcode, payload, frame size)
+    """
+    if len(data) < 2:
+        return None
+    first, second = data[0], data[1]
+    if first & 0x70:
+        raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'reserved bits set')
+    if not second & 0x80:
+        raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'client frames must be masked')
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        offset = 4
+        if len(data) < offset:
+            return None
+        length = int.from_bytes(data[2:4], 'big')
+    elif length == 127:
+        offset = 10
+        if len(data) < offset:
+            return None
+        length = int.from_bytes(data[2:10], 'big')
+    if length > MAX_MESSAGE_SIZE:
+        raise WebSocketError(CLOSE_TOO_BIG, 'frame too big')
+    size = offset + 4 + length
+    if len(data) < size:
+        return None
+    mask = bytes(data[offset:offset + 4])
+    payload = unmask(mask, bytes(data[offset + 4:size]))
+    return bool(first & 0x80), first & 0x0F, payload, size
+
+
+def unmask(mask, payload):
+    length = len(payload)
+    if not length:
+        return payload
+    key = (mask * (length // 4 + 1))[:length]
+    value = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return value.to_bytes(length, 'big')
+
+
+def encode_frame(opcode, payload):
+    """Encodes a final, unmasked server frame"""
+    length = len(payload)
+    header = bytearray([0x80 | opcode])
+    if length < 126:
+        header.append(length)
+    elif length < 0x10000:
+        header.append(126)
+        header.extend(length.to_bytes(2, 'big'))
+    else:
+        header.append(127)
+        header.extend(length.to_bytes(8, 'big'))
+    return bytes(header) + payload
+
+
+class LongPollBody(object):
+    """
+    Waits on a status watch yielding empty chunks, the response only
+    starts once the watch is done
+    """
+
+    def __init__(self, response, watch):
+        self.response = response
+        self.watch = watch
+        self.sent = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sent:
+            raise StopIteration
+        if not self.watch.done:
+            return b''
+        self.sent = True
+        return b''.join(self.response.reply_with_json(self.watch.result()))
+
+    def close(self):
+        self.watch.close()
+
+
 class ServerError(Exception):
     pass
+
+
+class WebSocketError(Exception):
+
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+
+
+class HttpError(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
@@ -19,3 +19,33 @@ def to_list(value):
     if type(value) is list:
         return value
     return [value]
+
+
+def as_parameters(values):
+    """Turns json values into the string arguments a form post would have"""
+    parameters = {}
+    for key, value in values.items():
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        parameters[key] = str(value)
+    return parameters
+
+
+def parse_accept(value):
+    """Parses an Accept like header into a {name: quality} dict"""
+    accepted = {}
+    for item in value.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, number = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
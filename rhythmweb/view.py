@@ -1,7 +1,15 @@
 
-from rhythmweb.app import route
-from rhythmweb.controller import Player, Song, Queue, Query, Source, query_library
-from rhythmweb.utils import to_int, to_float
+import json
+
+from urllib.parse import parse_qs
+
+from rhythmweb import rb
+from rhythmweb.app import route, app, NoRouteError
+from rhythmweb.model import SONG_FIELDS
+from rhythmweb.controller import Player, Song, Queue, Query, Source, query_library, get_events
+from rhythmweb.controller import library_suggestions, SUGGEST_FIELDS
+from rhythmweb.controller import LONG_POLL_SECONDS, EventStream, StatusWatch
+from rhythmweb.utils import to_int, to_float, as_parameters
 
 import logging
 log = logging.getLogger(__name__)
@@ -14,17 +22,35 @@ MEDIA_TYPES = {'song' : 'song',
                 'podcast-post' : 'podcast-post'}
 
 SEARCH_TYPES = {'artists', 'genres', 'albums'}
+LIBRARY_SORTS = (rb.SORT_COUNT, rb.SORT_NAME)
+MAX_SUGGEST_LIMIT = 50
+FORMAT_COLUMNAR = 'columnar'
+
+BATCH_PATH = '/rest/batch'
+MAX_BATCH_SIZE = 20
+
+@route('/rest/status', query=('since', 'timeout'))
+def status(**kwargs):
+    since = to_int(kwargs.get('since', None), 'since must be a number')
+    if since is None:
+        log.debug('Returning status')
+        return Player().snapshot().encode()
+    timeout = to_int(kwargs.get('timeout', LONG_POLL_SECONDS), 'timeout must be a number')
+    log.debug('Returning status since version {}'.format(since))
+    return Player().watch(since, timeout)
+
 
-@route('/rest/status')
-def status():
-    log.debug('Returning status')
-    return Player().status()
+@route('/rest/events')
+def events():
+    log.debug('Subscribing to events')
+    return get_events().subscribe()
 
 
-@route('/rest/song/<song:int>')
+@route('/rest/song/<song:int>', query=('fields',))
 def song(song_id, **kwargs):
+    fields = parse_fields(kwargs)
     handler = Song()
-    song = handler.find_by_id(song_id)
+    song = handler.find_by_id(song_id, fields)
     if song:
         rating = to_int(kwargs.get('rating', None), 'rating must be a number')
         if not rating is None:
@@ -34,27 +60,102 @@ def song(song_id, **kwargs):
     return song
 
 
-@route('/rest/queue')
-def queue():
+@route('/rest/queue', query=('fields', 'format'))
+def queue(**kwargs):
+    fields = parse_fields(kwargs)
+    columnar = parse_format(kwargs)
     handler = Queue()
+    if kwargs: # POST
+        changes = parse_queue_changes(kwargs)
+        log.info('Updating queue with {}'.format(changes))
+        handler.update_queue(**changes)
     log.debug('Returning queue')
-    return handler.get_queue()
+    return handler.get_queue(fields, columnar)
+
+
+@route('/rest/queue/order', query=('fields', 'format'))
+def queue_order(**kwargs):
+    fields = parse_fields(kwargs)
+    columnar = parse_format(kwargs)
+    if not kwargs:
+        raise TypeError
+    if not kwargs.get('entries', None):
+        raise ValueError('no "entries" parameter')
+    handler = Queue()
+    handler.reorder_queue(parse_ids(kwargs['entries']))
+    return handler.get_queue(fields, columnar)
+
+
+def parse_queue_changes(kwargs):
+    """
+    The add, remove and replace lists of entry ids and the move list of
+    id:position pairs of a queue update, replace= clears the queue
+    """
+    unknown = set(kwargs) - set(('add', 'remove', 'move', 'replace'))
+    if unknown or not kwargs:
+        raise ValueError('queue changes are add, remove, move and replace')
+    changes = {}
+    for key in ('add', 'remove', 'replace'):
+        if key in kwargs:
+            changes[key] = parse_ids(kwargs[key])
+    if 'move' in kwargs:
+        moves = []
+        for move in parse_list(kwargs['move']):
+            entry_id, separator, position = move.partition(':')
+            if not separator:
+                raise ValueError('moves must be id:position pairs')
+            moves.append((to_int(entry_id, 'entry ids must be numbers'),
+                to_int(position, 'move positions must be numbers')))
+        changes['move'] = moves
+    return changes
+
 
+def parse_ids(value):
+    return [to_int(entry_id, 'entry ids must be numbers') for entry_id in parse_list(value)]
 
-@route('/rest/search/<media_type?>/<first_constraint?>/<first_value?>/<second_constraint?>/<second_value?>')
+
+def parse_list(value):
+    values = value if isinstance(value, list) else [value]
+    return [item.strip() for value in values for item in value.split(',') if item.strip()]
+
+
+@route('/rest/search/<media_type?>/<first_constraint?>/<first_value?>/<second_constraint?>/<second_value?>',
+        query=('fields', 'format'))
 def search(*args, **kwargs):
+    fields = parse_fields(kwargs)
+    columnar = parse_format(kwargs)
     try:
         query = parse_search_args(args)
         if kwargs:
             query.update(kwargs)
         validate_query(query)
         log.info('Running query {}'.format(query))
-        return Query().query(query)
+        return Query().query(query, fields, columnar)
     except:
         log.error('Error while running query', exc_info=True)
         raise ValueError('Invalid query')
         
 
+def parse_fields(kwargs):
+    """The song fields asked for with fields=, all of them by default"""
+    value = kwargs.pop('fields', None)
+    if not value:
+        return SONG_FIELDS
+    fields = tuple(field.strip() for field in value.split(',') if field.strip())
+    unknown = [field for field in fields if field not in SONG_FIELDS]
+    if unknown:
+        raise ValueError('Unknown fields {}'.format(', '.join(unknown)))
+    return fields
+
+
+def parse_format(kwargs):
+    """True when the entries are asked for as columnar rows"""
+    value = kwargs.pop('format', None)
+    if value and value != FORMAT_COLUMNAR:
+        raise ValueError('Unknown format {}'.format(value))
+    return value == FORMAT_COLUMNAR
+
+
 def parse_search_args(args):
     query = {}
     query_type = MEDIA_TYPES.get(args[0], None)
@@ -129,15 +230,46 @@ def parse_player_args(player_arguments):
     return kwargs
 
 
-@route('/rest/library/<search_for>')
-def library(search_for):
+@route('/rest/library/<search_for>', query=('first', 'limit', 'sort', 'prefix'))
+def library(search_for, **kwargs):
     if search_for not in SEARCH_TYPES:
         raise ValueError('Invalid library filter "{}"'.format(search_for))
-    return query_library(search_for)
+    if not kwargs:
+        return query_library(search_for)
+    page = {}
+    if 'sort' in kwargs:
+        if kwargs['sort'] not in LIBRARY_SORTS:
+            raise ValueError('sort must be one of {}'.format(', '.join(LIBRARY_SORTS)))
+        page['sort'] = kwargs['sort']
+    if kwargs.get('prefix', None):
+        page['prefix'] = kwargs['prefix']
+    for key in ('first', 'limit'):
+        if key in kwargs:
+            value = to_int(kwargs[key], '{} must be a number'.format(key))
+            if value < 0:
+                raise ValueError('{} must not be negative'.format(key))
+            page[key] = value
+    return query_library(search_for, **page)
 
     
-@route('/rest/playlists/<id?:int>')
+@route('/rest/suggest', query=('q', 'field', 'limit'))
+def suggest(**kwargs):
+    prefix = kwargs.get('q', '').strip()
+    if not prefix:
+        raise ValueError('no "q" parameter')
+    fields = [field for field in kwargs.get('field', 'artist,album,title').split(',') if field]
+    for field in fields:
+        if field not in SUGGEST_FIELDS:
+            raise ValueError('field must be one of {}'.format(', '.join(SUGGEST_FIELDS)))
+    limit = to_int(kwargs.get('limit', rb.SUGGEST_LIMIT), 'limit must be a number')
+    if not 0 < limit <= MAX_SUGGEST_LIMIT:
+        raise ValueError('limit must be between 1 and {}'.format(MAX_SUGGEST_LIMIT))
+    return library_suggestions(prefix, fields, limit)
+
+
+@route('/rest/playlists/<id?:int>', query=('fields',))
 def playlists(playlist_id, **kwargs):
+    fields = parse_fields(kwargs)
     source = Source()
     if kwargs: # POST
         action = kwargs.get('action', None)
@@ -160,9 +292,63 @@ def playlists(playlist_id, **kwargs):
         except IndexError:
             raise ValueError('there is no playlist with id {}'.format(playlist_id))
     elif playlist_id is None: # GET
-        return {'playlists': source.get_playlists()}
+        return {'playlists': source.get_playlists(fields)}
     else:
         try:
-            return source.get_playlist(playlist_id)
+            return source.get_playlist(playlist_id, fields)
         except IndexError:
             raise ValueError('there is no playlist with id {}'.format(playlist_id))
+
+
+@route(BATCH_PATH)
+def batch(**kwargs):
+    if not kwargs:
+        raise TypeError
+    try:
+        requests = json.loads(kwargs.get('requests', ''))
+    except ValueError:
+        raise ValueError('requests must be a json list')
+    if not isinstance(requests, list):
+        raise ValueError('requests must be a json list')
+    if len(requests) > MAX_BATCH_SIZE:
+        raise ValueError('no more than {} requests per batch'.format(MAX_BATCH_SIZE))
+    log.info('Running batch of {} requests'.format(len(requests)))
+    return [run_batch_request(request) for request in requests]
+
+
+def is_batch(path):
+    try:
+        return app.find_route(path)[0] is batch
+    except (NoRouteError, ValueError):
+        return False
+
+
+def run_batch_request(request):
+    if not isinstance(request, dict) or not isinstance(request.get('path', None), str):
+        return {'status' : 400, 'error' : 'every request needs a path'}
+    method = str(request.get('method', 'GET')).upper()
+    path, _, query = request['path'].partition('?')
+    if method not in ('GET', 'POST') or is_batch(path):
+        return {'status' : 405, 'error' : 'method {} not allowed'.format(method)}
+    if method == 'GET':
+        query = parse_qs(query, keep_blank_values=True)
+        params = app.query_parameters(path,
+            dict((key, values[-1]) for key, values in query.items()))
+    else:
+        params = as_parameters(request.get('params', None) or {})
+    log.debug('Batch {} {} with {}'.format(method, path, params))
+    try:
+        result = app.route(path, **params)
+    except ValueError as e:
+        return {'status' : 400, 'error' : str(e)}
+    except TypeError:
+        return {'status' : 405, 'error' : 'method {} not allowed'.format(method)}
+    except Exception:
+        log.error('Error running batch request {}'.format(request), exc_info=True)
+        return {'status' : 500, 'error' : 'server error'}
+    if result is None:
+        return {'status' : 404, 'error' : 'not found'}
+    if isinstance(result, (EventStream, StatusWatch)):
+        result.close()
+        return {'status' : 400, 'error' : 'streams cannot be batched'}
+    return {'status' : 200, 'body' : result}
@@ -8,10 +8,109 @@ mkdir -p gi
 touch gi/__init__.py
 echo "
 import mock
+import time
+import select
+import itertools
+import threading
+
+
+class MainContext(object):
+    # Runs io watches, timeouts and idle callbacks in a background thread
+
+    lock = threading.RLock()
+    sources = {}
+    ids = itertools.count(1)
+    thread = None
+
+    @classmethod
+    def add(cls, source):
+        with cls.lock:
+            source_id = next(cls.ids)
+            cls.sources[source_id] = source
+            if cls.thread is None:
+                cls.thread = threading.Thread(target=cls.run)
+                cls.thread.daemon = True
+                cls.thread.start()
+            return source_id
+
+    @classmethod
+    def remove(cls, source_id):
+        with cls.lock:
+            return cls.sources.pop(source_id, None) is not None
+
+    @classmethod
+    def run(cls):
+        while True:
+            time.sleep(0.0005)
+            with cls.lock:
+                cls.iterate()
+
+    @classmethod
+    def iterate(cls):
+        readers, writers, ready = {}, {}, []
+        now = time.time()
+        for source_id, source in list(cls.sources.items()):
+            kind = source[0]
+            if kind == 'io':
+                fd = source[1]
+                fd = fd if isinstance(fd, int) else fd.fileno()
+                if fd < 0:
+                    continue
+                if source[2] & (GObject.IO_IN | GObject.IO_HUP):
+                    readers[fd] = source_id
+                if source[2] & GObject.IO_OUT:
+                    writers[fd] = source_id
+            elif kind == 'idle' or source[1] <= now:
+                ready.append((source_id, None))
+        try:
+            timeout = 0 if ready else 0.01
+            r, w, _ = select.select(list(readers), list(writers), [], timeout)
+        except (OSError, ValueError):
+            return
+        ready += [(readers[fd], GObject.IO_IN) for fd in r]
+        ready += [(writers[fd], GObject.IO_OUT) for fd in w]
+        for source_id, condition in ready:
+            source = cls.sources.get(source_id)
+            if source is None:
+                continue
+            if source[0] == 'io':
+                keep = source[3](source[1], condition, *source[4])
+            else:
+                keep = source[2](*source[3])
+            if not keep:
+                cls.sources.pop(source_id, None)
+            elif source[0] == 'timeout':
+                cls.sources[source_id] = (
+                    'timeout', time.time() + source[4]) + source[2:]
+
+
+def io_add_watch(fd, condition, function, *args):
+    return MainContext.add(('io', fd, condition, function, args))
+
+
+def timeout_add(interval, function, *args):
+    delay = interval / 1000.0
+    return MainContext.add(('timeout', time.time() + delay, function, args, delay))
+
+
+def timeout_add_seconds(interval, function, *args):
+    return MainContext.add(('timeout', time.time() + interval, function, args, interval))
+
+
+def idle_add(function, *args):
+    return MainContext.add(('idle', None, function, args))
+
+
+def source_remove(source_id):
+    return MainContext.remove(source_id)
+
 
 class GObject(object):
-    IO_IN = 'input'
-    keep_running = {'keep': True}
+    IO_IN = 1
+    IO_PRI = 2
+    IO_OUT = 4
+    IO_ERR = 8
+    IO_HUP = 16
 
     class Object(object):
         pass
@@ -23,22 +122,11 @@ class GObject(object):
     def property(*args, **kwargs):
         return mock.Mock()
 
-    @classmethod
-    def io_add_watch(cls, socket, event, function):
-        cls.running = True
-        import threading, select
-        def do_the_work():
-            values = select.select([socket], [], [])
-            if values:
-                function.__self__.cgi_server.handle_request()
-
-        t = threading.Thread(target=do_the_work)
-        t.start()
-        return 1
-
-    @classmethod
-    def source_remove(cls, source):
-        cls.running = False
+    io_add_watch = staticmethod(io_add_watch)
+    timeout_add = staticmethod(timeout_add)
+    timeout_add_seconds = staticmethod(timeout_add_seconds)
+    idle_add = staticmethod(idle_add)
+    source_remove = staticmethod(source_remove)
 
 class RB(object):
     class RhythmDBPropType(object):
@@ -91,6 +179,17 @@ class GLib(object):
     class PtrArray(object):
         pass
 
+    IO_IN = GObject.IO_IN
+    IO_PRI = GObject.IO_PRI
+    IO_OUT = GObject.IO_OUT
+    IO_ERR = GObject.IO_ERR
+    IO_HUP = GObject.IO_HUP
+    io_add_watch = staticmethod(io_add_watch)
+    timeout_add = staticmethod(timeout_add)
+    timeout_add_seconds = staticmethod(timeout_add_seconds)
+    idle_add = staticmethod(idle_add)
+    source_remove = staticmethod(source_remove)
+
 class Peas(object):
     class Activatable(object):
         pass
@@ -0,0 +1,32 @@
+"""
+Measures the dispatch cost of every route registered in rhythmweb.view
+
+    python test/route_benchmark.py [iterations]
+"""
+import sys
+import timeit
+
+from rhythmweb import view
+from rhythmweb.app import app
+
+SAMPLES = {'int': '12', 'float': '1.5', 'str': 'value'}
+
+
+def sample_paths():
+    for path, function, rules in sorted(app.iter_routes(), key=lambda route: route[0]):
+        if all(rule['optional'] for rule in rules):
+            yield path
+        if rules:
+            values = [SAMPLES[rule['type']] for rule in rules]
+            yield '/'.join([path] + values)
+
+
+def main(iterations=100000):
+    print('{:<70} {:>10}'.format('path', 'usec/call'))
+    for path in sample_paths():
+        seconds = timeit.timeit(lambda: app.find_route(path), number=iterations)
+        print('{:<70} {:>10.3f}'.format(path, seconds * 1000000 / iterations))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,4 +1,9 @@
 
+import os
+import gzip
+import zlib
+import shutil
+import tempfile
 import unittest
 
 from rhythmweb.app import app, route
@@ -53,6 +58,36 @@ class TestPathParams(unittest.TestCase):
         with self.assertRaises(ValueError):
             app.route('/typed/route/1/2.1.3')
 
+    def test_unknown_path_returns_none(self):
+        self.assertIsNone(app.route('/unknown/route'))
+        self.assertIsNone(app.route('/other'))
+
+    def test_longest_registered_prefix_wins(self):
+        self.assertEquals('nested', app.route('/other/route/nested'))
+        self.assertEquals(('x', 'y'), app.route('/other/route/x/y'))
+
+    def test_routes_are_walked_from_the_trie(self):
+        routes = dict((path, rules) for path, function, rules in app.iter_routes())
+        self.assertEquals((), routes['/other/route/nested'])
+        self.assertEquals(['first', 'second'], [rule['name'] for rule in routes['/other/route']])
+        self.assertNotIn('/other', routes)
+
+    def test_query_parameters_are_only_the_declared_ones(self):
+        query = {'since': '3', 'action': 'next', '_': '123'}
+        self.assertEquals({'since': '3'}, app.query_parameters('/query/route', query))
+        self.assertEquals({}, app.query_parameters('/route/with/kwargs', query))
+        self.assertEquals({}, app.query_parameters('/unknown/route', query))
+
+    def test_empty_segments_are_skipped(self):
+        result1, result2 = app.route('/typed/route//1//2.5/')
+        self.assertEquals(1, result1)
+        self.assertEquals(2.5, result2)
+
+    def test_invalid_value_message_names_the_rule(self):
+        with self.assertRaises(ValueError) as e:
+            app.route('/typed/route/x/2.1')
+        self.assertEquals('x is invalid as value for one, int expected', str(e.exception))
+
 @route('/test/<name>')
 def simple_test(name):
     return name
@@ -61,10 +96,18 @@ def simple_test(name):
 def slightly_harder_test(one, two):
     return one, two
 
+@route('/other/route/nested')
+def nested_route():
+    return 'nested'
+
 @route('/route/with/kwargs')
 def route_with_kwargs(**kwargs):
     return kwargs['argument']
 
+@route('/query/route', query=('since', 'timeout'))
+def route_with_query(**kwargs):
+    return kwargs
+
 @route('/another/<first:str>/<second:str>/<third?:str>/<fourth?:str>')
 def route_with_optional_path(one, two, three, four):
     return one, two, three, four
@@ -93,3 +136,65 @@ class TestMountFilesystem(unittest.TestCase):
     def test_mount_invalid_path_raises_exception(self):
         with self.assertRaises(IOError):
             app.mount('./testXXXX', 'other3', ignore='/test')
+
+    def test_identical_files_share_content_across_groups(self):
+        app.mount('./resources/default', 'dedup1', ignore='/resources/default')
+        app.mount('./resources/touch', 'dedup2', ignore='/resources/touch')
+        default = app.get_file('/jquery-1.4.4.min.js', 'dedup1')
+        mobile = app.get_file('/jquery-1.4.4.min.js', 'dedup2')
+        self.assertIs(default.content, mobile.content)
+        self.assertEquals(default.etag, mobile.etag)
+
+    def test_file_is_not_modified_with_matching_etag(self):
+        app.mount('./test/acceptance.sh', 'etag')
+        f = app.get_file('/test/acceptance.sh', 'etag')
+        self.assertTrue(f.is_not_modified({'HTTP_IF_NONE_MATCH': f.etag}))
+        self.assertTrue(f.is_not_modified({'HTTP_IF_NONE_MATCH': 'W/' + f.etag}))
+        self.assertFalse(f.is_not_modified({'HTTP_IF_NONE_MATCH': '"other"'}))
+        self.assertFalse(f.is_not_modified({}))
+
+    def test_file_is_not_modified_since_last_modified(self):
+        app.mount('./test/acceptance.sh', 'since')
+        f = app.get_file('/test/acceptance.sh', 'since')
+        self.assertTrue(f.is_not_modified({'HTTP_IF_MODIFIED_SINCE': f.last_modified}))
+        self.assertFalse(f.is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': 'Thu, 01 Jan 1970 00:00:00 GMT'}))
+        self.assertFalse(f.is_not_modified({'HTTP_IF_MODIFIED_SINCE': 'garbage'}))
+
+    def test_modified_file_is_reloaded_when_checking_mtime(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'file.txt')
+            with open(filename, 'w') as f:
+                f.write('one')
+            app.mount(filename, 'mtime', ignore=path)
+            self.assertEquals(app.get_file('/file.txt', 'mtime').content, b'one')
+            with open(filename, 'w') as f:
+                f.write('two')
+            os.utime(filename, (0, 0))
+            self.assertEquals(app.get_file('/file.txt', 'mtime').content, b'one')
+            app.check_mtime = True
+            self.assertEquals(app.get_file('/file.txt', 'mtime').content, b'two')
+        finally:
+            app.check_mtime = False
+            shutil.rmtree(path)
+
+    def test_compressed_variants_are_picked_by_accept_encoding(self):
+        app.mount('./resources/default/jquery.js', 'encoding', ignore='/resources/default')
+        f = app.get_file('/jquery.js', 'encoding')
+        encoding, content, etag = f.encode('gzip, deflate')
+        self.assertEquals('gzip', encoding)
+        self.assertEquals(gzip.decompress(content), f.content)
+        self.assertNotEquals(etag, f.etag)
+        encoding, content, etag = f.encode('gzip;q=0.5, deflate')
+        self.assertEquals('deflate', encoding)
+        self.assertEquals(zlib.decompress(content), f.content)
+        self.assertEquals((None, f.content, f.etag), f.encode(''))
+        self.assertEquals((None, f.content, f.etag), f.encode('gzip;q=0, br'))
+        self.assertTrue(f.is_not_modified({'HTTP_IF_NONE_MATCH': f.etags['gzip']}))
+
+    def test_images_are_not_compressed(self):
+        app.mount('./resources/default/img/play.png', 'images', ignore='/resources/default')
+        f = app.get_file('/img/play.png', 'images')
+        self.assertEquals({}, f.variants)
+        self.assertEquals((None, f.content, f.etag), f.encode('gzip'))
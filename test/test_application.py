@@ -1,13 +1,28 @@
 import os
+import json
+import time
+import socket
 import unittest
 
+from http.client import HTTPConnection
+
 from mock import Mock, patch
 from urllib.request import urlopen, HTTPError
 
 from rhythmweb.conf import Configuration
 from rhythmweb import view, controller, rb
 from rhythmweb.server import Server
-from utils import Stub
+from utils import Stub, mock_snapshot
+
+
+def read_until(client, marker):
+    received = b''
+    while marker not in received:
+        data = client.recv(65536)
+        if not data:
+            raise AssertionError('connection closed before {}'.format(marker))
+        received += data
+    return received
 
 
 class TestServer(unittest.TestCase):
@@ -15,10 +30,13 @@ class TestServer(unittest.TestCase):
     def setUp(self):
         self.rb = Mock(rb.RBHandler)
         controller.rb_handler['rb'] = self.rb
+        controller.status_cache.clear()
+        mock_snapshot(self.rb)
         self.entry = Stub()
         self.response = Mock()
         conf = Configuration()
         conf.parser.set('server', 'port', '7003')
+        conf.parser.set('server', 'keepalive.requests', '3')
         self.conf_patch = patch('rhythmweb.server.Configuration')
         conf_mock = self.conf_patch.start()
         conf_mock.return_value = conf
@@ -70,3 +88,212 @@ class TestServer(unittest.TestCase):
             self.assertEquals(response.code, 200)
         finally:
             server.stop()
+
+    def test_slow_client_does_not_block_other_requests(self):
+        server = Server()
+        try:
+            server.start()
+            slow = socket.create_connection(('localhost', 7003))
+            slow.sendall(b'GET /index.html HTTP/1.1\r\nHost: loc')
+            response = urlopen('http://localhost:7003/index.html', timeout=5)
+            self.assertEquals(response.code, 200)
+            slow.sendall(b'alhost\r\n\r\n')
+            slow.settimeout(5)
+            self.assertTrue(slow.recv(1024).startswith(b'HTTP/1.1 200 OK'))
+            slow.close()
+        finally:
+            server.stop()
+
+    def test_invalid_request_line_returns_bad_request(self):
+        server = Server()
+        try:
+            server.start()
+            client = socket.create_connection(('localhost', 7003))
+            client.settimeout(5)
+            client.sendall(b'this is not http\r\n\r\n')
+            self.assertTrue(client.recv(1024).startswith(b'HTTP/1.1 400'))
+            client.close()
+        finally:
+            server.stop()
+
+    def test_keep_alive_reuses_connection(self):
+        server = Server()
+        try:
+            server.start()
+            client = HTTPConnection('localhost', 7003, timeout=5)
+            for path in ('/index.html', '/style.css'):
+                client.request('GET', path)
+                response = client.getresponse()
+                self.assertEquals(response.status, 200)
+                self.assertEquals(response.getheader('Connection'), 'keep-alive')
+                self.assertTrue(response.read())
+            self.assertEquals(len(server.connections), 1)
+            client.close()
+        finally:
+            server.stop()
+
+    def test_connection_closed_after_max_requests(self):
+        server = Server()
+        try:
+            server.start()
+            client = HTTPConnection('localhost', 7003, timeout=5)
+            headers = []
+            for _ in range(3):
+                client.request('GET', '/index.html')
+                response = client.getresponse()
+                response.read()
+                headers.append(response.getheader('Connection'))
+            self.assertEquals(headers, ['keep-alive', 'keep-alive', 'close'])
+            client.close()
+        finally:
+            server.stop()
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        self.rb.get_entry.return_value = None
+        server = Server()
+        try:
+            server.start()
+            client = socket.create_connection(('localhost', 7003))
+            client.settimeout(5)
+            client.sendall(
+                b'GET /rest/song/1 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                b'GET /index.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            received = b''
+            data = client.recv(65536)
+            while data:
+                received += data
+                data = client.recv(65536)
+            client.close()
+            first = received.index(b'HTTP/1.1 404')
+            second = received.index(b'HTTP/1.1 200 OK')
+            self.assertTrue(first < second)
+        finally:
+            server.stop()
+
+    def test_http_10_connection_is_closed(self):
+        server = Server()
+        try:
+            server.start()
+            client = socket.create_connection(('localhost', 7003))
+            client.settimeout(5)
+            client.sendall(b'GET /index.html HTTP/1.0\r\n\r\n')
+            received = b''
+            data = client.recv(65536)
+            while data:
+                received += data
+                data = client.recv(65536)
+            client.close()
+            self.assertIn(b'Connection: close', received)
+            self.assertIn(b'<html>', received)
+        finally:
+            server.stop()
+
+    def test_large_json_is_sent_chunked(self):
+        self.rb.query.return_value = [Stub(id=i) for i in range(500)]
+        server = Server()
+        try:
+            server.start()
+            client = HTTPConnection('localhost', 7003, timeout=5)
+            client.request('GET', '/rest/search/song')
+            response = client.getresponse()
+            self.assertEquals(response.getheader('Transfer-Encoding'), 'chunked')
+            returned = json.loads(response.read().decode('UTF-8'))
+            self.assertEquals(500, len(returned['entries']))
+            client.close()
+        finally:
+            server.stop()
+
+    def test_events_are_pushed_to_subscribers(self):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        controller.rb_handler.pop('events', None)
+        server = Server()
+        try:
+            server.start()
+            client = socket.create_connection(('localhost', 7003))
+            client.settimeout(5)
+            client.sendall(b'GET /rest/events HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            received = read_until(client, b'"volume": 1')
+            self.assertTrue(received.startswith(b'HTTP/1.1 200 OK'))
+            self.assertIn(b'Transfer-Encoding: chunked', received)
+            self.rb.get_volume.return_value = 0.5
+            self.rb.state_version = 2
+            events = controller.get_events()
+            events.state_changed('player', 2)
+            received = read_until(client, b'"volume": 0.5')
+            self.assertIn(b'event: status', received)
+            client.close()
+            deadline = time.time() + 5
+            while events.subscribers and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(events.subscribers)
+        finally:
+            server.stop()
+
+    def test_websocket_commands_and_status_push(self):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        controller.rb_handler.pop('events', None)
+        server = Server()
+        try:
+            server.start()
+            client = socket.create_connection(('localhost', 7003))
+            client.settimeout(5)
+            client.sendall(b'GET /rest/ws HTTP/1.1\r\nHost: localhost\r\n'
+                b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                b'Sec-WebSocket-Version: 13\r\n\r\n')
+            received = read_until(client, b'"status"')
+            self.assertTrue(received.startswith(b'HTTP/1.1 101 Switching Protocols'))
+            self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', received)
+            mask = b'\x00\x00\x00\x00'
+            command = b'{"id": 1, "action": "set_volume", "volume": 0.5}'
+            self.rb.get_volume.return_value = 0.5
+            client.sendall(bytes([0x81, 0x80 | len(command)]) + mask + command)
+            received = read_until(client, b'"volume": 0.5')
+            self.rb.set_volume.assert_called_with(0.5)
+            self.assertIn(b'"action": "set_volume"', received)
+            client.sendall(b'\x88\x82' + mask + b'\x03\xe8')
+            received = b''
+            data = client.recv(65536)
+            while data:
+                received += data
+                data = client.recv(65536)
+            self.assertEquals(b'\x88\x02\x03\xe8', received)
+            client.close()
+            self.assertFalse(controller.get_events().subscribers)
+        finally:
+            server.stop()
+
+    def test_parked_status_request_does_not_block_others(self):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        self.rb.state_version = 5
+        listeners = []
+        self.rb.add_state_listener.side_effect = listeners.append
+        server = Server()
+        try:
+            server.start()
+            parked = socket.create_connection(('localhost', 7003))
+            parked.settimeout(5)
+            parked.sendall(b'GET /rest/status?since=5 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            deadline = time.time() + 5
+            while not listeners and time.time() < deadline:
+                time.sleep(0.01)
+            response = urlopen('http://localhost:7003/index.html', timeout=5)
+            self.assertEquals(response.code, 200)
+            self.rb.get_volume.return_value = 0.5
+            self.rb.state_version = 6
+            listeners[0]('player', 6)
+            received = read_until(parked, b'0\r\n\r\n')
+            self.assertTrue(received.startswith(b'HTTP/1.1 200 OK'))
+            self.assertIn(b'"version": 6', received)
+            parked.close()
+        finally:
+            server.stop()
@@ -16,6 +16,9 @@ class ConfigurationTest(unittest.TestCase):
         self.assertEquals('touch', config.get_string('theme.mobile'))
         self.assertEquals('0.0.0.0', config.get_string('hostname'))
         self.assertEquals(7000, config.get_int('port'))
+        self.assertEquals(15, config.get_int('keepalive.timeout'))
+        self.assertEquals(100, config.get_int('keepalive.requests'))
+        self.assertEquals(50, config.get_int('events.subscribers'))
         self.assertEquals('/tmp/rb-serve.log', config.get_string('log.file'))
         self.assertEquals('%(levelname)s	%(asctime)s	%(name)s: %(message)s', config.get_string('log.format'))
         self.assertEquals('INFO', config.get_string('log.level'))
@@ -0,0 +1,87 @@
+import unittest
+
+from rhythmweb.index import SearchIndex, fold, tokenize, trigrams
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.update(1, ('The Beatles', 'Abbey Road', 'Rock', 'Come Together'), 1)
+        self.index.update(2, ('The Beatles', 'Abbey Road', 'Rock', 'Something'), 2)
+        self.index.update(3, ('Radiohead', 'OK Computer', 'Rock', 'Airbag'), 1)
+        self.index.update(4, ('Björk', 'Homogenic', '[empty]', 'Jóga'), 3)
+
+    def test_fold_ignores_case_and_accents(self):
+        self.assertEquals('bjork', fold('BJÖRK'))
+        self.assertEquals(['joga', 'x'], tokenize('Jóga, X!'))
+
+    def test_all_tokens_have_to_match(self):
+        self.assertEquals([1], self.index.search('beatles together'))
+        self.assertEquals([], self.index.search('beatles airbag'))
+
+    def test_tokens_match_as_prefixes_across_fields(self):
+        self.assertEquals([1, 2], self.index.search('beat abbey'))
+        self.assertEquals([3, 1, 2], self.index.search('rock'))
+
+    def test_entries_are_found_once(self):
+        self.index.update(5, ('Road', 'Road', 'Road', 'Road'), 1)
+        self.assertEquals([5, 1, 2], self.index.search('road'))
+
+    def test_accents_and_empty_names(self):
+        self.assertEquals([4], self.index.search('bjork joga'))
+        self.assertEquals([], self.index.search('empty'))
+
+    def test_updates_and_removals_drop_old_tokens(self):
+        self.index.update(3, ('Radiohead', 'Kid A', 'Rock', 'Idioteque'), 1)
+        self.assertEquals([], self.index.search('computer'))
+        self.assertEquals([3], self.index.search('kid'))
+        self.index.remove(3)
+        self.assertEquals([], self.index.search('radiohead'))
+        self.assertNotIn('radiohead', self.index.tokens)
+        self.assertNotIn('radiohead', self.index.postings)
+
+    def test_text_without_tokens_finds_nothing(self):
+        self.assertEquals([], self.index.search(' ,. '))
+
+    def test_trigrams_are_padded(self):
+        self.assertEquals(set(['  o', ' ok', 'ok ']), trigrams('ok'))
+
+    def test_fuzzy_search_tolerates_typos(self):
+        self.assertEquals([1, 2], self.index.fuzzy_search('beatels'))
+        self.assertEquals([3], self.index.fuzzy_search('radiohaed airbga'))
+        self.assertEquals([], self.index.fuzzy_search('zeppelin'))
+
+    def test_fuzzy_search_ranks_the_closest_first(self):
+        self.index.update(5, ('Beatless', 'Live', 'Rock', 'Something'), 1)
+        self.assertEquals([5, 1, 2], self.index.fuzzy_search('beatless'))
+        self.assertEquals([5, 2], self.index.fuzzy_search('beatless something'))
+
+    def test_fuzzy_search_matches_prefixes_exactly(self):
+        self.assertEquals(1.0, self.index.similar('radio')['radiohead'])
+        self.assertEquals([3], self.index.fuzzy_search('radio'))
+
+    def test_removed_tokens_leave_the_trigrams(self):
+        self.index.remove(3)
+        self.assertEquals({}, self.index.similar('radiohead'))
+        self.assertNotIn('rad', self.index.trigrams)
+        self.assertEquals(set(['road', 'rock']), self.index.trigrams['  r'])
+
+    def test_relevance_weights_artist_over_title(self):
+        self.index.update(5, ('Someone', 'Live', 'Rock', 'Radiohead Cover'), 1)
+        scores = self.index.relevance('radiohead', [3, 5])
+        self.assertGreater(scores[3], scores[5])
+
+    def test_relevance_prefers_whole_tokens_and_exact_artists(self):
+        self.index.update(5, ('Radio', 'Live', 'Rock', 'Radio'), 1)
+        scores = self.index.relevance('radio', [3, 5])
+        self.assertGreater(scores[5], 2 * scores[3])
+
+    def test_relevance_of_text_without_tokens_is_empty(self):
+        self.assertEquals({}, self.index.relevance(' ', [1, 2]))
+
+    def test_removals_update_the_field_lengths(self):
+        lengths = list(self.index.lengths)
+        self.index.update(5, ('A B', 'C', 'D', 'E F G'), 1)
+        self.index.remove(5)
+        self.assertEquals(lengths, self.index.lengths)
@@ -1,7 +1,7 @@
 import unittest
 
 from mock import Mock, patch
-from rhythmweb.rb import RBHandler
+from rhythmweb.rb import RBHandler, RBEntry
 
 from utils import EntryStub, ModelStub, Stub
 
@@ -31,3 +31,16 @@ class TestRBEntry(unittest.TestCase):
         entry = rbplayer.get_entry(1)
         self.assertEquals(entry.id, 1)
 
+    def test_entry_properties_are_read_when_used(self):
+        entry = Mock()
+        entry.get_ulong.return_value = 3
+        entry.get_string.return_value = 'calabaza'
+        rb_entry = RBEntry(entry)
+        self.assertEquals(3, rb_entry.id)
+        self.assertFalse(entry.get_string.called)
+        self.assertEquals('calabaza', rb_entry.title)
+        self.assertEquals('calabaza', rb_entry.title)
+        entry.get_string.assert_called_once_with('title')
+        self.assertFalse(hasattr(rb_entry, '__dict__'))
+        with self.assertRaises(AttributeError):
+            rb_entry.lyrics
@@ -1,7 +1,7 @@
 import unittest
 
 from contextlib import contextmanager
-from mock import Mock
+from mock import Mock, patch
 from rhythmweb.rb import RBHandler, ORDER_SHUFFLE, ORDER_LINEAR
 
 
@@ -140,3 +140,102 @@ class RBTest(unittest.TestCase):
         rbplayer.toggle_loop()
         self.assertEquals(rbplayer.get_play_order(), 'shuffle-loop')
 
+
+    def test_player_signals_change_state(self):
+        rbplayer = RBHandler(self.shell)
+        listener = Mock()
+        rbplayer.add_state_listener(listener)
+        signals = dict((args[0][0], args[0][1]) for args in self.player.connect.call_args_list)
+        signals['playing-song-changed'](self.player, Mock())
+        listener.assert_called_with('player', 2)
+        signals['notify::volume'](self.player, Mock())
+        listener.assert_called_with('player', 3)
+        rbplayer.remove_state_listener(listener)
+        signals['playing-changed'](self.player, True)
+        self.assertEquals(4, rbplayer.state_version)
+        self.assertEquals(2, listener.call_count)
+
+    def test_queue_signals_change_state(self):
+        rbplayer = RBHandler(self.shell)
+        listener = Mock()
+        rbplayer.add_state_listener(listener)
+        model = self.shell.props.queue_source.props.query_model
+        signals = dict((args[0][0], args[0][1]) for args in model.connect.call_args_list)
+        signals['row-deleted'](model, Mock())
+        listener.assert_called_with('queue', 2)
+
+    def test_elapsed_only_changes_state_on_seek(self):
+        rbplayer = RBHandler(self.shell)
+        listener = Mock()
+        rbplayer.add_state_listener(listener)
+        rbplayer.elapsed_changed(self.player, 1)
+        self.assertFalse(listener.called)
+        rbplayer.elapsed_changed(self.player, 120)
+        listener.assert_called_with('player', 2)
+
+    def set_player(self, playing=True, elapsed=60):
+        self.player.get_playing.return_value = (None, playing)
+        self.player.get_mute.return_value = (None, False)
+        self.player.get_volume.return_value = (None, 1.0)
+        self.player.get_playing_time.return_value = (None, elapsed)
+        entry = Mock()
+        entry.get_ulong.return_value = 7
+        self.player.get_playing_entry.return_value = entry
+        return entry
+
+    def test_snapshot_is_read_again_only_after_player_changes(self):
+        self.set_player(playing=False)
+        rbplayer = RBHandler(self.shell)
+        rbplayer.get_snapshot()
+        rbplayer.get_snapshot()
+        self.assertEquals(1, self.player.get_playing.call_count)
+        self.assertEquals(1, self.player.get_volume.call_count)
+        signals = dict((args[0][0], args[0][1]) for args in self.player.connect.call_args_list)
+        signals['notify::volume'](self.player, Mock())
+        rbplayer.get_snapshot()
+        self.assertEquals(2, self.player.get_volume.call_count)
+
+    def test_snapshot_is_read_again_when_playing_entry_changes(self):
+        entry = self.set_player()
+        rbplayer = RBHandler(self.shell)
+        self.assertEquals(7, rbplayer.get_snapshot()['playing_entry'].id)
+        self.db.connect.assert_any_call('entry-changed', rbplayer.playing_entry_changed)
+        other = Mock()
+        other.get_ulong.return_value = 8
+        rbplayer.playing_entry_changed(self.db, other, [])
+        self.assertEquals(1, rbplayer.state_version)
+        rbplayer.get_snapshot()
+        self.assertEquals(1, self.player.get_playing_entry.call_count)
+        rbplayer.playing_entry_changed(self.db, entry, [])
+        self.assertEquals(2, rbplayer.state_version)
+        rbplayer.get_snapshot()
+        self.assertEquals(2, self.player.get_playing_entry.call_count)
+
+    @patch('rhythmweb.rb.time')
+    def test_elapsed_is_extrapolated_while_playing(self, time):
+        self.set_player(elapsed=60)
+        time.time.return_value = 100
+        rbplayer = RBHandler(self.shell)
+        rbplayer.get_snapshot()
+        time.time.return_value = 105
+        self.assertEquals(65, rbplayer.get_elapsed())
+        self.assertEquals(1, self.player.get_playing_time.call_count)
+
+    @patch('rhythmweb.rb.time')
+    def test_elapsed_is_kept_while_paused(self, time):
+        self.set_player(elapsed=60)
+        time.time.return_value = 100
+        rbplayer = RBHandler(self.shell)
+        rbplayer.get_snapshot()
+        listener = Mock()
+        rbplayer.add_state_listener(listener)
+        time.time.return_value = 105
+        rbplayer.playing_changed(self.player, False)
+        self.player.get_playing.return_value = (None, False)
+        rbplayer.get_snapshot()
+        time.time.return_value = 500
+        self.assertEquals(65, rbplayer.get_elapsed())
+        rbplayer.playing_changed(self.player, True)
+        time.time.return_value = 501
+        rbplayer.elapsed_changed(self.player, 66)
+        self.assertEquals(2, listener.call_count)
@@ -1,7 +1,7 @@
 import unittest
 
-from mock import Mock
-from rhythmweb.rb import RBHandler
+from mock import Mock, patch
+from rhythmweb.rb import RBHandler, Library, LIBRARY_SLICE
 from utils import EntryStub
 
 class TestRBLibrary(unittest.TestCase):
@@ -11,17 +11,93 @@ class TestRBLibrary(unittest.TestCase):
         shell.props.shell_player = player
         shell.props.db = db
         self.player, self.shell, self.db = player, shell, db
+        self.glib_patch = patch('rhythmweb.rb.GLib')
+        self.glib = self.glib_patch.start()
+
+    def tearDown(self):
+        self.glib_patch.stop()
 
     def test_entry_added_signal_connected(self):
         rb = RBHandler(self.shell)
         self.shell.props.db.connect.assert_called_with(
                 'entry_added', rb.library.entry_added)
 
+    def test_entry_changes_and_deletions_are_connected(self):
+        rb = RBHandler(self.shell)
+        self.db.connect.assert_any_call('entry-changed', rb.library.entry_changed)
+        self.db.connect.assert_any_call('entry-deleted', rb.library.entry_deleted)
+
+    def add(self, library, *entries):
+        for entry in entries:
+            library.entry_added(self.db, entry)
+        library.drain()
+
+    def test_play_count_change_applies_the_difference(self):
+        library = Library()
+        self.add(library, EntryStub(1, artist='guy', play_count=10),
+                EntryStub(2, artist='guy', play_count=5))
+        library.entry_changed(self.db, EntryStub(1, artist='guy', play_count=11), [])
+        library.drain()
+        self.assertEquals({'guy': 16}, library.artists['values'])
+        self.assertEquals(16, library.artists['max'])
+
+    def test_retag_moves_the_counts(self):
+        library = Library()
+        self.add(library, EntryStub(1, artist='guy 1', play_count=10),
+                EntryStub(2, artist='guy 2', play_count=5))
+        library.entry_changed(self.db, EntryStub(1, artist='guy 2', play_count=10), [])
+        library.drain()
+        self.assertEquals({'guy 2': 15}, library.artists['values'])
+        self.assertEquals(15, library.artists['max'])
+        self.assertEquals({'album': 15}, library.albums['values'])
+
+    def test_deleted_entry_is_subtracted(self):
+        library = Library()
+        self.add(library, EntryStub(1, artist='guy 1', play_count=10),
+                EntryStub(2, artist='guy 2', play_count=5),
+                EntryStub(3, artist='guy 2', play_count=0))
+        library.entry_deleted(self.db, EntryStub(1))
+        library.drain()
+        self.assertEquals({'guy 2': 5}, library.artists['values'])
+        self.assertEquals(5, library.artists['max'])
+        library.entry_deleted(self.db, EntryStub(2))
+        library.drain()
+        self.assertEquals({'guy 2': 0}, library.artists['values'])
+        library.entry_deleted(self.db, EntryStub(3))
+        library.drain()
+        self.assertEquals({}, library.artists['values'])
+        self.assertEquals(0, library.artists['max'])
+
+    def test_check_fixes_sampled_entries(self):
+        library = Library()
+        self.add(library, EntryStub(1, artist='guy', play_count=10),
+                EntryStub(2, artist='guy', play_count=5))
+        entries = {1: EntryStub(1, artist='guy', play_count=12)}
+        self.db.entry_count.return_value = 2
+        self.db.entry_lookup_by_id.side_effect = entries.get
+        library.check(self.db)
+        self.assertEquals({'guy': 12}, library.artists['values'])
+        self.assertEquals([1], list(library.entries))
+
+    def test_check_rebuilds_when_counts_differ(self):
+        library = Library()
+        self.add(library, EntryStub(1, artist='guy', play_count=10))
+        self.db.entry_count.return_value = 2
+        def foreach(function, data):
+            function(EntryStub(2, artist='other', play_count=3), data)
+            function(EntryStub(3, artist='other', play_count=4), data)
+        self.db.entry_foreach.side_effect = foreach
+        library.check(self.db)
+        library.drain()
+        self.assertEquals({'other': 7}, library.artists['values'])
+        self.assertEquals(7, library.artists['max'])
+
     def test_one_entry_added_adds_values(self):
         rb = RBHandler(self.shell)
         rb.library.entry_added(self.shell.props.db, 
                 EntryStub(1, artist='guy 1', album='album 1',
                 genre='genre 1', title='song 1', play_count=10))
+        rb.library.drain()
         self.assertEquals(rb.library.artists, {'values': {'guy 1': 10}, 'max': 10})
         self.assertEquals(rb.library.albums, {'values': {'album 1': 10}, 'max': 10})
         self.assertEquals(rb.library.genres, {'values': {'genre 1': 10}, 'max': 10})
@@ -33,12 +109,85 @@ class TestRBLibrary(unittest.TestCase):
                 EntryStub(1, artist='guy 1', album='album 1',
                 genre='genre 1', title='song 1', play_count=10))
         rb.library.entry_added(self.shell.props.db, 
-                EntryStub(1, artist='guy 2', album='album 1',
+                EntryStub(2, artist='guy 2', album='album 1',
                 genre='genre 1', title='song 2', play_count=5))
         rb.library.entry_added(self.shell.props.db, 
-                EntryStub(1, artist='guy 1', album='album 1',
+                EntryStub(3, artist='guy 1', album='album 1',
                 genre='genre 1', title='song 3', play_count=7))
+        rb.library.drain()
         self.assertEquals(rb.library.artists, {'values': {'guy 1': 17, 'guy 2' : 5}, 'max': 17})
         self.assertEquals(rb.library.albums, {'values': {'album 1': 22}, 'max': 22})
         self.assertEquals(rb.library.genres, {'values': {'genre 1': 22}, 'max': 22})
         self.assertEquals(rb.library.songs, {'values': {'song 1': 10, 'song 2': 5, 'song 3': 7}, 'max': 10})
+
+    def test_signals_are_indexed_in_idle_slices(self):
+        library = Library()
+        for entry_id in range(LIBRARY_SLICE + 100):
+            library.entry_added(self.db, EntryStub(entry_id, artist='guy', play_count=1))
+        library.entry_changed(self.db, EntryStub(1, artist='guy', play_count=3), [])
+        self.glib.idle_add.assert_called_once_with(library.drain)
+        self.assertEquals(0, library.progress())
+        self.assertTrue(library.drain())
+        self.assertEquals(83, library.progress())
+        self.assertFalse(library.drain())
+        self.assertIsNone(library.progress())
+        self.assertEquals({'guy': LIBRARY_SLICE + 102}, library.artists['values'])
+
+    def test_deletion_of_a_queued_entry_wins(self):
+        library = Library()
+        library.entry_added(self.db, EntryStub(1, artist='guy', play_count=1))
+        library.entry_deleted(self.db, EntryStub(1))
+        library.drain()
+        self.assertEquals({}, library.artists['values'])
+        self.assertEquals({}, library.entries)
+
+    def test_handler_indexes_the_loaded_db(self):
+        def foreach(function, data):
+            function(EntryStub(1, artist='guy', play_count=3), data)
+        self.db.entry_foreach.side_effect = foreach
+        rb = RBHandler(self.shell)
+        rb.library.drain()
+        self.assertEquals({'guy': 3}, rb.library.artists['values'])
+
+    def library_of(self, *artists):
+        library = Library()
+        self.add(library, *[EntryStub(entry_id, artist=artist, play_count=count)
+            for entry_id, (artist, count) in enumerate(artists)])
+        return library
+
+    def test_select_sorts_by_count_then_name(self):
+        library = self.library_of(('b', 5), ('a', 5), ('c', 9), ('d', 1))
+        page = library.select('artists', first=1, limit=2)
+        self.assertEquals([('a', 5), ('b', 5)], list(page['values'].items()))
+        self.assertEquals(4, page['total'])
+        self.assertEquals(9, page['max'])
+
+    def test_select_by_name_with_prefix(self):
+        library = self.library_of(('Beatles', 5), ('beach boys', 7), ('Blur', 9), ('abba', 1))
+        page = library.select('artists', sort='name', prefix='BEA')
+        self.assertEquals(['beach boys', 'Beatles'], list(page['values']))
+        page = library.select('artists', prefix='bea')
+        self.assertEquals(['beach boys', 'Beatles'], list(page['values']))
+        self.assertEquals(2, page['total'])
+
+    def test_select_follows_changes(self):
+        library = self.library_of(('a', 5), ('b', 3))
+        self.assertEquals(['a', 'b'], list(library.select('artists')['values']))
+        library.entry_changed(self.db, EntryStub(1, artist='b', play_count=8), [])
+        library.entry_deleted(self.db, EntryStub(0))
+        library.drain()
+        self.assertEquals({'b': 8}, library.select('artists')['values'])
+        self.assertEquals(['b'], list(library.select('artists', sort='name')['values']))
+
+    def test_suggest_ranks_a_prefix_by_play_count(self):
+        library = self.library_of(('Beatles', 5), ('beach boys', 7), ('Beck', 9), ('Blur', 20))
+        self.assertEquals([('Beck', 9), ('beach boys', 7)], library.suggest('artists', 'BE', 2))
+        self.assertEquals([], library.suggest('artists', 'x'))
+
+    def test_suggestions_are_cached_until_the_table_changes(self):
+        library = self.library_of(('Beatles', 5), ('Beck', 9))
+        first = library.suggest('artists', 'be')
+        self.assertIs(first, library.suggest('artists', 'be'))
+        library.entry_changed(self.db, EntryStub(0, artist='Beatles', play_count=15), [])
+        library.drain()
+        self.assertEquals([('Beatles', 15), ('Beck', 9)], library.suggest('artists', 'be'))
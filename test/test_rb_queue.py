@@ -32,16 +32,18 @@ class TestRBHandleQueue(unittest.TestCase):
         self.shell.props.queue_source.add_entry.assert_has_calls([
             call(1, -1)])
 
-    def test_shuffle_queue(self):
-        self.shell.props.queue_source.props.query_model = ModelStub(
-            EntryStub(1), EntryStub(2), EntryStub(3))
+    @patch('rhythmweb.rb.random.shuffle')
+    def test_shuffle_queue(self, shuffle):
+        entries = [EntryStub(1), EntryStub(2), EntryStub(3)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
+        shuffle.side_effect = lambda order: order.reverse()
         rb = Queue(self.shell)
         rb.shuffle_queue()
-        expected = set([1, 2, 3])
-        for args in self.shell.props.queue_source.move_entry.call_args_list:
-            key = args[0][0]
-            expected.remove(key)
-        self.assertTrue(not expected)
+        self.shell.props.queue_source.move_entry.assert_has_calls([
+            call(entries[2], 0), call(entries[1], 1)])
+        self.assertEquals(2, self.shell.props.queue_source.move_entry.call_count)
+        self.assertFalse(self.db.entry_lookup_by_id.called)
+        self.shell.props.queue_source.queue_draw.assert_called_once_with()
 
     def test_dequeue_one_works_ok(self):
         self.shell.props.queue_source.props.query_model = ModelStub(
@@ -60,12 +62,14 @@ class TestRBHandleQueue(unittest.TestCase):
             call(1), call(2)])
 
     def test_clear_play_queue_works_ok(self):
-        self.shell.props.queue_source.props.query_model = ModelStub(
-            EntryStub(1), EntryStub(2), EntryStub(3))
+        entries = [EntryStub(1), EntryStub(2), EntryStub(3)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
         rb = Queue(self.shell)
         rb.clear_play_queue()
         self.shell.props.queue_source.remove_entry.assert_has_calls([
-            call(1), call(2), call(3)])
+            call(entries[0]), call(entries[1]), call(entries[2])])
+        self.assertFalse(self.db.entry_lookup_by_id.called)
+        self.shell.props.queue_source.queue_draw.assert_called_once_with()
 
     def test_get_play_queue_works(self):
         self.shell.props.queue_source.props.query_model = ModelStub(
@@ -75,3 +79,41 @@ class TestRBHandleQueue(unittest.TestCase):
         self.assertEquals(play_queue[0].id, 1)
         self.assertEquals(play_queue[1].id, 2)
         self.assertEquals(play_queue[2].id, 5)
+
+    def test_update_queue_looks_up_once_and_draws_once(self):
+        entries = [EntryStub(1), EntryStub(2), EntryStub(3)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
+        rb = Queue(self.shell)
+        rb.update_queue(add=['4', '5', '4'], remove=['2', '2'])
+        self.shell.props.queue_source.remove_entry.assert_called_once_with(2)
+        self.assertEquals([call(4, -1), call(5, -1)],
+            self.shell.props.queue_source.add_entry.call_args_list)
+        self.assertEquals([call(4), call(5), call(2)], self.db.entry_lookup_by_id.call_args_list)
+        self.shell.props.queue_source.queue_draw.assert_called_once_with()
+
+    def test_update_queue_replaces_the_queue(self):
+        entries = [EntryStub(1), EntryStub(2)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
+        rb = Queue(self.shell)
+        rb.update_queue(replace=['7', '8'])
+        self.shell.props.queue_source.remove_entry.assert_has_calls([
+            call(entries[0]), call(entries[1])])
+        self.shell.props.queue_source.add_entry.assert_has_calls([
+            call(7, -1), call(8, -1)])
+
+    def test_update_queue_moves_entries_to_positions(self):
+        entries = [EntryStub(1), EntryStub(2), EntryStub(3), EntryStub(4)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
+        rb = Queue(self.shell)
+        rb.update_queue(move=[('4', '0'), ('1', '9')])
+        self.shell.props.queue_source.move_entry.assert_has_calls([
+            call(entries[3], 0), call(entries[1], 1), call(entries[2], 2)])
+        self.shell.props.queue_source.queue_draw.assert_called_once_with()
+
+    def test_reorder_queue_puts_the_entries_first(self):
+        entries = [EntryStub(1), EntryStub(2), EntryStub(3)]
+        self.shell.props.queue_source.props.query_model = ModelStub(*entries)
+        rb = Queue(self.shell)
+        rb.reorder_queue(['3', '9', '1'])
+        self.shell.props.queue_source.move_entry.assert_called_once_with(entries[2], 0)
+        self.assertFalse(self.db.entry_lookup_by_id.called)
@@ -1,8 +1,8 @@
 import unittest
 
 from mock import Mock, MagicMock, patch, call
-from rhythmweb.rb import RBHandler, InvalidQueryException
-from utils import ModelStub
+from rhythmweb.rb import RBHandler, Cursors, QueryCache, InvalidQueryException
+from utils import ModelStub, EntryStub
 
 
 @patch('gi.repository.RB.RhythmDBQueryModel.new_empty')
@@ -107,13 +107,15 @@ class TestRBHandleSearch(unittest.TestCase):
         self.db.query_append_params.assert_has_calls([
             call(array, 'FUZZY', 'GENRE_FOLDED', 'a nice genre')])
 
-    def test_query_for_all_works(self, ptr_array, query_model):
+    @patch('rhythmweb.rb.GLib')
+    def test_query_for_all_searches_the_db_while_indexing(self, glib, ptr_array, query_model):
         item = Mock()
         array, model = Mock(), ModelStub(item)
         query_model.return_value = model
-        ptr_array.return_value = array
+        glib.PtrArray.return_value = array
 
         rb = RBHandler(self.shell)
+        rb.library.entry_added(self.db, EntryStub(1))
         rb.query({'all': 'calabazas'})
         self.db.do_full_query_parsed.assert_called_with(model, array)
         self.db.query_append_params.assert_has_calls([
@@ -127,6 +129,121 @@ class TestRBHandleSearch(unittest.TestCase):
             call(array, 'FUZZY', 'GENRE_FOLDED', 'calabazas'),
             ])
 
+    @patch('rhythmweb.rb.GLib')
+    def test_query_for_all_uses_the_index(self, glib, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        for entry_id, title in enumerate(('calabazas one', 'other', 'calabazas two', 'calabazas three')):
+            rb.library.entry_added(self.db, EntryStub(entry_id, artist='guy', title=title))
+        rb.library.drain()
+        entries = {}
+        for entry_id in range(4):
+            entry = Mock()
+            entry.get_ulong.return_value = entry_id
+            entry.get_entry_type.return_value = 'song' if entry_id != 2 else 'iradio'
+            entries[entry_id] = entry
+        self.db.entry_lookup_by_id.side_effect = entries.get
+        result = [entry.id for entry in rb.query({'all': 'Calabazas', 'limit': '1', 'first': '1'})]
+        self.assertEquals([3], result)
+        self.assertFalse(self.db.do_full_query_parsed.called)
+
+    @patch('rhythmweb.rb.GLib')
+    def test_fuzzy_query_tolerates_typos_in_any_field(self, glib, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        rb.library.entry_added(self.db, EntryStub(1, artist='The Beatles', title='Something'))
+        rb.library.entry_added(self.db, EntryStub(2, artist='Radiohead', title='Airbag'))
+        rb.library.drain()
+        entries = {}
+        for entry_id in (1, 2):
+            entry = Mock()
+            entry.get_ulong.return_value = entry_id
+            entry.get_entry_type.return_value = 'song'
+            entries[entry_id] = entry
+        self.db.entry_lookup_by_id.side_effect = entries.get
+        self.assertEquals([1], [entry.id for entry in rb.query({'all': 'beatels', 'fuzzy': '1'})])
+        self.assertEquals([2], [entry.id for entry in rb.query({'artist': 'radiohaed', 'fuzzy': '1'})])
+        self.assertEquals([], list(rb.query({'all': 'beatels'})))
+        self.assertFalse(self.db.do_full_query_parsed.called)
+
+    @patch('rhythmweb.rb.GLib')
+    def test_relevance_sort_ranks_and_boosts_the_matches(self, glib, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        songs = ((1, 'Yesterday', 'Beatles Tribute', 0, 0),
+                 (2, 'Beatles', 'Help', 0, 0),
+                 (3, 'Beatles', 'Let It Be', 5, 40),
+                 (4, 'Other', 'Beatles Medley', 0, 0))
+        entries = {}
+        for entry_id, artist, title, rating, play_count in songs:
+            rb.library.entry_added(self.db, EntryStub(entry_id, artist=artist, title=title))
+            entry = Mock()
+            entry.get_entry_type.return_value = 'song'
+            entry.get_ulong.side_effect = {'id': entry_id, 'play_count': play_count}.get
+            entry.get_double.return_value = rating
+            entries[entry_id] = entry
+        rb.library.drain()
+        self.db.entry_lookup_by_id.side_effect = entries.get
+        result = [entry.id for entry in rb.query({'all': 'beatles', 'sort': 'relevance'})]
+        self.assertEquals([3, 2, 4, 1], result)
+        result = [entry.id for entry in rb.query({'all': 'beatles', 'sort': 'relevance', 'first': '1', 'limit': '2'})]
+        self.assertEquals([2, 4], result)
+        self.assertFalse(self.db.do_full_query_parsed.called)
+
+    def test_query_with_unknown_sort_fails(self, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        with self.assertRaises(InvalidQueryException):
+            rb.query({'all': 'beatles', 'sort': 'year'})
+
+    @patch('rhythmweb.rb.GLib')
+    def test_cursor_pages_resume_the_search(self, glib, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        for entry_id in range(5):
+            rb.library.entry_added(self.db, EntryStub(entry_id, artist='guy', title='calabazas'))
+        rb.library.drain()
+        looked_up = []
+        def lookup(entry_id):
+            looked_up.append(entry_id)
+            entry = Mock()
+            entry.get_ulong.return_value = entry_id
+            entry.get_entry_type.return_value = 'song'
+            return entry
+        self.db.entry_lookup_by_id.side_effect = lookup
+        page, cursor = rb.query_cursor({'all': 'calabazas', 'cursor': 'new', 'limit': '2', 'first': '1'})
+        self.assertEquals([1, 2], [entry.id for entry in page])
+        self.assertEquals([0, 1, 2], looked_up)
+        page, cursor = rb.query_cursor({'cursor': cursor, 'limit': '2'})
+        self.assertEquals([3, 4], [entry.id for entry in page])
+        self.assertEquals([0, 1, 2, 3, 4], looked_up)
+        page, cursor = rb.query_cursor({'cursor': cursor, 'limit': '2'})
+        self.assertEquals([], page)
+        self.assertIsNone(cursor)
+
+    @patch('rhythmweb.rb.GLib')
+    def test_cursors_expire_when_the_db_changes(self, glib, ptr_array, query_model):
+        rb = RBHandler(self.shell)
+        cursor = rb.cursors.open(iter(range(10)), rb.library.generation)
+        rb.library.entry_changed(self.db, EntryStub(1))
+        with self.assertRaises(InvalidQueryException):
+            rb.query_cursor({'cursor': cursor, 'limit': '2'})
+
+    def test_same_normalized_query_is_read_from_the_cache(self, ptr_array, query_model):
+        entries = dict((entry_id, EntryStub(entry_id)) for entry_id in (3, 5))
+        query_model.return_value = ModelStub(entries[3], entries[5])
+        self.db.entry_lookup_by_id.side_effect = entries.get
+        rb = RBHandler(self.shell)
+        self.assertEquals([3, 5], [entry.id for entry in rb.query({'artist': 'Calabazas  Uno'})])
+        self.assertEquals([3, 5], [entry.id for entry in rb.query({'artist': ' calabazas uno'})])
+        self.assertEquals(1, self.db.do_full_query_parsed.call_count)
+        self.assertEquals((1, 1), (rb.query_cache.hits, rb.query_cache.misses))
+        rb.query({'artist': 'calabazas uno', 'exact-match': 'true'})
+        self.assertEquals(2, self.db.do_full_query_parsed.call_count)
+
+    def test_query_cache_is_dropped_when_the_db_changes(self, ptr_array, query_model):
+        query_model.return_value = ModelStub(EntryStub(3))
+        rb = RBHandler(self.shell)
+        list(rb.query({'genre': 'rock'}))
+        rb.library.entry_deleted(self.db, EntryStub(3))
+        list(rb.query({'genre': 'rock'}))
+        self.assertEquals(2, self.db.do_full_query_parsed.call_count)
+
     def test_search_with_no_filters_returns_empty_list(self, ptr_array, query_model):
         rb = RBHandler(self.shell)
         result = rb.query({})
@@ -138,3 +255,67 @@ class TestRBHandleSearch(unittest.TestCase):
         self.assertListEqual(result, [])
 
 
+class TestCursors(unittest.TestCase):
+
+    def test_reads_pages_until_exhausted(self):
+        cursors = Cursors()
+        cursor = cursors.open(iter(range(5)), 1)
+        self.assertEquals(([0, 1, 2], cursor), cursors.read(cursor, 3, 1))
+        self.assertEquals(([3, 4], None), cursors.read(cursor, 3, 1))
+        self.assertRaises(InvalidQueryException, cursors.read, cursor, 3, 1)
+
+    def test_no_limit_reads_everything(self):
+        cursors = Cursors()
+        cursor = cursors.open(iter(range(5)), 1)
+        self.assertEquals((list(range(5)), None), cursors.read(cursor, 0, 1))
+
+    def test_least_recently_used_are_evicted(self):
+        cursors = Cursors(size=2)
+        first = cursors.open(iter(range(5)), 1)
+        second = cursors.open(iter(range(5)), 1)
+        cursors.read(first, 1, 1)
+        cursors.open(iter(range(5)), 1)
+        self.assertIn(first, cursors.cursors)
+        self.assertNotIn(second, cursors.cursors)
+
+    @patch('rhythmweb.rb.time')
+    def test_unused_cursors_expire(self, time):
+        time.time.return_value = 100
+        cursors = Cursors(ttl=10)
+        cursor = cursors.open(iter(range(5)), 1)
+        time.time.return_value = 111
+        self.assertRaises(InvalidQueryException, cursors.read, cursor, 1, 1)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def entries(self, *entry_ids):
+        return [Mock(id=entry_id) for entry_id in entry_ids]
+
+    def test_ids_are_cached_once_every_entry_is_read(self):
+        cache = QueryCache()
+        self.assertIsNone(cache.get('key', 1))
+        entries = cache.record('key', 1, iter(self.entries(1, 2)))
+        next(entries)
+        self.assertNotIn('key', cache.results)
+        list(entries)
+        self.assertEquals([1, 2], cache.get('key', 1))
+        self.assertEquals((1, 1), (cache.hits, cache.misses))
+
+    def test_a_new_generation_drops_every_result(self):
+        cache = QueryCache()
+        cache.get('key', 1)
+        list(cache.record('key', 1, iter(self.entries(1))))
+        self.assertIsNone(cache.get('key', 2))
+        list(cache.record('other', 1, iter(self.entries(1))))
+        self.assertNotIn('other', cache.results)
+
+    def test_least_recently_used_and_large_results_are_not_kept(self):
+        cache = QueryCache(size=2, max_entries=2)
+        for key in ('a', 'b'):
+            cache.get(key, 1)
+            list(cache.record(key, 1, iter(self.entries(1))))
+        cache.get('a', 1)
+        list(cache.record('c', 1, iter(self.entries(1))))
+        list(cache.record('d', 1, iter(self.entries(1, 2, 3))))
+        self.assertEquals(['a', 'c'], list(cache.results))
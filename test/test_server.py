@@ -1,9 +1,14 @@
 
+import json
 import unittest
 
+from collections import defaultdict
+
 from mock import Mock, patch
 from io import BytesIO
-from rhythmweb.server import Server
+from rhythmweb.server import Server, Response, stream_json, header_value, is_large
+from rhythmweb.server import iter_cbor, as_plain
+from rhythmweb.server import parse_frame, encode_frame, WebSocket, WebSocketError, WRITE_SIZE
 from rhythmweb.app import app, route
 
 
@@ -63,6 +68,103 @@ class TestNewServer(unittest.TestCase):
             'key1': 'value1,value3,value5'})
 
 
+class TestStreamJson(unittest.TestCase):
+
+    def test_nested_lists_are_encoded_in_chunks(self):
+        content = {'playlists': [
+            {'id': i, 'entries': [{'id': j, 'title': 'x' * 100} for j in range(300)]}
+            for i in range(5)]}
+        chunks = list(stream_json(content))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(content, json.loads(b''.join(chunks).decode('UTF-8')))
+
+    def test_generators_are_encoded_as_lists(self):
+        content = {'entries': (i for i in range(3)), 'empty': []}
+        result = b''.join(stream_json(content)).decode('UTF-8')
+        self.assertEquals({'entries': [0, 1, 2], 'empty': []}, json.loads(result))
+
+    def test_large_dicts_and_nested_generators_are_streamed(self):
+        self.assertTrue(is_large({'values': dict((str(i), i) for i in range(20000))}))
+        self.assertTrue(is_large({'entries': [{'songs': (i for i in range(2))}]}))
+        self.assertFalse(is_large({'values': {'a': 1}, 'max': 1}))
+
+
+class TestResponseHeaders(unittest.TestCase):
+
+    def test_client_error_message_is_not_sent_in_status(self):
+        function = Mock()
+        body = Response(function).reply_with_client_error(
+                ValueError('bad\r\nSet-Cookie: x=1'))
+        function.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals([b'bad\r\nSet-Cookie: x=1'], body)
+
+    def test_header_values_cannot_break_lines(self):
+        self.assertEquals('a Set-Cookie: x=1', header_value('a\r\nSet-Cookie: x=1'))
+        self.assertEquals('200 OK', header_value('200 OK'))
+
+
+class TestContentNegotiation(unittest.TestCase):
+
+    def reply(self, accept, content):
+        function = Mock()
+        body = Response(function, {'HTTP_ACCEPT': accept}).reply_with_json(content)
+        return function.call_args[0][1], b''.join(body)
+
+    def test_cbor_encodes_every_kind_of_value(self):
+        samples = ((0, '00'), (23, '17'), (24, '1818'), (1000, '1903e8'),
+            (1000000000000, '1b000000e8d4a51000'), (-1, '20'), (-1000, '3903e7'),
+            (18446744073709551616, 'c249010000000000000000'),
+            (-18446744073709551617, 'c349010000000000000000'),
+            (1.1, 'fb3ff199999999999a'), (True, 'f5'), (False, 'f4'), (None, 'f6'),
+            ('IETF', '6449455446'), ([1, [2, 3]], '8201820203'),
+            ({'a': 1, 'b': [2, 3]}, 'a26161016162820203'),
+            ((i for i in (1, 2)), '9f0102ff'), (b'{"a": [1]}', 'a161618101'))
+        for value, expected in samples:
+            self.assertEquals(expected, b''.join(iter_cbor(value)).hex())
+
+    def test_cbor_defaultdicts_are_maps(self):
+        content = defaultdict(list)
+        content['entries'].append({'id': 1})
+        self.assertEquals('a167656e7472696573' + '81a1626964' + '01',
+            b''.join(iter_cbor(content)).hex())
+
+    def test_json_is_the_default(self):
+        for accept in ('', '*/*', 'application/json, application/cbor',
+                'application/cbor;q=0.5, */*'):
+            headers, body = self.reply(accept, {'a': 1})
+            self.assertEquals('application/json; charset=UTF-8', dict(headers)['Content-type'])
+
+    def test_cbor_when_preferred(self):
+        headers, body = self.reply('application/cbor, */*;q=0.1', {'a': 1})
+        self.assertEquals([('Content-type', 'application/cbor'),
+            ('Cache-Control', 'no-cache'), ('Vary', 'Accept')], headers)
+        self.assertEquals('a1616101', body.hex())
+
+    def test_large_cbor_is_streamed(self):
+        headers, body = self.reply('application/cbor',
+            {'entries': ({'id': i} for i in range(3))})
+        self.assertEquals(('Vary', 'Accept, Accept-Encoding'), headers[-1])
+        self.assertEquals('a167656e7472696573' + '9f' + 'a1626964' + '00'
+            + 'a1626964' + '01' + 'a1626964' + '02' + 'ff', body.hex())
+
+    @patch('rhythmweb.server.msgpack', None)
+    def test_msgpack_is_only_offered_when_installed(self):
+        headers, body = self.reply('application/msgpack', {'a': 1})
+        self.assertEquals('application/json; charset=UTF-8', dict(headers)['Content-type'])
+
+    @patch('rhythmweb.server.msgpack')
+    def test_msgpack_when_preferred(self, msgpack):
+        msgpack.packb.return_value = b'packed'
+        headers, body = self.reply('application/x-msgpack', {'a': (i for i in range(2))})
+        self.assertEquals('application/x-msgpack', dict(headers)['Content-type'])
+        self.assertEquals(b'packed', body)
+        msgpack.packb.assert_called_with({'a': [0, 1]}, use_bin_type=True)
+
+    def test_plain_content_reads_generators_and_json_bytes(self):
+        content = {'entries': (i for i in range(2)), 'status': b'{"playing": true}'}
+        self.assertEquals({'entries': [0, 1], 'status': {'playing': True}}, as_plain(content))
+
 
 @route('/something/<argument>')
 def try_one_path_argument(argument):
@@ -71,3 +173,137 @@ def try_one_path_argument(argument):
 @route('/path/with/kwargs')
 def path_with_kwargs(**kwargs):
     return kwargs
+
+
+def client_frame(opcode, payload, fin=True, mask=b'\x01\x02\x03\x04'):
+    length = len(payload)
+    header = bytearray([(0x80 if fin else 0) | opcode])
+    if length < 126:
+        header.append(0x80 | length)
+    else:
+        header.append(0x80 | 126)
+        header.extend(length.to_bytes(2, 'big'))
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return bytes(header) + mask + masked
+
+
+class TestWebSocketFrames(unittest.TestCase):
+
+    def test_masked_frame_is_parsed(self):
+        data = bytearray(client_frame(0x1, b'hello') + b'next')
+        self.assertEquals((True, 0x1, b'hello', 11), parse_frame(data))
+
+    def test_extended_length_frame_is_parsed(self):
+        payload = b'x' * 300
+        fin, opcode, parsed, size = parse_frame(bytearray(client_frame(0x1, payload)))
+        self.assertEquals(payload, parsed)
+        self.assertEquals(308, size)
+
+    def test_incomplete_frame_waits(self):
+        data = client_frame(0x1, b'hello')
+        self.assertIsNone(parse_frame(bytearray(data[:1])))
+        self.assertIsNone(parse_frame(bytearray(data[:-1])))
+
+    def test_unmasked_frame_fails(self):
+        with self.assertRaises(WebSocketError) as e:
+            parse_frame(bytearray(b'\x81\x05hello'))
+        self.assertEquals(1002, e.exception.code)
+
+    def test_server_frames_are_not_masked(self):
+        self.assertEquals(b'\x81\x02hi', encode_frame(0x1, b'hi'))
+        frame = encode_frame(0x1, b'x' * 200)
+        self.assertEquals(b'\x81\x7e\x00\xc8', frame[:4])
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = Mock()
+        self.connection.input = bytearray()
+        self.connection.output = bytearray()
+        self.stream = Mock()
+        self.stream.pop.return_value = [('status', '{"playing": false, "volume": 1}')]
+        self.websocket = WebSocket(self.connection, self.stream)
+        self.stream.pop.return_value = []
+
+    def sent(self):
+        messages = []
+        data = bytes(self.connection.output)
+        while data:
+            length = data[1]
+            messages.append((data[0] & 0x0F, data[2:2 + length]))
+            data = data[2 + length:]
+        del self.connection.output[:]
+        return messages
+
+    def receive(self, *frames):
+        self.connection.input.extend(b''.join(frames))
+        self.websocket.process_input()
+
+    def test_initial_status_is_sent(self):
+        opcode, message = self.sent()[0]
+        self.assertEquals(0x1, opcode)
+        self.assertEquals({'status' : {'playing' : False, 'volume' : 1}}, json.loads(message.decode('UTF-8')))
+
+    def test_only_changed_fields_are_pushed(self):
+        self.sent()
+        self.stream.pop.return_value = [('status', '{"playing": false, "volume": 0.5}')]
+        self.websocket.push_events()
+        message = json.loads(self.sent()[0][1].decode('UTF-8'))
+        self.assertEquals({'status' : {'volume' : 0.5}}, message)
+
+    def test_pushes_wait_for_slow_clients(self):
+        self.sent()
+        self.stream.pop.reset_mock()
+        self.connection.output.extend(b'x' * (WRITE_SIZE + 1))
+        self.websocket.push_events()
+        self.assertFalse(self.stream.pop.called)
+        del self.connection.output[:]
+        self.stream.pop.return_value = [('status', '{"playing": true, "volume": 1}')]
+        self.websocket.flushed()
+        message = json.loads(self.sent()[0][1].decode('UTF-8'))
+        self.assertEquals({'status' : {'playing' : True}}, message)
+        self.websocket.flushed()
+        self.assertEquals(1, self.stream.pop.call_count)
+
+    @patch('rhythmweb.server.app')
+    def test_command_is_routed_to_player(self, app):
+        self.sent()
+        app.route.return_value = {'playing' : True, 'volume' : 1, 'last_action' : 'play_pause'}
+        self.receive(client_frame(0x1, b'{"id": 7, "action": "enqueue", "entry_id": [1, 2]}'))
+        app.route.assert_called_with('/rest/player', action='enqueue', entry_id='1,2')
+        message = json.loads(self.sent()[0][1].decode('UTF-8'))
+        self.assertEquals({'id' : 7, 'action' : 'play_pause', 'status' : {'playing' : True}}, message)
+
+    @patch('rhythmweb.server.app')
+    def test_invalid_command_replies_error(self, app):
+        self.sent()
+        app.route.side_effect = ValueError('No action')
+        self.receive(client_frame(0x1, b'{"id": 1}'))
+        message = json.loads(self.sent()[0][1].decode('UTF-8'))
+        self.assertEquals({'id' : 1, 'error' : 'No action'}, message)
+
+    @patch('rhythmweb.server.app')
+    def test_fragmented_message_is_joined(self, app):
+        self.sent()
+        app.route.return_value = {'playing' : False, 'volume' : 1, 'last_action' : 'next'}
+        self.receive(client_frame(0x1, b'{"action": ', fin=False),
+            client_frame(0x9, b'ping'),
+            client_frame(0x0, b'"next"}'))
+        app.route.assert_called_with('/rest/player', action='next')
+        self.assertEquals((0xA, b'ping'), self.sent()[0])
+
+    def test_close_is_answered_and_unsubscribes(self):
+        self.sent()
+        self.receive(client_frame(0x8, b'\x03\xe8'))
+        self.assertEquals([(0x8, b'\x03\xe8')], self.sent())
+        self.assertTrue(self.stream.close.called)
+        self.websocket.flushed()
+        self.assertTrue(self.connection.close.called)
+
+    def test_binary_message_closes_with_unsupported(self):
+        self.sent()
+        self.receive(client_frame(0x2, b'data'))
+        opcode, payload = self.sent()[0]
+        self.assertEquals(0x8, opcode)
+        self.assertEquals(1003, int.from_bytes(payload[:2], 'big'))
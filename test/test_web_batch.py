@@ -0,0 +1,105 @@
+import unittest
+import json
+
+from mock import Mock
+from urllib.parse import quote
+from rhythmweb import view, controller, rb
+from rhythmweb.server import Server
+from utils import Stub, environ, handle_request, mock_snapshot
+
+class TestWebBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.rb = Mock(spec=rb.RBHandler)
+        controller.rb_handler['rb'] = self.rb
+        self.rb.library.progress.return_value = None
+        controller.status_cache.clear()
+        mock_snapshot(self.rb)
+        self.response = Mock()
+        self.app = Server()
+
+    def batch(self, requests):
+        post = 'requests={}'.format(quote(json.dumps(requests)))
+        return handle_request(self.app, environ('/rest/batch', post), self.response)
+
+    def test_requests_are_answered_in_order(self):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        self.rb.library.artists = {'values' : {'a guy' : 55}, 'max': 55}
+        self.rb.library.genres = {'values' : {'rock' : 5}, 'max': 5}
+        result = self.batch([
+            {'path' : '/rest/status'},
+            {'method' : 'GET', 'path' : '/rest/library/artists'},
+            {'path' : '/rest/library/genres'}])
+        self.response.assert_called_with('200 OK',
+                [('Content-type', 'application/json; charset=UTF-8'),
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
+        returned = json.loads(result)
+        self.assertEquals([200, 200, 200], [item['status'] for item in returned])
+        self.assertEquals('linear', returned[0]['body']['playing_order'])
+        self.assertEquals({'a guy' : 55}, returned[1]['body']['values'])
+        self.assertEquals(5, returned[2]['body']['max'])
+
+    def test_post_params_are_passed_as_form_values(self):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        result = self.batch([{'method' : 'POST', 'path' : '/rest/player',
+            'params' : {'action' : 'seek', 'time' : 10}}])
+        self.rb.seek.assert_called_with(10)
+        returned = json.loads(result)
+        self.assertEquals('seek', returned[0]['body']['last_action'])
+
+    def test_errors_have_their_own_status(self):
+        self.rb.get_entry.return_value = None
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        controller.rb_handler.pop('events', None)
+        result = self.batch([
+            {'path' : '/rest/song/1'},
+            {'path' : '/rest/library/calabaza'},
+            {'method' : 'POST', 'path' : '/rest/player'},
+            {'method' : 'DELETE', 'path' : '/rest/queue'},
+            {'path' : '/rest/batch'},
+            {'path' : '/rest/events'},
+            'nonsense'])
+        returned = json.loads(result)
+        self.assertEquals([404, 400, 405, 405, 405, 400, 400],
+            [item['status'] for item in returned])
+        self.assertEquals('Invalid library filter "calabaza"', returned[1]['error'])
+
+    def test_get_requests_do_not_take_params(self):
+        self.rb.library.genres = {'values' : {'rock' : 5}, 'max': 5}
+        result = self.batch([
+            {'path' : '/rest/player', 'params' : {'action' : 'next'}},
+            {'path' : '/rest/player?action=next'},
+            {'path' : '/rest/library/genres?_='}])
+        self.assertFalse(self.rb.play_next.called)
+        returned = json.loads(result)
+        self.assertEquals([405, 405, 200], [item['status'] for item in returned])
+
+    def test_nested_batch_is_found_by_route(self):
+        result = self.batch([{'path' : '/rest/batch/?requests=[]'},
+            {'method' : 'POST', 'path' : '/rest/batch/', 'params' : {'requests' : '[]'}}])
+        returned = json.loads(result)
+        self.assertEquals([405, 405], [item['status'] for item in returned])
+
+    def test_requests_must_be_a_list(self):
+        result = self.batch({'path' : '/rest/status'})
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('requests must be a json list', result)
+
+    def test_batch_size_is_limited(self):
+        self.batch([{'path' : '/rest/status'}] * 21)
+        self.assertTrue(self.response.call_args[0][0].startswith('400'))
+
+    def test_get_is_not_allowed(self):
+        handle_request(self.app, environ('/rest/batch'), self.response)
+        self.assertTrue(self.response.call_args[0][0].startswith('405'))
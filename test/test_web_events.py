@@ -0,0 +1,100 @@
+import unittest
+import json
+
+from mock import Mock, patch
+from rhythmweb import view, controller, rb
+from utils import environ, mock_snapshot
+from rhythmweb.server import Server
+
+class TestWebEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.rb = Mock(spec=rb.RBHandler)
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = 1
+        mock_snapshot(self.rb)
+        self.rb.state_version = 1
+        controller.rb_handler['rb'] = self.rb
+        controller.status_cache.clear()
+        controller.rb_handler.pop('events', None)
+        self.response = Mock()
+        self.app = Server()
+        self.glib = patch('rhythmweb.controller.GLib').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def subscribe(self):
+        env = environ('/rest/events')
+        env['rhythmweb.resume'] = Mock()
+        return self.app.handle_request(env, self.response), env['rhythmweb.resume']
+
+    def test_subscribe_sends_current_status(self):
+        body, resume = self.subscribe()
+        self.response.assert_called_with('200 OK', [
+            ('Content-type', 'text/event-stream; charset=UTF-8'),
+            ('Cache-Control', 'no-cache')])
+        chunk = next(body).decode('UTF-8')
+        self.assertTrue(chunk.startswith('retry: 3000\n\n'))
+        self.assertIn('event: status\ndata: ', chunk)
+        data = chunk.split('data: ')[1].strip()
+        self.assertEquals('linear', json.loads(data)['playing_order'])
+        self.assertEquals(b'', next(body))
+
+    def test_changes_are_coalesced_per_subscriber(self):
+        body, resume = self.subscribe()
+        next(body)
+        events = controller.get_events()
+        events.state_changed('player', 2)
+        events.state_changed('player', 3)
+        events.state_changed('queue', 4)
+        self.assertEquals(1, self.glib.idle_add.call_count)
+        self.rb.get_volume.return_value = 0.5
+        self.rb.state_version = 2
+        events.flush()
+        self.assertTrue(resume.called)
+        chunk = next(body).decode('UTF-8')
+        self.assertEquals(1, chunk.count('event: status'))
+        self.assertIn('"volume": 0.5', chunk)
+        self.assertIn('event: queue', chunk)
+        self.assertEquals(b'', next(body))
+
+    def test_slow_subscriber_only_gets_latest_status(self):
+        body, resume = self.subscribe()
+        events = controller.get_events()
+        for version, volume in enumerate((0.1, 0.2, 0.3), 2):
+            self.rb.get_volume.return_value = volume
+            self.rb.state_version = version
+            events.state_changed('player', 2)
+            events.flush()
+        chunk = next(body).decode('UTF-8')
+        self.assertEquals(1, chunk.count('event: status'))
+        self.assertIn('"volume": 0.3', chunk)
+
+    def test_heartbeat_sends_comment(self):
+        body, resume = self.subscribe()
+        next(body)
+        controller.get_events().heartbeat()
+        self.assertEquals(b':\n\n', next(body))
+
+    def test_closing_the_body_unsubscribes(self):
+        body, resume = self.subscribe()
+        events = controller.get_events()
+        self.assertEquals(1, len(events.subscribers))
+        body.close()
+        self.assertEquals(0, len(events.subscribers))
+        self.assertTrue(self.glib.source_remove.called)
+        events.state_changed('player', 2)
+        self.assertFalse(self.glib.idle_add.called)
+
+    def test_subscribers_over_the_limit_are_rejected(self):
+        self.app.max_subscribers = 1
+        self.subscribe()
+        result, resume = self.subscribe()
+        self.response.assert_called_with('503 Service Unavailable', [
+            ('Content-type', 'text/html; charset=UTF-8'),
+            ('Retry-After', '30')])
+        self.assertEquals([], result)
+        self.assertEquals(1, len(controller.get_events().subscribers))
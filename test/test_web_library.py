@@ -11,6 +11,7 @@ class TestWebLibrary(unittest.TestCase):
     def setUp(self):
         self.rb = Mock(spec=rb.RBHandler)
         controller.rb_handler['rb'] = self.rb
+        self.rb.library.progress.return_value = None
         self.entry = Stub()
         self.response = Mock()
         self.app = Server()
@@ -21,12 +22,45 @@ class TestWebLibrary(unittest.TestCase):
         self.response.assert_called_with('404 NOT FOUND',
                 [('Content-type', 'text/html; charset=UTF-8')])
 
+    def test_progress_is_reported_while_indexing(self):
+        self.rb.library.artists = {'values' : {'a guy' : 55}, 'max': 55}
+        self.rb.library.progress.return_value = 40
+        result = handle_request(self.app, environ('/rest/library/artists'), self.response)
+        self.assertEquals({'values' : {'a guy' : 55}, 'max': 55, 'indexing': 40}, json.loads(result))
+        self.assertEquals({'values' : {'a guy' : 55}, 'max': 55}, self.rb.library.artists)
+
+    def get(self, query):
+        env = environ('/rest/library/artists')
+        env['QUERY_STRING'] = query
+        return handle_request(self.app, env, self.response)
+
+    def test_page_parameters_are_passed_to_the_library(self):
+        self.rb.library.select.return_value = {'values' : {'a guy' : 55}, 'max': 55, 'total' : 1}
+        result = self.get('first=10&limit=5&sort=name&prefix=a&_=1')
+        self.rb.library.select.assert_called_with('artists',
+                first=10, limit=5, sort='name', prefix='a')
+        self.assertEquals(1, json.loads(result)['total'])
+
+    def test_invalid_page_parameters_fail(self):
+        self.assertEquals('sort must be one of count, name', self.get('sort=size'))
+        self.assertEquals('limit must be a number', self.get('limit=x'))
+        self.assertEquals('first must not be negative', self.get('first=-1'))
+        self.assertEquals('400 Bad Request', self.response.call_args[0][0])
+
+    def test_cache_buster_is_ignored(self):
+        self.rb.library.artists = {'values' : {'a guy' : 55}, 'max': 55}
+        env = environ('/rest/library/artists')
+        env['QUERY_STRING'] = '_=123'
+        result = handle_request(self.app, env, self.response)
+        self.assertEquals('200 OK', self.response.call_args[0][0])
+        self.assertEquals({'a guy' : 55}, json.loads(result)['values'])
+
     def test_basic_do_get(self):
         self.rb.library.artists = {'values' : {'a guy' : 55}, 'max': 55}
         result = handle_request(self.app, environ('/rest/library/artists'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{"values": {"a guy": 55}, "max": 55}')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -34,5 +68,6 @@ class TestWebLibrary(unittest.TestCase):
     def test_invalid_search_type_fails(self):
         self.rb.query.return_value = [self.entry]
         result = handle_request(self.app, environ('/rest/library/calabaza'), self.response)
-        self.response.assert_called_with('400 Bad Request: Invalid library filter "calabaza"',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('Invalid library filter "calabaza"', result)
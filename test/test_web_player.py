@@ -23,22 +23,24 @@ class TestWebPlayer(unittest.TestCase):
 
     def test_do_get_errs(self):
         result = handle_request(self.app, environ('/rest/player'), self.response)
-        self.response.assert_called_with('405 method GET not allowed',
+        self.response.assert_called_with('405 Method Not Allowed',
                 [('Content-type', 'text/html; charset=UTF-8')])
 
     def test_post_without_action_fails(self):
         result = handle_request(self.app, 
                 environ('/rest/player', post_data='actions=invalid'),
                 self.response)
-        self.response.assert_called_with('400 Bad Request: No action', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('No action', result)
 
     def test_post_invalid_action_fails(self):
         result = handle_request(self.app, 
                 environ('/rest/player', post_data='action=invalid'),
                 self.response)
-        self.response.assert_called_with('400 Bad Request: action "invalid" is not supported', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('action "invalid" is not supported', result)
 
     def test_post_play_pause_works(self):
         result = handle_request(self.app, 
@@ -21,7 +21,8 @@ class TestWebPlaylist(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/playlists'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{"playlists": [{"entries": [{"title": "title", "album": "album", "last_played": "last_played", "duration": "duration", "artist": "artist", "play_count": "play_count", "rating": "rating", "location": "location", "bitrate": "bitrate", "track_number": "track_number", "id": "id", "genre": "genre", "year": "year"}], "type": "source_type", "id": "id", "name": "name" }]}')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -33,7 +34,8 @@ class TestWebPlaylist(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/playlists/0'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{ "id" : "id" , "name" : "name" , "type" : "source_type", "entries" : [{"last_played": "last_played", "title": "title", "genre": "genre", "album": "album", "bitrate": "bitrate", "track_number": "track_number", "id": "id", "duration": "duration", "year": "year", "play_count": "play_count", "location": "location", "artist": "artist", "rating": "rating"}]}')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -50,16 +52,18 @@ class TestWebPlaylist(unittest.TestCase):
         self.playlist = Stub(entries=[Stub()])
         self.rb.get_playlists.return_value = [self.playlist]
         result = handle_request(self.app, environ('/rest/playlists/1'), self.response)
-        self.response.assert_called_with('400 Bad Request: there is no playlist with id 1',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('there is no playlist with id 1', result)
         self.rb.get_playlists.assert_called_with()
 
     def test_post_invalid_action(self):
         result = handle_request(self.app, 
                 environ('/rest/playlists', post_data='action=invalid&playlist=0'), 
                 self.response)
-        self.response.assert_called_with('400 Bad Request: Unknown action invalid',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('Unknown action invalid', result)
 
     def test_enqueue_playlist(self):
         self.rb.get_playlists.return_value = [self.playlist]
@@ -69,7 +73,7 @@ class TestWebPlaylist(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "result" : "OK" , "count" : 1 }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -83,7 +87,7 @@ class TestWebPlaylist(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "result" : "OK" }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -97,7 +101,7 @@ class TestWebPlaylist(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "result" : "BAD" }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -111,7 +115,7 @@ class TestWebPlaylist(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "result" : "BAD" }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -123,8 +127,9 @@ class TestWebPlaylist(unittest.TestCase):
         result = handle_request(self.app, 
                 environ('/rest/playlists', post_data='action=play_source&source=10'), 
                 self.response)
-        self.response.assert_called_with('400 Bad Request: there is no playlist with id 10', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('there is no playlist with id 10', result)
 
     def test_play_with_no_source_fails(self):
         self.rb.get_playlists.return_value = [self.playlist]
@@ -132,12 +137,23 @@ class TestWebPlaylist(unittest.TestCase):
         result = handle_request(self.app, 
                 environ('/rest/playlists', post_data='action=play_source'), 
                 self.response)
-        self.response.assert_called_with('400 Bad Request: no "source" parameter', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('no "source" parameter', result)
 
     def test_play_with_no_action_fails(self):
         result = handle_request(self.app, 
                 environ('/rest/playlists', post_data='source=1'), 
                 self.response)
-        self.response.assert_called_with('400 Bad Request: no "action" parameter', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('no "action" parameter', result)
+
+    def test_get_playlist_fields(self):
+        self.playlist = Stub(entries=[Stub()])
+        self.rb.get_playlists.return_value = [self.playlist]
+        env = environ('/rest/playlists/0')
+        env['QUERY_STRING'] = 'fields=id,artist'
+        result = handle_request(self.app, env, self.response)
+        returned = json.loads(result)
+        self.assertEquals([{'id': 'id', 'artist': 'artist'}], returned['entries'])
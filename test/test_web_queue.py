@@ -27,13 +27,44 @@ class TestWebQueue(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/queue'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         returned = json.loads(result)
         self.queue.get_play_queue.assert_called_with()
         for index, entry in enumerate(returned['entries'], 1):
             self.assertEquals(index, entry['id'])
 
-    def test_basic_do_post(self):
+    def test_post_without_changes_fails(self):
         result = handle_request(self.app, environ('/rest/queue', post_data='bla=1'), self.response)
-        self.response.assert_called_with('405 method POST not allowed',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('queue changes are add, remove, move and replace', result)
+
+    def test_post_changes_updates_the_queue_once(self):
+        self.queue.get_play_queue.return_value = [Stub(id=3)]
+        result = handle_request(self.app, environ('/rest/queue',
+                post_data='add=1,2&remove=4&move=3:0,2:1&fields=id'), self.response)
+        self.queue.update_queue.assert_called_once_with([1, 2], [4], [(3, 0), (2, 1)], None)
+        self.assertEquals({'entries': [{'id': 3}]}, json.loads(result))
+
+    def test_post_empty_replace_clears_the_queue(self):
+        self.queue.get_play_queue.return_value = []
+        handle_request(self.app, environ('/rest/queue', post_data='replace='), self.response)
+        self.queue.update_queue.assert_called_once_with((), (), (), [])
+
+    def test_post_invalid_moves_fail(self):
+        result = handle_request(self.app, environ('/rest/queue', post_data='move=3'), self.response)
+        self.assertEquals('moves must be id:position pairs', result)
+        self.assertFalse(self.queue.update_queue.called)
+
+    def test_post_order(self):
+        self.queue.get_play_queue.return_value = []
+        handle_request(self.app, environ('/rest/queue/order', post_data='entries=3,1'), self.response)
+        self.queue.reorder_queue.assert_called_once_with([3, 1])
+
+    def test_get_columnar_queue(self):
+        self.queue.get_play_queue.return_value = [Stub(id=1), Stub(id=2)]
+        env = environ('/rest/queue')
+        env['QUERY_STRING'] = 'format=columnar&fields=id,artist'
+        result = handle_request(self.app, env, self.response)
+        expected = {'fields': ['id', 'artist'], 'rows': [[1, 'artist'], [2, 'artist']]}
+        self.assertEquals(expected, json.loads(result))
@@ -1,5 +1,6 @@
 import unittest
 import json
+import gzip
 
 from mock import Mock
 from rhythmweb import view, controller, rb
@@ -35,3 +36,23 @@ class TestWebStatus(unittest.TestCase):
         result = handle_request(self.app, environ('invalid_file'), self.response)
         self.response.assert_called_with('404 NOT FOUND', 
                 [('Content-type', 'text/html; charset=UTF-8')])
+
+    def test_load_with_matching_etag_returns_not_modified(self):
+        env = environ('/style.css')
+        handle_request(self.app, env, self.response)
+        etag = dict(self.response.call_args[0][1])['ETag']
+        env = environ('/style.css')
+        env['HTTP_IF_NONE_MATCH'] = etag
+        result = handle_request(self.app, env, self.response)
+        self.assertEquals('', result)
+        self.assertEquals('304 Not Modified', self.response.call_args[0][0])
+
+    def test_load_script_with_gzip(self):
+        env = environ('/jquery.js')
+        env['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        result = self.app.handle_request(env, self.response)
+        headers = dict(self.response.call_args[0][1])
+        self.assertEquals('gzip', headers['Content-Encoding'])
+        self.assertEquals('Accept-Encoding', headers['Vary'])
+        self.assertEquals(str(len(result[0])), headers['Content-Length'])
+        self.assertIn(b'jQuery', gzip.decompress(result[0]))
@@ -1,9 +1,10 @@
 import unittest
 import json
+import gzip
 
 from mock import Mock
 from rhythmweb import view, controller, rb
-from rhythmweb.server import Server
+from rhythmweb.server import Server, iter_json
 from rhythmweb.rb import InvalidQueryException
 from utils import Stub, environ, handle_request
 
@@ -14,6 +15,7 @@ class TestWebSearch(unittest.TestCase):
     def setUp(self):
         self.rb = Mock(rb.RBHandler)
         controller.rb_handler['rb'] = self.rb
+        controller.song_fragments.clear()
         self.entry = Stub()
         self.response = Mock()
         self.app = Server()
@@ -23,7 +25,8 @@ class TestWebSearch(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/search'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{ "entries" : [ { "duration" : "duration" , "location" : "location" , "last_played" : "last_played" , "album" : "album" , "title" : "title" , "genre" : "genre" , "year" : "year" , "rating" : "rating" , "id" : "id" , "track_number" : "track_number" , "play_count" : "play_count" , "bitrate" : "bitrate" , "artist" : "artist"  } ] }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -34,7 +37,8 @@ class TestWebSearch(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/search', post_data=''), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{ "entries" : [ { "duration" : "duration" , "location" : "location" , "last_played" : "last_played" , "album" : "album" , "title" : "title" , "genre" : "genre" , "year" : "year" , "rating" : "rating" , "id" : "id" , "track_number" : "track_number" , "play_count" : "play_count" , "bitrate" : "bitrate" , "artist" : "artist"  } ] }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -47,7 +51,8 @@ class TestWebSearch(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         returned = json.loads(result)
         self.assertEquals(5, len(returned['entries']))
         self.rb.query.assert_called_with({ 'type' : 'song', 'limit' : '10', 'first' : '5' })
@@ -59,7 +64,7 @@ class TestWebSearch(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         returned = json.loads(result)
         self.assertEquals({}, returned)
         self.rb.query.assert_called_with({})
@@ -73,7 +78,8 @@ class TestWebSearch(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{ "entries" : [ { "duration" : "duration" , "location" : "location" , "last_played" : "last_played" , "album" : "album" , "title" : "title" , "genre" : "genre" , "year" : "year" , "rating" : "rating" , "id" : "id" , "track_number" : "track_number" , "play_count" : "play_count" , "bitrate" : "bitrate" , "artist" : "artist"  } ] }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -86,7 +92,8 @@ class TestWebSearch(unittest.TestCase):
                 self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache'),
+                    ('Vary', 'Accept-Encoding')])
         expected = json.loads('{ "entries" : [ { "duration" : "duration" , "location" : "location" , "last_played" : "last_played" , "album" : "album" , "title" : "title" , "genre" : "genre" , "year" : "year" , "rating" : "rating" , "id" : "id" , "track_number" : "track_number" , "play_count" : "play_count" , "bitrate" : "bitrate" , "artist" : "artist"  } ] }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -97,6 +104,96 @@ class TestWebSearch(unittest.TestCase):
         result = handle_request(self.app, 
                 environ('/rest/search/song'), 
                 self.response)
-        self.response.assert_called_with('400 Bad Request: Invalid query', 
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('Invalid query', result)
         self.rb.query.assert_called_with({'type': 'song'})
+
+    def test_large_result_is_streamed(self):
+        self.rb.query.return_value = [Stub(id=i) for i in range(500)]
+        result = self.app.handle_request(environ('/rest/search/song'), self.response)
+        self.assertFalse(isinstance(result, list))
+        headers = dict(self.response.call_args[0][1])
+        self.assertNotIn('Content-Encoding', headers)
+        returned = json.loads(b''.join(result).decode('UTF-8'))
+        self.assertEquals(list(range(500)), [entry['id'] for entry in returned['entries']])
+
+    def test_large_result_is_streamed_compressed(self):
+        self.rb.query.return_value = [Stub(id=i) for i in range(500)]
+        env = environ('/rest/search/song')
+        env['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+        result = self.app.handle_request(env, self.response)
+        headers = dict(self.response.call_args[0][1])
+        self.assertEquals('gzip', headers['Content-Encoding'])
+        returned = json.loads(gzip.decompress(b''.join(result)).decode('UTF-8'))
+        self.assertEquals(500, len(returned['entries']))
+
+    def test_search_entries_are_read_while_sent(self):
+        read = []
+        def entries():
+            for i in range(3):
+                read.append(i)
+                yield self.entry
+        self.rb.query.return_value = entries()
+        result = controller.Query().query({'artist': 'uno'})
+        self.assertEquals([0], read)
+        self.assertEquals(3, len(list(result['entries'])))
+        self.assertEquals([0, 1, 2], read)
+
+    def test_search_with_cursor_returns_a_page(self):
+        self.rb.query_cursor.return_value = ([Stub(id=1), Stub(id=2)], 'abc')
+        result = handle_request(self.app,
+                environ('/rest/search/song', post_data='cursor=new&limit=2&artist=uno'),
+                self.response)
+        returned = json.loads(result)
+        self.assertEquals('abc', returned['cursor'])
+        self.assertEquals([1, 2], [entry['id'] for entry in returned['entries']])
+        self.rb.query_cursor.assert_called_with({'type': 'song', 'cursor': 'new', 'limit': '2', 'artist': 'uno'})
+        self.assertFalse(self.rb.query.called)
+
+    def test_last_cursor_page_has_no_cursor(self):
+        self.rb.query_cursor.return_value = ([], None)
+        result = handle_request(self.app,
+                environ('/rest/search', post_data='cursor=abc'), self.response)
+        self.assertEquals({}, json.loads(result))
+
+    def test_search_fields(self):
+        self.rb.query.return_value = [Stub(id=1)]
+        env = environ('/rest/search/song')
+        env['QUERY_STRING'] = 'fields=title, id'
+        result = handle_request(self.app, env, self.response)
+        self.assertEquals({'entries': [{'id': 1, 'title': 'title'}]}, json.loads(result))
+        self.rb.query.assert_called_with({'type': 'song'})
+
+    def test_search_columnar_format(self):
+        self.rb.query.return_value = [Stub(id=1), Stub(id=2)]
+        result = handle_request(self.app,
+                environ('/rest/search', post_data='artist=uno&format=columnar&fields=id,title'),
+                self.response)
+        expected = {'fields': ['id', 'title'], 'rows': [[1, 'title'], [2, 'title']]}
+        self.assertEquals(expected, json.loads(result))
+        self.rb.query.assert_called_with({'artist': 'uno'})
+
+    def test_search_unknown_format_fails(self):
+        result = handle_request(self.app,
+                environ('/rest/search', post_data='artist=uno&format=xml'), self.response)
+        self.assertEquals('400 Bad Request', self.response.call_args[0][0])
+        self.assertEquals('Unknown format xml', result)
+
+    def test_entries_are_encoded_once_until_they_change(self):
+        def search():
+            result = handle_request(self.app, environ('/rest/search', post_data='fields=id,title'),
+                    self.response)
+            return json.loads(result)['entries']
+        self.rb.query.return_value = [Stub(id=7, title='first')]
+        self.assertEquals([{'id': 7, 'title': 'first'}], search())
+        self.rb.query.return_value = [Stub(id=7, title='second')]
+        self.assertEquals([{'id': 7, 'title': 'first'}], search())
+        changed = Mock()
+        changed.get_ulong.return_value = 7
+        controller.forget_song(Mock(), changed, [])
+        self.assertEquals([{'id': 7, 'title': 'second'}], search())
+
+    def test_encoded_entries_are_joined(self):
+        content = {'entries': [b'{"id": 1}', b'{"id": 2}']}
+        self.assertEquals('{"entries": [{"id": 1}, {"id": 2}]}', ''.join(iter_json(content)))
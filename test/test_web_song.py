@@ -20,12 +20,20 @@ class TestWebSong(unittest.TestCase):
         self.response.assert_called_with('404 NOT FOUND',
                 [('Content-type', 'text/html; charset=UTF-8')])
 
+    def test_get_query_string_does_not_change_the_song(self):
+        self.rb.get_entry.return_value = Stub(id=1)
+        env = environ('/rest/song/1')
+        env['QUERY_STRING'] = 'rating=5'
+        handle_request(self.app, env, self.response)
+        self.assertEquals('200 OK', self.response.call_args[0][0])
+        self.assertFalse(self.rb.set_rating.called)
+
     def test_get_song_success(self):
         self.rb.get_entry.return_value = Stub(id=1)
         result = handle_request(self.app, environ('/rest/song/1'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         returned = json.loads(result)
         expected = json.loads('{ "play_count" : "play_count" , "album" : "album" , "track_number" : "track_number" , "rating" : "rating" , "last_played" : "last_played" , "location" : "location" , "id" : 1, "bitrate" : "bitrate" , "year" : "year" , "duration" : "duration" , "title" : "title" , "genre" : "genre" , "artist" : "artist"  }')
         self.assertEquals(expected, returned)
@@ -41,7 +49,7 @@ class TestWebSong(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/song/2', post_data='rating=5'), self.response)
         self.response.assert_called_with('200 OK',
                 [('Content-type', 'application/json; charset=UTF-8'),
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "play_count" : "play_count" , "album" : "album" , "track_number" : "track_number" , "rating" : 5, "last_played" : "last_played" , "location" : "location" , "id" : 2, "bitrate" : "bitrate" , "year" : "year" , "duration" : "duration" , "title" : "title" , "genre" : "genre" , "artist" : "artist"  }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -49,10 +57,26 @@ class TestWebSong(unittest.TestCase):
 
     def test_post_invalid_song_id_errs(self):
         result = handle_request(self.app, environ('/rest/song/X', post_data='rating=5'), self.response)
-        self.response.assert_called_with('400 Bad Request: X is invalid as value for song, int expected',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('X is invalid as value for song, int expected', result)
 
     def test_post_invalid_rating_errs(self):
         result = handle_request(self.app, environ('/rest/song/1', post_data='rating=x'), self.response)
-        self.response.assert_called_with('400 Bad Request: rating must be a number',
-                [('Content-type', 'text/html; charset=UTF-8')])
+        self.response.assert_called_with('400 Bad Request',
+                [('Content-type', 'text/plain; charset=UTF-8')])
+        self.assertEquals('rating must be a number', result)
+
+    def test_get_song_fields(self):
+        self.rb.get_entry.return_value = Stub(id=1)
+        env = environ('/rest/song/1')
+        env['QUERY_STRING'] = 'fields=id,title'
+        result = handle_request(self.app, env, self.response)
+        self.assertEquals({'id': 1, 'title': 'title'}, json.loads(result))
+
+    def test_get_song_unknown_fields_fail(self):
+        env = environ('/rest/song/1')
+        env['QUERY_STRING'] = 'fields=id,lyrics'
+        result = handle_request(self.app, env, self.response)
+        self.assertEquals('400 Bad Request', self.response.call_args[0][0])
+        self.assertEquals('Unknown fields lyrics', result)
@@ -1,16 +1,19 @@
 import unittest
 import json
 
-from mock import Mock
+from mock import Mock, patch
 from rhythmweb import view, controller, rb
-from utils import Stub, environ, handle_request
+from utils import Stub, environ, handle_request, mock_snapshot
 from rhythmweb.server import Server
+from rhythmweb.rb import RBHandler
 
 class TestWebStatus(unittest.TestCase):
 
     def setUp(self):
         self.rb = Mock(spec=rb.RBHandler)
         controller.rb_handler['rb'] = self.rb
+        controller.status_cache.clear()
+        mock_snapshot(self.rb)
         self.entry = Stub()
         self.response = Mock()
         self.app = Server()
@@ -23,7 +26,7 @@ class TestWebStatus(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/status'), self.response)
         self.response.assert_called_with('200 OK', 
                 [('Content-type', 'application/json; charset=UTF-8'), 
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('{ "playing_order" : "bla" , "volume" : 1, "muted" : true, "playing" : false }')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
@@ -38,7 +41,7 @@ class TestWebStatus(unittest.TestCase):
         result = handle_request(self.app, environ('/rest/status'), self.response)
         self.response.assert_called_with('200 OK', 
                 [('Content-type', 'application/json; charset=UTF-8'), 
-                    ('Cache-Control: ', 'no-cache; must-revalidate')])
+                    ('Cache-Control', 'no-cache')])
         expected = json.loads('''{ "playing_entry" : {
                         "artist" : "artist" , "title" : "title" , "duration" : 
                         "duration" , "genre" : "genre" , "id" : "id" , "year" : "year" , 
@@ -50,3 +53,137 @@ class TestWebStatus(unittest.TestCase):
                         "volume" : 1, "playing" : true, "playing_time" : 10 }''')
         returned = json.loads(result)
         self.assertEquals(expected, returned)
+
+    def set_status(self, volume=1):
+        self.rb.get_playing_status.return_value = False
+        self.rb.get_play_order.return_value = 'linear'
+        self.rb.get_mute.return_value = False
+        self.rb.get_volume.return_value = volume
+
+    def long_poll(self, since):
+        env = environ('/rest/status')
+        env['QUERY_STRING'] = 'since={}'.format(since)
+        env['rhythmweb.resume'] = Mock()
+        return self.app.handle_request(env, self.response), env['rhythmweb.resume']
+
+    def test_status_since_old_version_returns_at_once(self):
+        self.set_status()
+        self.rb.state_version = 3
+        controller.status_history.clear()
+        body, resume = self.long_poll(0)
+        returned = json.loads(b''.join(body).decode('UTF-8'))
+        self.assertEquals({'playing' : False, 'playing_order' : 'linear',
+            'muted' : False, 'volume' : 1, 'version' : 3}, returned)
+
+    @patch('rhythmweb.controller.GLib')
+    def test_status_since_current_version_waits_for_change(self, glib):
+        self.set_status()
+        self.rb.state_version = 3
+        controller.status_history.clear()
+        b''.join(self.long_poll(0)[0])
+        self.response.reset_mock()
+        body, resume = self.long_poll(3)
+        self.assertEquals(b'', next(body))
+        self.assertFalse(self.response.called)
+        listener = self.rb.add_state_listener.call_args[0][0]
+        self.rb.get_volume.return_value = 0.5
+        self.rb.state_version = 4
+        listener('player', 4)
+        self.assertTrue(resume.called)
+        self.rb.remove_state_listener.assert_called_with(listener)
+        glib.source_remove.assert_called_with(glib.timeout_add_seconds.return_value)
+        returned = json.loads(next(body).decode('UTF-8'))
+        self.assertEquals({'volume' : 0.5, 'version' : 4}, returned)
+        with self.assertRaises(StopIteration):
+            next(body)
+
+    @patch('rhythmweb.controller.GLib')
+    def test_status_since_current_version_times_out(self, glib):
+        self.set_status()
+        self.rb.state_version = 3
+        controller.status_history.clear()
+        b''.join(self.long_poll(0)[0])
+        body, resume = self.long_poll(3)
+        self.assertEquals(b'', next(body))
+        glib.timeout_add_seconds.assert_called_with(30, glib.timeout_add_seconds.call_args[0][1])
+        expired = glib.timeout_add_seconds.call_args[0][1]
+        self.assertFalse(expired())
+        self.assertEquals({'version' : 3}, json.loads(next(body).decode('UTF-8')))
+
+    @patch('rhythmweb.controller.GLib')
+    def test_closing_parked_request_removes_listener(self, glib):
+        self.set_status()
+        self.rb.state_version = 3
+        body, resume = self.long_poll(3)
+        next(body)
+        body.close()
+        self.assertTrue(self.rb.remove_state_listener.called)
+        self.assertTrue(glib.source_remove.called)
+
+    def test_status_since_must_be_a_number(self):
+        env = environ('/rest/status')
+        env['QUERY_STRING'] = 'since=abc'
+        self.app.handle_request(env, self.response)
+        self.assertEquals('400 Bad Request', self.response.call_args[0][0])
+
+
+class TestWebStatusSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.player = Mock()
+        self.player.get_playing.return_value = (None, True)
+        self.player.get_mute.return_value = (None, False)
+        self.player.get_volume.return_value = (None, 1.0)
+        self.player.get_playing_time.return_value = (None, 60)
+        self.player.props.play_order = 'linear'
+        entry = Mock()
+        entry.get_ulong.return_value = 7
+        entry.get_string.return_value = 'value'
+        entry.get_double.return_value = 5.0
+        self.player.get_playing_entry.return_value = entry
+        shell = Mock()
+        shell.props.shell_player = self.player
+        controller.rb_handler['rb'] = RBHandler(shell)
+        controller.status_cache.clear()
+        self.response = Mock()
+        self.app = Server()
+
+    def status(self):
+        return json.loads(handle_request(self.app, environ('/rest/status'), self.response))
+
+    @patch('rhythmweb.rb.time')
+    def test_second_status_skips_the_player(self, time):
+        time.time.return_value = 100
+        first = self.status()
+        time.time.return_value = 103
+        second = self.status()
+        self.assertEquals(1, self.player.get_playing.call_count)
+        self.assertEquals(1, self.player.get_playing_entry.call_count)
+        self.assertEquals(1, self.player.get_playing_time.call_count)
+        self.assertEquals(60, first['playing_time'])
+        self.assertEquals(63, second['playing_time'])
+        del first['playing_time'], second['playing_time']
+        self.assertEquals(first, second)
+        self.assertEquals(7, second['playing_entry']['id'])
+
+    def test_status_is_read_again_after_player_changes(self):
+        self.status()
+        controller.get_handler().state_changed(rb.STATE_PLAYER)
+        self.player.get_volume.return_value = (None, 0.5)
+        self.assertEquals(0.5, self.status()['volume'])
+        self.assertEquals(2, self.player.get_playing.call_count)
+
+    def test_queue_changes_keep_the_snapshot(self):
+        self.status()
+        controller.get_handler().state_changed(rb.STATE_QUEUE)
+        self.status()
+        self.assertEquals(1, self.player.get_playing.call_count)
+
+    @patch('rhythmweb.rb.time')
+    def test_encoded_status_splices_playing_time(self, time):
+        time.time.return_value = 100
+        snapshot = controller.Player().snapshot()
+        time.time.return_value = 110
+        body = snapshot.encode()
+        self.assertTrue(body.startswith(b'{"playing_time": 70, '))
+        self.assertEquals(snapshot.as_dict(), json.loads(body.decode('UTF-8')))
@@ -0,0 +1,40 @@
+import unittest
+import json
+
+from mock import Mock
+from rhythmweb import view, controller, rb
+from rhythmweb.server import Server
+from utils import environ, handle_request
+
+
+class TestWebSuggest(unittest.TestCase):
+
+    def setUp(self):
+        self.rb = Mock(spec=rb.RBHandler)
+        controller.rb_handler['rb'] = self.rb
+        self.rb.library.suggest.return_value = [('Beck', 9)]
+        self.response = Mock()
+        self.app = Server()
+
+    def get(self, query):
+        env = environ('/rest/suggest')
+        env['QUERY_STRING'] = query
+        return handle_request(self.app, env, self.response)
+
+    def test_suggests_artists_albums_and_titles(self):
+        result = json.loads(self.get('q=be'))
+        self.assertEquals(['album', 'artist', 'title'], sorted(result))
+        self.assertEquals([{'name' : 'Beck', 'play_count' : 9}], result['artist'])
+        self.rb.library.suggest.assert_any_call('artists', 'be', 10)
+        self.rb.library.suggest.assert_any_call('songs', 'be', 10)
+
+    def test_fields_and_limit(self):
+        result = json.loads(self.get('q=be&field=genre&limit=3'))
+        self.assertEquals(['genre'], list(result))
+        self.rb.library.suggest.assert_called_with('genres', 'be', 3)
+
+    def test_invalid_parameters_fail(self):
+        self.assertEquals('no "q" parameter', self.get('q='))
+        self.assertEquals('field must be one of artist, album, title, genre', self.get('q=a&field=year'))
+        self.assertEquals('limit must be between 1 and 50', self.get('q=a&limit=500'))
+        self.assertEquals('400 Bad Request', self.response.call_args[0][0])
@@ -114,3 +114,17 @@ def handle_request(app, env, response):
         return ''.join(line.decode('UTF-8') for line in result)
     return ''
 
+
+
+def mock_snapshot(handler):
+    """Builds the status snapshot of a mocked handler from its getters"""
+    def snapshot():
+        playing = handler.get_playing_status()
+        return {'playing' : playing,
+                'playing_entry' : handler.get_playing_entry() if playing else None,
+                'playing_order' : handler.get_play_order(),
+                'muted' : handler.get_mute(),
+                'volume' : handler.get_volume()}
+    handler.get_snapshot.side_effect = snapshot
+    handler.get_elapsed.side_effect = lambda: handler.get_playing_time()
+    handler.state_version = 0